@@ -0,0 +1,4 @@
+import time
+
+# Imported first in every worker, start up is measured from here
+STARTED = time.perf_counter()
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import time
+from collections import Counter, deque
+
+from fastapi import status
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.flow_config import get_config
+from app.metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT
+
+# Limits apply to each worker process, they share no state
+ADMISSION_CONCURRENCY = int(os.environ.get("ADMISSION_CONCURRENCY", "64"))
+ADMISSION_INSTANCE_CONCURRENCY = int(
+    os.environ.get("ADMISSION_INSTANCE_CONCURRENCY", "16")
+)
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "64"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "5"))
+S3_FOLDERS = frozenset(("devicezip", "images", "surveys"))
+S3_BUNDLE = "images.zip"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class FairScheduler:
+    def __init__(self, limit: int, instance_limit: int, queue_size: int):
+        self._limit = limit
+        self._instance_limit = instance_limit
+        self._queue_size = queue_size
+        self._total = 0
+        self._running: Counter[str] = Counter()
+        self._queues: dict[str, deque[asyncio.Future[None]]] = {}
+        # Instances with waiters, served round robin as slots free up
+        self._turns: deque[str] = deque()
+
+    async def acquire(self, instance: str) -> None:
+        if instance not in self._queues and self._can_start(instance):
+            self._start(instance)
+            return
+        if len(self._queues.get(instance, ())) >= self._queue_size:
+            raise QueueFullError(instance)
+        if instance not in self._queues:
+            self._queues[instance] = deque()
+            self._turns.append(instance)
+        queue = self._queues[instance]
+        waiter = asyncio.get_running_loop().create_future()
+        queue.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._forget(instance, waiter)
+            else:
+                # Granted a slot just before being cancelled, hand it on
+                self.release(instance)
+            raise
+
+    def release(self, instance: str) -> None:
+        self._total -= 1
+        self._running[instance] -= 1
+        if not self._running[instance]:
+            del self._running[instance]
+        self._wake()
+
+    def _can_start(self, instance: str) -> bool:
+        return (
+            self._total < self._limit and self._running[instance] < self._instance_limit
+        )
+
+    def _start(self, instance: str) -> None:
+        self._total += 1
+        self._running[instance] += 1
+
+    def _wake(self) -> None:
+        skipped = 0
+        while self._turns and self._total < self._limit and skipped < len(self._turns):
+            instance = self._turns[0]
+            if not self._can_start(instance):
+                self._turns.rotate(-1)
+                skipped += 1
+                continue
+            queue = self._queues[instance]
+            waiter = queue.popleft()
+            if queue:
+                self._turns.rotate(-1)
+            else:
+                del self._queues[instance]
+                self._turns.popleft()
+            if waiter.cancelled():
+                # Its task is still unwinding, _forget will find it gone
+                continue
+            self._start(instance)
+            waiter.set_result(None)
+            skipped = 0
+
+    def _forget(self, instance: str, waiter: asyncio.Future[None]) -> None:
+        queue = self._queues.get(instance)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[instance]
+            self._turns.remove(instance)
+
+
+scheduler = FairScheduler(
+    ADMISSION_CONCURRENCY, ADMISSION_INSTANCE_CONCURRENCY, ADMISSION_QUEUE_SIZE
+)
+
+
+def _instance(scope: Scope) -> str | None:
+    parts = scope["path"].split("/", 3)
+    # Bundles read many images, they are admitted like the S3 folders
+    if parts[2:] != [S3_BUNDLE] and (len(parts) < 4 or parts[2] not in S3_FOLDERS):
+        return None
+    # Unknown instances are answered without S3, and must not create series
+    return parts[1] if get_config(parts[1]) else None
+
+
+class AdmissionMiddleware:
+    def __init__(self, app: ASGIApp, scheduler: FairScheduler = scheduler):
+        self.app = app
+        self.scheduler = scheduler
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        instance = _instance(scope) if scope["type"] == "http" else None
+        if instance is None:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        depth = ADMISSION_QUEUE_DEPTH.labels(instance)
+        depth.inc()
+        try:
+            await self.scheduler.acquire(instance)
+        except QueueFullError:
+            ADMISSION_REJECTED.labels(instance).inc()
+            response = JSONResponse(
+                {"detail": "Too many requests for this instance"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+            )
+            await response(scope, receive, send)
+            return
+        finally:
+            depth.dec()
+        ADMISSION_WAIT.labels(instance).observe(time.perf_counter() - start)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.scheduler.release(instance)
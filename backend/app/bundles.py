@@ -0,0 +1,189 @@
+import asyncio
+import os
+import zipfile
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import aclosing
+from itertools import islice
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from pydantic import BaseModel, Field
+from starlette.responses import Response
+
+from app.concurrency import ReadAhead, io_executor, run_io
+from app.downloads import ObjectStreamingResponse
+from app.ingest import valid_filename
+from app.messages import BulkResultMessage, FileResult, MessageStatus
+from app.metrics import S3_ERRORS, error_code
+from app.s3 import S3Bucket
+
+BUNDLE_MAX_FILES = int(os.environ.get("BUNDLE_MAX_FILES", "1000"))
+# Images fetched ahead of the archive, bounds the memory held per bundle
+BUNDLE_PREFETCH = int(os.environ.get("BUNDLE_PREFETCH", "8"))
+# Images up to this size are read ahead whole, larger ones stream when written
+BUNDLE_BUFFER_SIZE = int(os.environ.get("BUNDLE_BUFFER_SIZE", str(8 * 1024 * 1024)))
+MANIFEST = "manifest.json"
+
+_Entry = tuple[zipfile.ZipInfo, bytes | StreamingBody]
+_Fetched = tuple[FileResult, _Entry | None]
+
+
+class BundleRequest(BaseModel):
+    filenames: list[str] = Field(min_length=1, max_length=BUNDLE_MAX_FILES)
+    form_id: int | None = None
+
+
+class _Sink:
+    # Without tell or seek zipfile writes each entry once, in order
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> list[bytes]:
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+
+def _read_image(bucket: S3Bucket, filename: str) -> _Entry:
+    res = bucket.download(f"images/{filename}")
+    info = zipfile.ZipInfo(filename, res["LastModified"].timetuple()[:6])
+    # Known upfront, zipfile picks ZIP64 headers for entries that need them
+    info.file_size = res["ContentLength"]
+    body = res["Body"]
+    if res["ContentLength"] > BUNDLE_BUFFER_SIZE:
+        return info, body
+    try:
+        return info, body.read()
+    finally:
+        body.close()
+
+
+def _close(entry: _Entry | None) -> None:
+    if entry and not isinstance(entry[1], bytes):
+        io_executor.submit(entry[1].close)
+
+
+def _release(read: "asyncio.Future[_Entry]") -> None:
+    if not read.exception():
+        _close(read.result())
+
+
+def _discard(task: "asyncio.Future[_Fetched]") -> None:
+    if not task.cancelled():
+        _close(task.result()[1])
+
+
+def _failed(filename: str, status: MessageStatus, message: str) -> FileResult:
+    return FileResult(filename=filename, status=status, message=message)
+
+
+async def _fetch(bucket: S3Bucket, filename: str) -> _Fetched:
+    if not valid_filename(filename):
+        return _failed(filename, MessageStatus.FAIL, "Invalid filename"), None
+    read = asyncio.ensure_future(run_io(_read_image, bucket, filename))
+    try:
+        entry = await asyncio.shield(read)
+    except asyncio.CancelledError:
+        # The read goes on in its thread, a response it opens is closed after
+        read.add_done_callback(_release)
+        raise
+    except Exception as e:
+        S3_ERRORS.labels("get_object", error_code(e)).inc()
+        if isinstance(e, ClientError) and (
+            e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 404
+        ):
+            return _failed(filename, MessageStatus.FAIL, "Not found"), None
+        return _failed(filename, MessageStatus.ERROR, error_code(e)), None
+    return FileResult(filename=filename, status=MessageStatus.SUCCESS), entry
+
+
+async def _write(
+    archive: zipfile.ZipFile,
+    sink: _Sink,
+    info: zipfile.ZipInfo,
+    data: bytes | StreamingBody,
+) -> AsyncGenerator[bytes, None]:
+    if isinstance(data, bytes):
+        await run_io(archive.writestr, info, data)
+    else:
+        chunks = ReadAhead(data)
+        try:
+            with archive.open(info, "w") as entry:
+                async for chunk in chunks:
+                    await run_io(entry.write, chunk)
+                    for part in sink.drain():
+                        yield part
+        finally:
+            chunks.close()
+    for part in sink.drain():
+        yield part
+
+
+async def zip_bundle(
+    bucket: S3Bucket, filenames: list[str], prefetch: int = BUNDLE_PREFETCH
+) -> AsyncIterator[bytes]:
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, "w")  # type: ignore[call-overload]
+    results: dict[str, FileResult] = {}
+    queued = iter(filenames)
+    pending: set[asyncio.Task[_Fetched]] = set()
+    done: set[asyncio.Task[_Fetched]] = set()
+    try:
+        while True:
+            for filename in islice(queued, prefetch - len(pending)):
+                pending.add(asyncio.create_task(_fetch(bucket, filename)))
+            if not pending:
+                break
+            # Entries are written as they arrive, a slow image only holds back itself
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            while done:
+                result, entry = done.pop().result()
+                results[result.filename] = result
+                if entry is None:
+                    continue
+                try:
+                    async with aclosing(_write(archive, sink, *entry)) as parts:
+                        async for part in parts:
+                            yield part
+                except Exception as e:
+                    # Already sent in part, the manifest flags it
+                    S3_ERRORS.labels("get_object", error_code(e)).inc()
+                    message = f"Incomplete: {error_code(e)}"
+                    results[result.filename] = _failed(
+                        result.filename, MessageStatus.ERROR, message
+                    )
+        files = [results[filename] for filename in filenames]
+        failed = sum(f.status != MessageStatus.SUCCESS for f in files)
+        manifest = BulkResultMessage(
+            status=MessageStatus.FAIL if failed else MessageStatus.SUCCESS,
+            message=f"{failed} of {len(files)} files missing" if failed else "OK!",
+            files=files,
+        )
+        archive.writestr(MANIFEST, manifest.model_dump_json(indent=2))
+        archive.close()
+        for chunk in sink.drain():
+            yield chunk
+    finally:
+        # Fetched but never written, or still in flight
+        for task in pending | done:
+            task.cancel()
+            task.add_done_callback(_discard)
+
+
+def bundle_response(bucket: S3Bucket, filenames: list[str], name: str) -> Response:
+    return ObjectStreamingResponse(
+        zip_bundle(bucket, list(dict.fromkeys(filenames))),
+        media_type="application/zip",
+        headers={
+            "content-disposition": f'attachment; filename="{name}"',
+            "cache-control": "no-store",
+        },
+    )
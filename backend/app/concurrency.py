@@ -0,0 +1,90 @@
+import asyncio
+import os
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, ParamSpec, TypeVar
+
+if TYPE_CHECKING:
+    from botocore.response import StreamingBody
+
+IO_THREADS = int(os.environ.get("IO_THREADS", "128"))
+READ_CHUNK_MIN_SIZE = int(os.environ.get("READ_CHUNK_MIN_SIZE", str(64 * 1024)))
+READ_CHUNK_MAX_SIZE = int(os.environ.get("READ_CHUNK_MAX_SIZE", str(1024 * 1024)))
+# Chunks read ahead of the client, bounds the memory held per download
+READ_AHEAD = int(os.environ.get("READ_AHEAD", "4"))
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+io_executor = ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io")
+
+
+async def run_io(func: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, partial(func, *args, **kwargs))
+
+
+class ReadAhead:
+    def __init__(
+        self,
+        body: "StreamingBody",
+        min_size: int = READ_CHUNK_MIN_SIZE,
+        max_size: int = READ_CHUNK_MAX_SIZE,
+        read_ahead: int = READ_AHEAD,
+    ):
+        self._body = body
+        self._size = min_size
+        self._max_size = max_size
+        self._queue: asyncio.Queue[bytes | Exception] = asyncio.Queue(read_ahead)
+        self._task: asyncio.Task[None] | None = None
+        self._stopped = False
+        # Reads and close run in io threads, close waits for a read in progress
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __aiter__(self) -> "ReadAhead":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._stopped:
+            raise StopAsyncIteration
+        if self._task is None:
+            self._task = asyncio.create_task(self._fill())
+        item = await self._queue.get()
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        if not item:
+            self.close()
+            raise StopAsyncIteration
+        return item
+
+    def close(self) -> None:
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._task:
+            self._task.cancel()
+        # Releases the upstream connection without waiting on the event loop
+        io_executor.submit(self._close)
+
+    async def _fill(self) -> None:
+        try:
+            while chunk := await run_io(self._read, self._size):
+                await self._queue.put(chunk)
+                # Small objects start quickly, large ones take fewer hops
+                self._size = min(self._size * 2, self._max_size)
+            await self._queue.put(b"")
+        except Exception as e:
+            await self._queue.put(e)
+
+    def _read(self, size: int) -> bytes:
+        with self._lock:
+            return b"" if self._closed else self._body.read(size)
+
+    def _close(self) -> None:
+        with self._lock:
+            self._closed = True
+            self._body.close()
@@ -1,16 +1,25 @@
 from collections.abc import Callable
 
-from app.flow_config import AWS_ACCESS_ID, AWS_BUCKET, AWS_SECRET, GCP_CREDENTIAL
-from app.form_validator import FormValidator
-from app.s3 import S3Bucket
+from app.flow_config import (
+    AWS_ACCESS_ID,
+    AWS_BUCKET,
+    AWS_REGION,
+    AWS_SECRET,
+    GCP_CREDENTIAL,
+)
+from app.form_validator import FormValidator, get_form_validator
+from app.s3 import S3Bucket, resolve_region
 
 
 def make_bucket(config: dict[str, str]) -> S3Bucket:
-    return S3Bucket(
-        config.get(AWS_BUCKET, ""),
-        config.get(AWS_ACCESS_ID, ""),
-        config.get(AWS_SECRET, ""),
+    bucket = config.get(AWS_BUCKET, "")
+    access_key_id = config.get(AWS_ACCESS_ID, "")
+    secret_access_key = config.get(AWS_SECRET, "")
+    # Called off the event loop, the first call per bucket may look its region up
+    region = config.get(AWS_REGION) or resolve_region(
+        bucket, access_key_id, secret_access_key
     )
+    return S3Bucket(bucket, access_key_id, secret_access_key, region)
 
 
 def provide_make_bucket() -> Callable[[dict[str, str]], S3Bucket]:
@@ -18,7 +27,7 @@ def provide_make_bucket() -> Callable[[dict[str, str]], S3Bucket]:
 
 
 def make_form_validator(config: dict[str, str]) -> FormValidator:
-    return FormValidator(config.get(GCP_CREDENTIAL, ""))
+    return get_form_validator(config.get(GCP_CREDENTIAL, ""))
 
 
 def provide_make_form_validator() -> Callable[[dict[str, str]], FormValidator]:
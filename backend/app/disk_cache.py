@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections.abc import Iterable
+from contextlib import suppress
+from email.utils import formatdate
+from typing import IO, TYPE_CHECKING, NamedTuple
+
+from app.metrics import (
+    SURVEY_CACHE_EVICTIONS,
+    SURVEY_CACHE_LOOKUPS,
+    SURVEY_CACHE_SERVED,
+)
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3.type_defs import GetObjectOutputTypeDef
+
+SURVEY_CACHE_DIR = os.environ.get(
+    "SURVEY_CACHE_DIR", os.path.join(tempfile.gettempdir(), "flow-survey-cache")
+)
+SURVEY_CACHE_MAX_BYTES = int(
+    os.environ.get("SURVEY_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))
+)
+STALE_FILL_SECONDS = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(NamedTuple):
+    path: str
+    size: int
+    headers: dict[str, str]
+
+
+class CacheFill:
+    def __init__(self, cache: "DiskCache", path: str, file: IO[bytes]):
+        self.file = file
+        self._cache = cache
+        self._path = path
+
+    def commit(self, res: "GetObjectOutputTypeDef") -> None:
+        headers = {
+            "content-type": res["ContentType"],
+            "etag": res["ETag"],
+            "last-modified": formatdate(res["LastModified"].timestamp(), usegmt=True),
+        }
+        try:
+            self._cache._write(f"{self._path}.json", [json.dumps(headers).encode()])
+            # Readers still holding the file keep reading it after the rename
+            os.replace(f"{self._path}.tmp", self._path)
+            self._cache.evict()
+        except OSError:
+            logger.warning("Could not cache %s", self._path, exc_info=True)
+            self.discard()
+
+    def discard(self) -> None:
+        with suppress(FileNotFoundError):
+            os.remove(f"{self._path}.tmp")
+
+
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, instance: str, name: str) -> CacheEntry | None:
+        path = self._path(instance, name)
+        try:
+            with open(f"{path}.json") as f:
+                headers = json.load(f)
+            size = os.stat(path).st_size
+            # The file mtime is the LRU clock shared by all workers
+            os.utime(path)
+        except (OSError, ValueError):
+            SURVEY_CACHE_LOOKUPS.labels("miss").inc()
+            return None
+        SURVEY_CACHE_LOOKUPS.labels("hit").inc()
+        return CacheEntry(path, size, headers)
+
+    def served(self, size: int) -> None:
+        SURVEY_CACHE_SERVED.inc(size)
+
+    def reserve(self, instance: str, name: str) -> CacheFill | None:
+        path = self._path(instance, name)
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            # The fill file is the claim, workers never fill the same entry twice
+            fd = os.open(f"{path}.tmp", os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return None
+        return CacheFill(self, path, os.fdopen(fd, "w+b"))
+
+    def evict(self) -> None:
+        now = time.time()
+        files: list[tuple[float, str, int]] = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            # Other workers may evict or rename the same files concurrently
+            with suppress(FileNotFoundError):
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    if stat.st_mtime < now - STALE_FILL_SECONDS:
+                        os.remove(entry.path)
+                elif not entry.name.endswith(".json"):
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+                    total += stat.st_size
+        for _, path, size in sorted(files):
+            if total <= self.max_bytes:
+                break
+            for evicted in (path, f"{path}.json"):
+                with suppress(FileNotFoundError):
+                    os.remove(evicted)
+            total -= size
+            SURVEY_CACHE_EVICTIONS.inc()
+
+    def _path(self, instance: str, name: str) -> str:
+        digest = hashlib.sha256(f"{instance}/{name}".encode()).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def _write(self, path: str, chunks: Iterable[bytes]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+
+survey_cache = DiskCache(SURVEY_CACHE_DIR, SURVEY_CACHE_MAX_BYTES)
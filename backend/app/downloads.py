@@ -0,0 +1,301 @@
+import os
+import re
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Iterator
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from typing import TYPE_CHECKING, Any
+
+from botocore.exceptions import ClientError
+from fastapi import HTTPException, Request, status
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from app.concurrency import ReadAhead, run_io
+from app.disk_cache import CacheFill
+from app.flow_config import DOWNLOAD_REDIRECT
+from app.metrics import S3_ERRORS, error_code, timed
+from app.resilience import CircuitOpenError
+from app.s3 import ObjectMetadata, S3Bucket
+from app.singleflight import SharedReader, shared_downloads
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3.type_defs import GetObjectOutputTypeDef
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+FILE_CHUNK_SIZE = 256 * 1024
+ZERO_COPY_SEND = "http.response.zerocopysend"
+DOWNLOAD_REDIRECT_ENABLED = os.environ.get("DOWNLOAD_REDIRECT", "").lower() == "true"
+
+singleRangePattern = re.compile(r"^bytes=(\d+-\d*|-\d+)$")
+
+_passthrough_headers = ("etag", "last-modified", "cache-control")
+
+
+def redirects(config: dict[str, str]) -> bool:
+    return (
+        DOWNLOAD_REDIRECT_ENABLED
+        or config.get(DOWNLOAD_REDIRECT, "").strip().lower() == "true"
+    )
+
+
+def redirect_response(bucket: S3Bucket, key: str) -> RedirectResponse:
+    return RedirectResponse(
+        bucket.presigned_url(key),
+        status_code=status.HTTP_307_TEMPORARY_REDIRECT,
+        headers={"cache-control": "no-store"},
+    )
+
+
+@contextmanager
+def s3_errors(operation: str) -> Iterator[None]:
+    # Missing or unreadable objects are not found, slow ones time out
+    try:
+        yield
+    except (HTTPException, CircuitOpenError):
+        raise
+    except TimeoutError as e:
+        S3_ERRORS.labels(operation, error_code(e)).inc()
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT) from e
+    except Exception as e:
+        S3_ERRORS.labels(operation, error_code(e)).inc()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND) from e
+
+
+def download_params(request: Request) -> dict[str, Any]:
+    params: dict[str, Any] = {}
+    if etags := request.headers.get("if-none-match"):
+        params["IfNoneMatch"] = etags
+    elif modified_since := request.headers.get("if-modified-since"):
+        try:
+            params["IfModifiedSince"] = parsedate_to_datetime(modified_since)
+        except (TypeError, ValueError):
+            pass
+    byte_range = request.headers.get("range", "").replace(" ", "")
+    if singleRangePattern.match(byte_range):
+        params["Range"] = byte_range
+    return params
+
+
+def byte_range(request: Request, size: int) -> tuple[int, int] | None:
+    value = request.headers.get("range", "").replace(" ", "")
+    if not singleRangePattern.match(value):
+        return None
+    first, last = value.removeprefix("bytes=").split("-")
+    if not first:
+        start, end = max(size - int(last), 0), size - 1
+    elif last and int(last) < int(first):
+        return None
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start >= size:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"content-range": f"bytes */{size}"},
+        )
+    return start, end
+
+
+def not_modified(request: Request, etag: str, last_modified: str) -> bool:
+    if if_none_match := request.headers.get("if-none-match"):
+        etags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in etags or etag.removeprefix("W/") in etags
+    if modified_since := request.headers.get("if-modified-since"):
+        try:
+            return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(
+                modified_since
+            )
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class FileSliceResponse(Response):
+    def __init__(
+        self,
+        path: str,
+        offset: int,
+        count: int,
+        status_code: int = status.HTTP_200_OK,
+        headers: dict[str, str] | None = None,
+        media_type: str | None = None,
+    ):
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers({**(headers or {}), "content-length": str(count)})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        file = await run_io(open, self.path, "rb")
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers,
+                }
+            )
+            if scope["method"].upper() == "HEAD":
+                await send({"type": "http.response.body", "body": b""})
+            elif ZERO_COPY_SEND in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": ZERO_COPY_SEND,
+                        "file": file,
+                        "offset": self.offset,
+                        "count": self.count,
+                    }
+                )
+            else:
+                await self._send_chunks(file.fileno(), send)
+        finally:
+            file.close()
+
+    async def _send_chunks(self, fd: int, send: Send) -> None:
+        position, end = self.offset, self.offset + self.count
+        more_body = True
+        while more_body:
+            size = min(FILE_CHUNK_SIZE, end - position)
+            chunk = await run_io(os.pread, fd, size, position)
+            position += len(chunk)
+            more_body = bool(chunk) and position < end
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": more_body}
+            )
+
+
+def file_response(
+    path: str,
+    size: int,
+    headers: dict[str, str],
+    request: Request,
+    cache_control: str | None = None,
+) -> Response:
+    response_headers = {
+        "accept-ranges": "bytes",
+        "etag": headers["etag"],
+        "last-modified": headers["last-modified"],
+    }
+    if cache_control:
+        response_headers["cache-control"] = cache_control
+    if not_modified(request, headers["etag"], headers["last-modified"]):
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=response_headers
+        )
+    offset, count, status_code = 0, size, status.HTTP_200_OK
+    if requested := byte_range(request, size):
+        start, end = requested
+        offset, count = start, end - start + 1
+        status_code = status.HTTP_206_PARTIAL_CONTENT
+        response_headers["content-range"] = f"bytes {start}-{end}/{size}"
+    return FileSliceResponse(
+        path,
+        offset,
+        count,
+        status_code=status_code,
+        headers=response_headers,
+        media_type=headers["content-type"],
+    )
+
+
+class ObjectStreamingResponse(StreamingResponse):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Starlette leaves the body suspended when the client disconnects
+            if isinstance(self.body_iterator, ReadAhead | SharedReader):
+                self.body_iterator.close()
+            elif isinstance(self.body_iterator, AsyncGenerator):
+                await self.body_iterator.aclose()
+
+
+def object_headers(
+    res: "GetObjectOutputTypeDef", cache_control: str | None = None
+) -> dict[str, str]:
+    headers = {
+        "accept-ranges": "bytes",
+        "content-length": str(res["ContentLength"]),
+        "etag": res["ETag"],
+        "last-modified": formatdate(res["LastModified"].timestamp(), usegmt=True),
+    }
+    if "ContentRange" in res:
+        headers["content-range"] = res["ContentRange"]
+    if cache_control:
+        headers["cache-control"] = cache_control
+    return headers
+
+
+async def object_response(
+    bucket: S3Bucket,
+    key: str,
+    request: Request,
+    cache_control: str | None = None,
+    reserve: Callable[[], CacheFill | None] | None = None,
+) -> Response:
+    params = download_params(request)
+    content: AsyncIterator[bytes]
+    with s3_errors("get_object"):
+        try:
+            with timed("s3_first_byte"):
+                if params:
+                    res = await run_io(bucket.download, key, **params)
+                    content = ReadAhead(res["Body"])
+                else:
+                    # Identical concurrent requests share a single upstream fetch
+                    res, content = await shared_downloads.open(bucket, key, reserve)
+            return ObjectStreamingResponse(
+                content=content,
+                status_code=(
+                    status.HTTP_206_PARTIAL_CONTENT
+                    if "ContentRange" in res
+                    else status.HTTP_200_OK
+                ),
+                media_type=res["ContentType"],
+                headers=object_headers(res, cache_control),
+            )
+        except ClientError as e:
+            metadata = e.response.get("ResponseMetadata", {})
+            status_code = metadata.get("HTTPStatusCode")
+            if status_code == status.HTTP_304_NOT_MODIFIED:
+                s3_headers = metadata.get("HTTPHeaders", {})
+                headers = {
+                    h: v for h, v in s3_headers.items() if h in _passthrough_headers
+                }
+                if cache_control:
+                    headers["cache-control"] = cache_control
+                return Response(status_code=status_code, headers=headers)
+            if status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE:
+                return Response(
+                    status_code=status_code, headers={"accept-ranges": "bytes"}
+                )
+            raise
+
+
+async def object_metadata(bucket: S3Bucket, key: str) -> ObjectMetadata:
+    with s3_errors("head_object"), timed("s3_head"):
+        metadata = await run_io(bucket.head, key)
+    if metadata is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return metadata
+
+
+async def head_response(
+    bucket: S3Bucket, key: str, request: Request, cache_control: str | None = None
+) -> Response:
+    metadata = await object_metadata(bucket, key)
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": metadata.etag,
+        "last-modified": formatdate(metadata.last_modified.timestamp(), usegmt=True),
+    }
+    if cache_control:
+        headers["cache-control"] = cache_control
+    if not_modified(request, headers["etag"], headers["last-modified"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # The body is never sent, the length is that of the object
+    headers["content-length"] = str(metadata.size)
+    return Response(headers=headers, media_type=metadata.content_type)
@@ -1,64 +1,165 @@
 # pyright: strict, reportCallIssue=false, reportArgumentType=false, reportReturnType=false
 
+import fcntl
 import json
 import os
 import re
 import tempfile
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass
 from glob import glob
 from xml.etree import ElementTree
 
 from git.cmd import Git
+from git.exc import GitCommandError
 
-SOURCE_PATH = "/akvo-flow-server-config"
-CONFIG_FILE = f"{tempfile.gettempdir()}/flow-config.json"
+SOURCE_PATH = os.environ.get("FLOW_CONFIG_SOURCE", "/akvo-flow-server-config")
+CONFIG_FILE = os.environ.get(
+    "FLOW_CONFIG_FILE", f"{tempfile.gettempdir()}/flow-config.json"
+)
 AWS_BUCKET = "awsBucket"
 AWS_ACCESS_ID = "awsAccessKeyId"
 AWS_SECRET = "awsSecretKey"
 GCP_CREDENTIAL = "gcpCredentialFile"
+AWS_REGION = "awsRegion"
+DOWNLOAD_REDIRECT = "downloadRedirect"
+POPULATE_WORKERS = int(os.environ.get("POPULATE_WORKERS", "8"))
 
 instanceUrlPattern = re.compile(
-    r"^(https?://)?(?P<alias>.+)+\.(akvoflow\.org|appspot\.com)$"
+    r"^(https?://)?(?P<alias>.+)\.(akvoflow\.org|appspot\.com)$"
 )
 
 
-def populate(*, source: str = SOURCE_PATH, destination: str = CONFIG_FILE) -> None:
-    files = glob(f"{source}/*/survey.properties")
+@dataclass(frozen=True)
+class _Snapshot:
+    signature: tuple[int, int, int, int]
+    configs: dict[str, dict[str, str]]
+
+
+_snapshots: dict[str, _Snapshot] = {}
+
+
+def populate(
+    *,
+    source: str = SOURCE_PATH,
+    destination: str = CONFIG_FILE,
+    changed: Iterable[str] | None = None,
+) -> None:
     configs: dict[str, dict[str, str]] = {}
-    for f in files:
-        props = _parse_survey_props(f)
-        path = os.path.dirname(f)
-        app_id = _get_app_id(path)
-        if not app_id:
-            continue
-        matches = instanceUrlPattern.match(props.get("instanceUrl", ""))
-        if not matches:
-            continue
-        alias = matches.group("alias").strip()
-        if not alias:
-            continue
-        gcp_credential_file = glob(f"{path}/{app_id}*.json")
-        if not gcp_credential_file:
-            continue
-        props[GCP_CREDENTIAL] = gcp_credential_file[0]
-        configs[alias] = props
-    with open(destination, "w") as out:
-        json.dump(configs, out)
+    if changed is None:
+        paths = [os.path.dirname(f) for f in glob(f"{source}/*/survey.properties")]
+    else:
+        # Only the changed instance directories are reindexed
+        paths = [os.path.normpath(os.path.join(source, d)) for d in changed]
+        reindexed = set(paths)
+        with open(destination) as f:
+            for alias, props in json.load(f).items():
+                path = os.path.normpath(os.path.dirname(props[GCP_CREDENTIAL]))
+                if path not in reindexed:
+                    configs[alias] = props
+    with ThreadPoolExecutor(max_workers=POPULATE_WORKERS) as executor:
+        for entry in executor.map(_index_instance, paths):
+            if entry:
+                configs[entry[0]] = entry[1]
+    # Workers read the file concurrently, so it is replaced in a single rename
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destination), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as out:
+            json.dump(configs, out)
+        os.replace(tmp, destination)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    _snapshots.pop(destination, None)
+
+
+def _index_instance(path: str) -> tuple[str, dict[str, str]] | None:
+    survey_props = f"{path}/survey.properties"
+    if not os.path.isfile(survey_props):
+        return None
+    props = _parse_survey_props(survey_props)
+    app_id = _get_app_id(path)
+    if not app_id:
+        return None
+    matches = instanceUrlPattern.match(props.get("instanceUrl", ""))
+    if not matches:
+        return None
+    alias = matches.group("alias").strip()
+    if not alias:
+        return None
+    gcp_credential_file = next(
+        (
+            entry.path
+            for entry in os.scandir(path)
+            if entry.name.startswith(app_id) and entry.name.endswith(".json")
+        ),
+        None,
+    )
+    if not gcp_credential_file:
+        return None
+    props[GCP_CREDENTIAL] = gcp_credential_file
+    return alias, props
 
 
 def get_config(
     app_id: str, *, config_file: str = CONFIG_FILE, source: str = SOURCE_PATH
 ) -> dict[str, str] | None:
-    if not os.path.isfile(config_file):
+    config = _load(config_file, source)
+    return config[app_id] if app_id in config else None
+
+
+def _load(config_file: str, source: str) -> dict[str, dict[str, str]]:
+    try:
+        stat = os.stat(config_file)
+    except FileNotFoundError:
         populate(source=source, destination=config_file)
+        stat = os.stat(config_file)
+    snapshot = _snapshots.get(config_file)
+    if snapshot and snapshot.signature == _signature(stat):
+        return snapshot.configs
     with open(config_file) as f:
-        config = json.load(f)
-        return config[app_id] if app_id in config else None
+        snapshot = _Snapshot(_signature(os.fstat(f.fileno())), json.load(f))
+    _snapshots[config_file] = snapshot
+    return snapshot.configs
+
+
+def _signature(stat: os.stat_result) -> tuple[int, int, int, int]:
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
 
 
 def refresh(*, source: str = SOURCE_PATH, destination: str = CONFIG_FILE) -> None:
-    repo = Git(source)
-    repo.pull(rebase=True)
-    populate(source=source, destination=destination)
+    # Workers refreshing at the same time would race on the git index
+    with open(f"{destination}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        repo = Git(source)
+        repo.pull(rebase=True)
+        new_head = repo.rev_parse("HEAD")
+        # Diffed from the last commit indexed, so a failed run is picked up again
+        old_head = _indexed_head(destination)
+        changed = None
+        if old_head and os.path.exists(destination):
+            # Unknown history (e.g. a force push) falls back to a full rebuild
+            with suppress(GitCommandError):
+                changed = _changed_directories(repo, old_head, new_head)
+        if changed is None or changed:
+            populate(source=source, destination=destination, changed=changed)
+        with open(f"{destination}.head", "w") as f:
+            f.write(new_head)
+
+
+def _indexed_head(destination: str) -> str | None:
+    with suppress(FileNotFoundError), open(f"{destination}.head") as f:
+        return f.read().strip() or None
+    return None
+
+
+def _changed_directories(repo: Git, old_head: str, new_head: str) -> set[str]:
+    if old_head == new_head:
+        return set()
+    names = repo.diff("--name-only", old_head, new_head)
+    return {name.split("/")[0] for name in names.splitlines() if "/" in name}
 
 
 def _parse_survey_props(filename: str) -> dict[str, str]:
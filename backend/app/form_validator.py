@@ -1,19 +1,146 @@
-from functools import cached_property
+import os
+import threading
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future
+from functools import cache, cached_property
+from typing import TYPE_CHECKING
 
-from google.cloud.datastore import Client
-from google.oauth2.service_account import Credentials
+from app.cache import TTLCache
+from app.metrics import DATASTORE_ERRORS, FORM_CACHE_LOOKUPS
+from app.resilience import datastore_get, guarded
+
+if TYPE_CHECKING:
+    from google.cloud.datastore import Client
+
+FORM_CACHE_SIZE = int(os.environ.get("FORM_CACHE_SIZE", "10000"))
+FORM_CACHE_HIT_TTL = float(os.environ.get("FORM_CACHE_HIT_TTL", "300"))
+FORM_CACHE_MISS_TTL = float(os.environ.get("FORM_CACHE_MISS_TTL", "30"))
+FORM_BATCH_WINDOW = float(os.environ.get("FORM_BATCH_WINDOW", "0.005"))
+FORM_BATCH_SIZE = int(os.environ.get("FORM_BATCH_SIZE", "100"))
+DATASTORE_TIMEOUT = float(os.environ.get("DATASTORE_TIMEOUT", "5"))
+
+
+class _Batch:
+    def __init__(self) -> None:
+        self.futures: dict[int, Future[bool]] = {}
+        self.full = threading.Event()
+
+
+class _Batcher:
+    def __init__(
+        self,
+        fetch: Callable[[list[int]], Iterable[int]],
+        window: float,
+        max_size: int,
+    ):
+        self._fetch = fetch
+        self._window = window
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._open: _Batch | None = None
+        self._in_flight: dict[int, Future[bool]] = {}
+
+    def get(self, form_id: int) -> bool:
+        batch = None
+        with self._lock:
+            future = self._in_flight.get(form_id)
+            if future is None and self._open:
+                future = self._open.futures.get(form_id)
+            if future is None:
+                if self._open is None:
+                    # The caller opening a batch collects and resolves it
+                    batch = self._open = _Batch()
+                future = self._open.futures[form_id] = Future()
+                if len(self._open.futures) >= self._max_size:
+                    self._open.full.set()
+                    self._open = None
+        if batch:
+            batch.full.wait(self._window)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+                self._in_flight.update(batch.futures)
+            self._resolve(batch.futures)
+        return future.result()
+
+    def _resolve(self, batch: dict[int, Future[bool]]) -> None:
+        try:
+            found = set(self._fetch(list(batch)))
+        except BaseException as e:
+            for future in batch.values():
+                future.set_exception(e)
+        else:
+            for form_id, future in batch.items():
+                future.set_result(form_id in found)
+        finally:
+            with self._lock:
+                for form_id in batch:
+                    self._in_flight.pop(form_id, None)
 
 
 class FormValidator:
     def __init__(self, service_account_file: str):
         self._service_account_file = service_account_file
+        # The file name starts with the app id, it tells instances apart
+        credentials = os.path.basename(service_account_file)
+        self._lookups = {
+            result: FORM_CACHE_LOOKUPS.labels(credentials, result)
+            for result in ("hit", "miss")
+        }
+        self._forms: TTLCache[int, bool] = TTLCache(FORM_CACHE_SIZE, FORM_CACHE_HIT_TTL)
+        self._batcher = _Batcher(self._fetch, FORM_BATCH_WINDOW, FORM_BATCH_SIZE)
 
     @cached_property
-    def datastore_client(self) -> Client:
+    def datastore_client(self) -> "Client":
+        # Deferred, the import is a good part of a worker's start up time
+        from google.cloud.datastore import Client
+        from google.oauth2.service_account import Credentials
+
         credentials = Credentials.from_service_account_file(self._service_account_file)
         return Client(credentials=credentials, project=credentials.project_id)
 
     def validate(self, form_id: int) -> bool:
-        key = self.datastore_client.key("Survey", form_id)
-        entity = self.datastore_client.get(key)
-        return True if entity else False
+        exists = self._forms.get(form_id)
+        self._lookups["miss" if exists is None else "hit"].inc()
+        if exists is None:
+            exists = self._batcher.get(form_id)
+            ttl = FORM_CACHE_HIT_TTL if exists else FORM_CACHE_MISS_TTL
+            self._forms.set(form_id, exists, ttl)
+        return exists
+
+    def prime(self, limit: int) -> int:
+        client = self.datastore_client
+        if not limit:
+            return 0
+        query = client.query(kind="Survey")
+        query.keys_only()
+        form_ids = [entity.key.id for entity in query.fetch(limit=limit)]
+        for form_id in form_ids:
+            self._forms.set(form_id, True)
+        return len(form_ids)
+
+    def _fetch(self, form_ids: list[int]) -> list[int]:
+        try:
+            return guarded(
+                f"datastore:{self._service_account_file}",
+                datastore_get,
+                lambda: self._lookup(form_ids),
+            )
+        except Exception:
+            DATASTORE_ERRORS.inc()
+            raise
+
+    def _lookup(self, form_ids: list[int]) -> list[int]:
+        client = self.datastore_client
+        keys = [client.key("Survey", form_id) for form_id in form_ids]
+        if len(keys) == 1:
+            return form_ids if client.get(keys[0], timeout=DATASTORE_TIMEOUT) else []
+        return [
+            entity.key.id
+            for entity in client.get_multi(keys, timeout=DATASTORE_TIMEOUT)
+        ]
+
+
+@cache
+def get_form_validator(service_account_file: str) -> FormValidator:
+    return FormValidator(service_account_file)
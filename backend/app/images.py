@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from typing import NamedTuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+from fastapi import HTTPException, Request, status
+from PIL import Image, ImageOps
+from starlette.background import BackgroundTask
+from starlette.responses import Response
+
+from app.concurrency import run_io
+from app.downloads import REVALIDATE, object_metadata, object_response, s3_errors
+from app.metrics import S3_ERRORS, error_code, timed
+from app.s3 import S3Bucket
+
+IMAGE_SIZES = frozenset(
+    int(size) for size in os.environ.get("IMAGE_SIZES", "160,320,640,1280").split(",")
+)
+IMAGE_QUALITIES = frozenset(
+    int(q) for q in os.environ.get("IMAGE_QUALITIES", "50,75,90").split(",")
+)
+IMAGE_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+DEFAULT_QUALITY = 75
+DEFAULT_FORMAT = "jpeg"
+IMAGE_MAX_SOURCE_SIZE = int(
+    os.environ.get("IMAGE_MAX_SOURCE_SIZE", str(32 * 1024 * 1024))
+)
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+
+# Pillow releases the GIL while resizing and encoding, threads run in parallel
+image_executor = ThreadPoolExecutor(
+    max_workers=IMAGE_WORKERS, thread_name_prefix="image"
+)
+_rendering: dict[str, "asyncio.Future[bytes]"] = {}
+_tasks: set["asyncio.Task[None]"] = set()
+
+
+class Variant(NamedTuple):
+    width: int | None
+    height: int | None
+    quality: int
+    format: str
+
+    def key(self, filename: str, etag: str) -> str:
+        # Keyed by the source ETag, a re-uploaded image never serves stale variants
+        size = f"{self.width or 0}x{self.height or 0}"
+        return (
+            f"derivatives/images/{filename}/{etag.strip('"')}/"
+            f"{size}-q{self.quality}.{self.format}"
+        )
+
+
+def parse_variant(
+    width: int | None, height: int | None, quality: int | None, format: str | None
+) -> Variant | None:
+    if width is None and height is None and quality is None and format is None:
+        return None
+    # Every variant is stored, a bounded set keeps the cache from being flooded
+    for name, value in (("w", width), ("h", height)):
+        if value is not None and value not in IMAGE_SIZES:
+            raise HTTPException(
+                status.HTTP_422_UNPROCESSABLE_ENTITY,
+                f"{name} must be one of {sorted(IMAGE_SIZES)}",
+            )
+    if quality is not None and quality not in IMAGE_QUALITIES:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"q must be one of {sorted(IMAGE_QUALITIES)}",
+        )
+    if format is not None and format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            f"format must be one of {sorted(IMAGE_FORMATS)}",
+        )
+    return Variant(width, height, quality or DEFAULT_QUALITY, format or DEFAULT_FORMAT)
+
+
+def render(data: bytes, variant: Variant) -> bytes:
+    with Image.open(io.BytesIO(data)) as original:
+        # Phone cameras store rotation in EXIF, thumbnails would lose it
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail(
+            (variant.width or image.width, variant.height or image.height),
+            Image.Resampling.LANCZOS,
+        )
+        if variant.format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, variant.format, quality=variant.quality, optimize=True)
+        return output.getvalue()
+
+
+def read_source(bucket: S3Bucket, key: str) -> bytes:
+    res = bucket.download(key)
+    if res["ContentLength"] > IMAGE_MAX_SOURCE_SIZE:
+        res["Body"].close()
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, "Image too large to resize"
+        )
+    return res["Body"].read()
+
+
+async def store_variant(
+    bucket: S3Bucket, key: str, data: bytes, media_type: str
+) -> None:
+    upload = bucket.multipart_upload(key, {"ContentType": media_type})
+    try:
+        await run_io(upload.complete, data)
+    except (BotoCoreError, ClientError) as e:
+        # The variant was served anyway, the next request generates it again
+        S3_ERRORS.labels("put_object", error_code(e)).inc()
+
+
+async def variant_response(
+    bucket: S3Bucket, filename: str, variant: Variant, request: Request
+) -> Response:
+    source = await object_metadata(bucket, f"images/{filename}")
+    key = variant.key(filename, source.etag)
+    try:
+        return await object_response(bucket, key, request, REVALIDATE)
+    except HTTPException as e:
+        if e.status_code != status.HTTP_404_NOT_FOUND:
+            raise
+    # First requests for this variant share a single generation
+    rendered = _rendering.get(key)
+    background = None
+    if rendered is None:
+        rendered = asyncio.get_running_loop().create_future()
+        _rendering[key] = rendered
+        task = asyncio.create_task(_generate(bucket, filename, variant, key, rendered))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+        # The request that started it finishes once the variant is stored
+        background = BackgroundTask(asyncio.wait, {task})
+    data = await asyncio.shield(rendered)
+    return Response(
+        data,
+        media_type=IMAGE_FORMATS[variant.format],
+        background=background,
+        headers={
+            # The ETag S3 gives the stored variant, later hits revalidate with it
+            "etag": f'"{hashlib.md5(data).hexdigest()}"',
+            "last-modified": formatdate(usegmt=True),
+            "cache-control": REVALIDATE,
+        },
+    )
+
+
+async def _generate(
+    bucket: S3Bucket,
+    filename: str,
+    variant: Variant,
+    key: str,
+    rendered: "asyncio.Future[bytes]",
+) -> None:
+    try:
+        try:
+            data = await _render_original(bucket, filename, variant)
+        except Exception as e:
+            rendered.set_exception(e)
+            return
+        rendered.set_result(data)
+        # Kept in flight until stored, later requests then find it in S3
+        await store_variant(bucket, key, data, IMAGE_FORMATS[variant.format])
+    finally:
+        if not rendered.done():
+            rendered.cancel()
+        del _rendering[key]
+
+
+async def _render_original(bucket: S3Bucket, filename: str, variant: Variant) -> bytes:
+    with s3_errors("get_object"):
+        data = await run_io(read_source, bucket, f"images/{filename}")
+    loop = asyncio.get_running_loop()
+    try:
+        with timed("image_resize"):
+            return await loop.run_in_executor(image_executor, render, data, variant)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY, "Not a resizable image"
+        ) from e
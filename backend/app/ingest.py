@@ -0,0 +1,285 @@
+import base64
+import binascii
+import os
+from collections import deque
+from collections.abc import AsyncIterator, Callable
+from enum import Enum, auto
+from typing import NamedTuple
+
+import anyio
+from anyio.abc import TaskGroup
+from botocore.exceptions import BotoCoreError, ClientError
+from fastapi import HTTPException, Request, status
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+
+from app.concurrency import run_io
+from app.messages import FileResult, MessageStatus
+from app.metrics import S3_ERRORS, error_code
+from app.s3 import MIN_PART_SIZE, MultipartUpload
+
+UPLOAD_PART_SIZE = max(
+    int(os.environ.get("UPLOAD_PART_SIZE", str(8 * 1024 * 1024))), MIN_PART_SIZE
+)
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+BULK_UPLOAD_CONCURRENCY = int(os.environ.get("BULK_UPLOAD_CONCURRENCY", "8"))
+
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            },
+            DEFAULT_CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+        },
+    }
+}
+BULK_UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {
+                        "file": {
+                            "type": "array",
+                            "items": {"type": "string", "format": "binary"},
+                        }
+                    },
+                    "required": ["file"],
+                }
+            },
+        },
+    }
+}
+
+
+def valid_filename(filename: str) -> bool:
+    # A single path segment, like the filename of a PUT, never another folder
+    return bool(filename) and filename not in (".", "..") and "/" not in filename
+
+
+class Part(NamedTuple):
+    name: str
+    filename: str | None
+    content_type: str | None
+
+
+class UploadSource(NamedTuple):
+    content_type: str | None
+    chunks: AsyncIterator[bytes]
+    md5: str | None = None
+
+
+def parse_content_md5(value: str | None) -> str | None:
+    if not value:
+        return None
+    try:
+        digest = base64.b64decode(value, validate=True)
+    except binascii.Error:
+        digest = b""
+    if len(digest) != 16:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid Content-MD5")
+    return digest.hex()
+
+
+class _Event(Enum):
+    PART_END = auto()
+
+
+class MultipartReader:
+    def __init__(self, stream: AsyncIterator[bytes], boundary: bytes):
+        self._stream = stream
+        self._events: deque[Part | bytes | _Event] = deque()
+        self._headers: list[tuple[bytes, bytes]] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._finished = False
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+            },
+        )
+
+    async def next_part(self) -> Part | None:
+        while (event := await self._next_event()) is not None:
+            if isinstance(event, Part):
+                return event
+        return None
+
+    async def read_part(self) -> AsyncIterator[bytes]:
+        while isinstance(event := await self._next_event(), bytes):
+            yield event
+        if event is None:
+            raise HTTPException(status.HTTP_400_BAD_REQUEST, "Truncated multipart body")
+
+    async def _next_event(self) -> Part | bytes | _Event | None:
+        while not self._events and not self._finished:
+            chunk = await anext(self._stream, None)
+            try:
+                if chunk is None:
+                    self._parser.finalize()
+                    self._finished = True
+                else:
+                    self._parser.write(chunk)
+            except MultipartParseError as e:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e)) from e
+        return self._events.popleft() if self._events else None
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        self._events.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        self._events.append(_Event.PART_END)
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers.append((self._header_field.lower(), self._header_value))
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        headers = dict(self._headers)
+        self._headers = []
+        _, options = parse_options_header(headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        content_type = headers.get(b"content-type")
+        self._events.append(
+            Part(
+                name=options.get(b"name", b"").decode(),
+                filename=filename.decode() if filename is not None else None,
+                content_type=content_type.decode() if content_type else None,
+            )
+        )
+
+
+def multipart_reader(request: Request) -> MultipartReader | None:
+    content_type, options = parse_options_header(
+        request.headers.get("content-type", "")
+    )
+    if content_type != b"multipart/form-data":
+        return None
+    if b"boundary" not in options:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Missing multipart boundary")
+    return MultipartReader(request.stream(), options[b"boundary"])
+
+
+async def open_upload(request: Request, field: str = "file") -> UploadSource:
+    reader = multipart_reader(request)
+    if reader is None:
+        content_type = request.headers.get("content-type", DEFAULT_CONTENT_TYPE)
+        # Part headers cannot carry one, the parser only accepts letters in names
+        md5 = parse_content_md5(request.headers.get("content-md5"))
+        return UploadSource(content_type, request.stream(), md5)
+    while part := await reader.next_part():
+        if part.name == field:
+            return UploadSource(part.content_type, reader.read_part())
+    raise HTTPException(
+        status.HTTP_422_UNPROCESSABLE_ENTITY, f"Missing multipart field: {field}"
+    )
+
+
+async def upload_parts(chunks: AsyncIterator[bytes], upload: MultipartUpload) -> bytes:
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= UPLOAD_PART_SIZE:
+            await run_io(upload.upload_part, bytes(buffer))
+            buffer.clear()
+    return bytes(buffer)
+
+
+async def abort_upload(upload: MultipartUpload, error: BaseException) -> None:
+    if isinstance(error, BotoCoreError | ClientError):
+        S3_ERRORS.labels("upload", error_code(error)).inc()
+    with anyio.CancelScope(shield=True):
+        await run_io(upload.abort)
+
+
+async def stream_upload(chunks: AsyncIterator[bytes], upload: MultipartUpload) -> None:
+    try:
+        await run_io(upload.complete, await upload_parts(chunks, upload))
+    except BaseException as e:
+        await abort_upload(upload, e)
+        raise
+
+
+async def bulk_upload(
+    reader: MultipartReader,
+    make_upload: Callable[[Part], MultipartUpload],
+    field: str = "file",
+) -> list[FileResult]:
+    results: list[FileResult] = []
+    slots = anyio.Semaphore(BULK_UPLOAD_CONCURRENCY)
+
+    def failed(index: int, status: MessageStatus, error: BaseException) -> None:
+        results[index] = FileResult(
+            filename=results[index].filename, status=status, message=str(error)
+        )
+
+    async def complete(index: int, upload: MultipartUpload, tail: bytes) -> None:
+        try:
+            await run_io(upload.complete, tail)
+        except BaseException as e:
+            await abort_upload(upload, e)
+            if not isinstance(e, Exception):
+                raise
+            failed(index, MessageStatus.ERROR, e)
+        finally:
+            slots.release()
+
+    async def read_part(tg: TaskGroup, part: Part) -> None:
+        index = len(results)
+        filename = part.filename or ""
+        results.append(FileResult(filename=filename, status=MessageStatus.SUCCESS))
+        if not part.filename:
+            failed(index, MessageStatus.FAIL, ValueError("Missing filename"))
+            return
+        if not valid_filename(part.filename):
+            failed(index, MessageStatus.FAIL, ValueError("Invalid filename"))
+            return
+        # Parts are read one at a time, only their uploads run concurrently
+        await slots.acquire()
+        upload = make_upload(part)
+        try:
+            tail = await upload_parts(reader.read_part(), upload)
+        except BaseException as e:
+            slots.release()
+            await abort_upload(upload, e)
+            if not isinstance(e, BotoCoreError | ClientError):
+                raise
+            # The rest of the part is skipped by the next call to next_part
+            failed(index, MessageStatus.ERROR, e)
+            return
+        tg.start_soon(complete, index, upload, tail)
+
+    error: BaseException | None = None
+    async with anyio.create_task_group() as tg:
+        try:
+            while part := await reader.next_part():
+                if part.name == field:
+                    await read_part(tg, part)
+        except BaseException as e:
+            # Re-raised below as is, rather than wrapped in an exception group
+            error = e
+            tg.cancel_scope.cancel()
+    if error:
+        raise error
+    return results
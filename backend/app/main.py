@@ -1,29 +1,114 @@
-from collections.abc import Awaitable, Callable
+import math
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
 from functools import partial
 from typing import Annotated
 
-from fastapi import Depends, FastAPI, HTTPException, Path, UploadFile, status
-from starlette.responses import StreamingResponse
+from fastapi import (
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    status,
+)
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.requests import ClientDisconnect
+from starlette.responses import JSONResponse, Response
 
+from app.admission import AdmissionMiddleware
+from app.bundles import BundleRequest, bundle_response
+from app.concurrency import run_io
 from app.dependencies import provide_make_bucket, provide_make_form_validator
-from app.flow_config import get_config, refresh
+from app.disk_cache import survey_cache
+from app.downloads import (
+    IMMUTABLE,
+    REVALIDATE,
+    file_response,
+    head_response,
+    object_response,
+    redirect_response,
+    redirects,
+)
+from app.flow_config import get_config
 from app.form_validator import FormValidator
-from app.messages import ResultMessage
-from app.s3 import S3Bucket
+from app.images import parse_variant, variant_response
+from app.ingest import (
+    BULK_UPLOAD_REQUEST_BODY,
+    UPLOAD_REQUEST_BODY,
+    Part,
+    bulk_upload,
+    multipart_reader,
+    open_upload,
+    parse_content_md5,
+    stream_upload,
+)
+from app.messages import (
+    BulkResultMessage,
+    MessageStatus,
+    ResultMessage,
+    UploadedPart,
+    UploadSession,
+)
+from app.metrics import MetricsMiddleware, render, timed
+from app.refresh import RefreshStatus, refresh_job
+from app.resilience import CircuitOpenError
+from app.s3 import MIN_PART_SIZE, ChecksumMismatchError, MultipartUpload, S3Bucket
+from app.sessions import (
+    MAX_PARTS,
+    SESSION_CONTENT_TYPE,
+    UPLOAD_CHUNK_MAX_SIZE,
+    completed_parts,
+    read_chunk,
+    session_errors,
+    sweep_stale_uploads,
+    uploaded_parts,
+)
+from app.warmup import WarmUpStatus, warm_up
 
 FormIdParam = Annotated[str, Path(pattern=r"^\d+$")]
 VersionedFormIdParam = Annotated[str, Path(pattern=r"^\d+(v\d+.0)?$")]
-app = FastAPI()
+PartNumberParam = Annotated[int, Path(ge=1, le=MAX_PARTS)]
+SESSIONS_PATH = "/{instance}/devicezip/{form_id}/{filename}/uploads"
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # Requests are served meanwhile, /ready tells when the first ones are fast
+    warm_up.start()
+    yield
 
 
-def validate_form_id(form_id: int, validator: FormValidator) -> None:
-    form_exists = validator.validate(form_id)
+app = FastAPI(lifespan=lifespan)
+# Metrics wrap admission, so rejected and queued requests are measured too
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open(_: Request, e: CircuitOpenError) -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Storage backend unavailable"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
+
+
+async def validate_form_id(form_id: int, validator: FormValidator) -> None:
+    try:
+        with timed("form_validation"):
+            form_exists = await run_io(validator.validate, form_id)
+    except TimeoutError as e:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT) from e
     if not form_id or not form_exists:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
 
 def get_config_for(instance: str) -> dict[str, str]:
-    config = get_config(instance)
+    with timed("config_lookup"):
+        config = get_config(instance)
     if not config:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
 
@@ -34,20 +119,31 @@ async def upload(
     instance: str,
     form_id: str,
     filename: str,
-    file: UploadFile,
+    request: Request,
     folder: str,
     make_bucket: Callable[[dict[str, str]], S3Bucket],
     make_form_validator: Callable[[dict[str, str]], FormValidator],
 ) -> ResultMessage:
     config = get_config_for(instance)
     form_validator = make_form_validator(config)
-    validate_form_id(int(form_id), form_validator)
-    bucket = make_bucket(config)
-    extra_args = {"ContentType": file.content_type}
-    if folder == "images":
-        extra_args["ACL"] = "public-read"
-    file_key = f"{folder}/{str(filename)}"
-    bucket.upload(file.file, file_key, extra_args)
+    await validate_form_id(int(form_id), form_validator)
+    bucket = await run_io(make_bucket, config)
+    try:
+        source = await open_upload(request)
+        extra_args = {"ContentType": source.content_type}
+        if folder == "images":
+            extra_args["ACL"] = "public-read"
+        file_key = f"{folder}/{str(filename)}"
+        # Retries of uploads that already succeeded are answered without the body
+        if source.md5 and await run_io(bucket.stored_md5, file_key) == source.md5:
+            return ResultMessage.success("Unchanged")
+        multipart_upload = bucket.multipart_upload(file_key, extra_args, source.md5)
+        with timed("s3_upload"):
+            await stream_upload(source.chunks, multipart_upload)
+    except ClientDisconnect as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST) from e
+    except ChecksumMismatchError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, str(e)) from e
     return ResultMessage.success("OK!")
 
 
@@ -58,100 +154,333 @@ def provide_upload(
     make_form_validator: Annotated[
         Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
     ],
-) -> Callable[[str, str, str, UploadFile, str], Awaitable[ResultMessage]]:
+) -> Callable[[str, str, str, Request, str], Awaitable[ResultMessage]]:
     return partial(
         upload, make_bucket=make_bucket, make_form_validator=make_form_validator
     )
 
 
 @app.put(
-    "/{instance}/devicezip/{form_id}/{filename}", status_code=status.HTTP_201_CREATED
+    "/{instance}/devicezip/{form_id}/{filename}",
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra=UPLOAD_REQUEST_BODY,
 )
 async def put_devicezip(
     instance: str,
     form_id: FormIdParam,
     filename: str,
-    file: UploadFile,
+    request: Request,
     upload: Annotated[
-        Callable[[str, str, str, UploadFile, str], Awaitable[ResultMessage]],
+        Callable[[str, str, str, Request, str], Awaitable[ResultMessage]],
         Depends(provide_upload),
     ],
 ) -> ResultMessage:
-    return await upload(instance, form_id, filename, file, "devicezip")
+    return await upload(instance, form_id, filename, request, "devicezip")
 
 
-@app.put("/{instance}/images/{form_id}/{filename}", status_code=status.HTTP_201_CREATED)
+@app.put(
+    "/{instance}/images/{form_id}/{filename}",
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra=UPLOAD_REQUEST_BODY,
+)
 async def put_images(
     instance: str,
     form_id: FormIdParam,
     filename: str,
-    file: UploadFile,
+    request: Request,
     upload: Annotated[
-        Callable[[str, str, str, UploadFile, str], Awaitable[ResultMessage]],
+        Callable[[str, str, str, Request, str], Awaitable[ResultMessage]],
         Depends(provide_upload),
     ],
 ) -> ResultMessage:
-    return await upload(instance, form_id, filename, file, "images")
+    return await upload(instance, form_id, filename, request, "images")
+
+
+@app.post(
+    "/{instance}/images/{form_id}",
+    status_code=status.HTTP_201_CREATED,
+    responses={status.HTTP_207_MULTI_STATUS: {"model": BulkResultMessage}},
+    openapi_extra=BULK_UPLOAD_REQUEST_BODY,
+)
+async def post_images(
+    instance: str,
+    form_id: FormIdParam,
+    request: Request,
+    response: Response,
+    make_bucket: Annotated[
+        Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
+    ],
+    make_form_validator: Annotated[
+        Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
+    ],
+) -> BulkResultMessage:
+    config = get_config_for(instance)
+    await validate_form_id(int(form_id), make_form_validator(config))
+    bucket = await run_io(make_bucket, config)
+    reader = multipart_reader(request)
+    if reader is None:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def make_upload(part: Part) -> MultipartUpload:
+        extra_args = {"ContentType": part.content_type, "ACL": "public-read"}
+        return bucket.multipart_upload(f"images/{part.filename}", extra_args)
+
+    try:
+        with timed("s3_upload"):
+            files = await bulk_upload(reader, make_upload)
+    except ClientDisconnect as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST) from e
+    if not files:
+        raise HTTPException(
+            status.HTTP_422_UNPROCESSABLE_ENTITY, "Missing multipart field: file"
+        )
+    failed = sum(f.status != MessageStatus.SUCCESS for f in files)
+    if failed:
+        response.status_code = status.HTTP_207_MULTI_STATUS
+        return BulkResultMessage(
+            status=MessageStatus.FAIL,
+            message=f"{failed} of {len(files)} files failed",
+            files=files,
+        )
+    return BulkResultMessage(status=MessageStatus.SUCCESS, message="OK!", files=files)
+
+
+async def provide_session_bucket(
+    instance: str,
+    form_id: FormIdParam,
+    make_bucket: Annotated[
+        Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
+    ],
+    make_form_validator: Annotated[
+        Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
+    ],
+) -> S3Bucket:
+    config = get_config_for(instance)
+    await validate_form_id(int(form_id), make_form_validator(config))
+    return await run_io(make_bucket, config)
+
+
+SessionBucket = Annotated[S3Bucket, Depends(provide_session_bucket)]
+
+
+@app.post(SESSIONS_PATH, status_code=status.HTTP_201_CREATED)
+async def open_upload_session(
+    filename: str, bucket: SessionBucket, background_tasks: BackgroundTasks
+) -> UploadSession:
+    extra_args = {"ContentType": SESSION_CONTENT_TYPE}
+    with session_errors("create_upload"):
+        upload_id = await run_io(
+            bucket.create_upload, f"devicezip/{filename}", extra_args
+        )
+    # Sessions live in S3 as multipart uploads, abandoned ones are swept here
+    background_tasks.add_task(run_io, sweep_stale_uploads, bucket)
+    return UploadSession(
+        status=MessageStatus.SUCCESS,
+        message="OK!",
+        upload_id=upload_id,
+        min_chunk_size=MIN_PART_SIZE,
+        max_chunk_size=UPLOAD_CHUNK_MAX_SIZE,
+    )
+
+
+@app.get(f"{SESSIONS_PATH}/{{upload_id}}")
+async def get_upload_session(
+    filename: str, upload_id: str, bucket: SessionBucket
+) -> UploadSession:
+    with session_errors("list_parts"):
+        parts = await run_io(bucket.list_parts, f"devicezip/{filename}", upload_id)
+    return UploadSession(
+        status=MessageStatus.SUCCESS,
+        message="OK!",
+        upload_id=upload_id,
+        parts=uploaded_parts(parts),
+        min_chunk_size=MIN_PART_SIZE,
+        max_chunk_size=UPLOAD_CHUNK_MAX_SIZE,
+    )
+
+
+@app.put(f"{SESSIONS_PATH}/{{upload_id}}/{{part_number}}")
+async def put_upload_part(
+    filename: str,
+    upload_id: str,
+    part_number: PartNumberParam,
+    request: Request,
+    bucket: SessionBucket,
+) -> UploadedPart:
+    md5 = parse_content_md5(request.headers.get("content-md5"))
+    try:
+        data = await read_chunk(request.stream(), request.headers.get("content-length"))
+    except ClientDisconnect as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST) from e
+    key = f"devicezip/{filename}"
+    with timed("s3_upload"), session_errors("upload_part"):
+        etag = await run_io(bucket.upload_part, key, upload_id, part_number, data, md5)
+    return UploadedPart(part_number=part_number, size=len(data), etag=etag)
+
+
+@app.post(
+    f"{SESSIONS_PATH}/{{upload_id}}/complete", status_code=status.HTTP_201_CREATED
+)
+async def complete_upload_session(
+    filename: str,
+    upload_id: str,
+    bucket: SessionBucket,
+    parts: Annotated[int | None, Query(ge=1, le=MAX_PARTS)] = None,
+) -> ResultMessage:
+    key = f"devicezip/{filename}"
+    with session_errors("list_parts"):
+        stored = await run_io(bucket.list_parts, key, upload_id)
+    completed = completed_parts(stored, parts)
+    with session_errors("complete_upload"):
+        await run_io(bucket.complete_upload, key, upload_id, completed)
+    return ResultMessage.success("OK!")
+
+
+@app.delete(f"{SESSIONS_PATH}/{{upload_id}}")
+async def abort_upload_session(
+    filename: str, upload_id: str, bucket: SessionBucket
+) -> ResultMessage:
+    with session_errors("abort_upload"):
+        await run_io(bucket.abort_upload, f"devicezip/{filename}", upload_id)
+    return ResultMessage.success("Aborted")
 
 
 @app.get("/{instance}/surveys/{versioned_form_id}.zip")
 async def get_survey_form(
     instance: str,
     versioned_form_id: VersionedFormIdParam,
+    request: Request,
     make_bucket: Annotated[
         Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
     ],
     make_form_validator: Annotated[
         Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
     ],
-) -> StreamingResponse:
+) -> Response:
     config = get_config_for(instance)
     form_id = versioned_form_id.split("v")[0]
     form_validator = make_form_validator(config)
-    validate_form_id(int(form_id), form_validator)
-    bucket = make_bucket(config)
+    await validate_form_id(int(form_id), form_validator)
+    bucket = await run_io(make_bucket, config)
+    key = f"surveys/{versioned_form_id}.zip"
+    if redirects(config):
+        return redirect_response(bucket, key)
+    if "v" not in versioned_form_id:
+        return await object_response(bucket, key, request, REVALIDATE)
 
-    try:
-        res = bucket.download(f"surveys/{versioned_form_id}.zip")
-        return StreamingResponse(
-            content=res["Body"].iter_chunks(), media_type=res["ContentType"]
-        )
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND) from e
+    entry = await run_io(survey_cache.get, instance, versioned_form_id)
+    if entry:
+        response = file_response(*entry, request, IMMUTABLE)
+        survey_cache.served(int(response.headers.get("content-length", 0)))
+        return response
+    # A full download is kept in the cache as it streams, not fetched again
+    reserve = partial(survey_cache.reserve, instance, versioned_form_id)
+    return await object_response(bucket, key, request, IMMUTABLE, reserve=reserve)
+
+
+@app.head("/{instance}/surveys/{versioned_form_id}.zip")
+async def head_survey_form(
+    instance: str,
+    versioned_form_id: VersionedFormIdParam,
+    request: Request,
+    make_bucket: Annotated[
+        Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
+    ],
+    make_form_validator: Annotated[
+        Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
+    ],
+) -> Response:
+    config = get_config_for(instance)
+    form_id = versioned_form_id.split("v")[0]
+    await validate_form_id(int(form_id), make_form_validator(config))
+    bucket = await run_io(make_bucket, config)
+    key = f"surveys/{versioned_form_id}.zip"
+    # Answered even when GET redirects, presigned GET urls do not accept HEAD
+    cache_control = IMMUTABLE if "v" in versioned_form_id else REVALIDATE
+    return await head_response(bucket, key, request, cache_control)
 
 
 @app.get("/{instance}/images/{filename}")
 async def get_image(
     instance: str,
     filename: str,
+    request: Request,
     make_bucket: Annotated[
         Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
     ],
-) -> StreamingResponse:
+    w: int | None = None,
+    h: int | None = None,
+    q: int | None = None,
+    image_format: Annotated[str | None, Query(alias="format")] = None,
+) -> Response:
+    variant = parse_variant(w, h, q, image_format)
     config = get_config_for(instance)
-    bucket = make_bucket(config)
+    bucket = await run_io(make_bucket, config)
+    if variant:
+        # Variants are small, they are proxied even when originals redirect
+        return await variant_response(bucket, filename, variant, request)
+    key = f"images/{filename}"
+    if redirects(config):
+        return redirect_response(bucket, key)
+    return await object_response(bucket, key, request)
 
-    try:
-        res = bucket.download(f"images/{filename}")
-        return StreamingResponse(
-            content=res["Body"].iter_chunks(), media_type=res["ContentType"]
-        )
-    except Exception as e:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND) from e
 
+@app.post("/{instance}/images.zip")
+async def post_image_bundle(
+    instance: str,
+    bundle: BundleRequest,
+    make_bucket: Annotated[
+        Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
+    ],
+    make_form_validator: Annotated[
+        Callable[[dict[str, str]], FormValidator], Depends(provide_make_form_validator)
+    ],
+) -> Response:
+    config = get_config_for(instance)
+    name = "images.zip"
+    if bundle.form_id is not None:
+        await validate_form_id(bundle.form_id, make_form_validator(config))
+        name = f"{bundle.form_id}-images.zip"
+    bucket = await run_io(make_bucket, config)
+    return bundle_response(bucket, bundle.filenames, name)
 
-@app.get("/refresh", include_in_schema=False)
-async def refresh_config() -> ResultMessage:
-    refresh()
-    return ResultMessage.success("OK!")
+
+@app.head("/{instance}/images/{filename}")
+async def head_image(
+    instance: str,
+    filename: str,
+    request: Request,
+    make_bucket: Annotated[
+        Callable[[dict[str, str]], S3Bucket], Depends(provide_make_bucket)
+    ],
+) -> Response:
+    config = get_config_for(instance)
+    bucket = await run_io(make_bucket, config)
+    return await head_response(bucket, f"images/{filename}", request)
 
 
-@app.post("/refresh", include_in_schema=False)
-async def post_refresh_config() -> ResultMessage:
-    refresh()
-    return ResultMessage.success("OK!")
+@app.get("/refresh", status_code=status.HTTP_202_ACCEPTED, include_in_schema=False)
+async def refresh_config() -> RefreshStatus:
+    return refresh_job.trigger()
+
+
+@app.post("/refresh", status_code=status.HTTP_202_ACCEPTED, include_in_schema=False)
+async def post_refresh_config() -> RefreshStatus:
+    return refresh_job.trigger()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    return Response(await run_io(render), media_type=CONTENT_TYPE_LATEST)
 
 
 @app.get("/healtz", include_in_schema=False)
 async def healt_check() -> ResultMessage:
     return ResultMessage.success("OK!")
+
+
+@app.get("/ready", include_in_schema=False)
+async def ready_check(response: Response) -> WarmUpStatus:
+    if not warm_up.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return warm_up.status()
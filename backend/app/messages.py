@@ -1,7 +1,7 @@
 from enum import StrEnum, auto
 from typing import Self
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 class MessageStatus(StrEnum):
@@ -25,3 +25,27 @@ class ResultMessage(BaseModel):
     @classmethod
     def error(cls, message: str) -> Self:
         return cls(status=MessageStatus.ERROR, message=message)
+
+
+class FileResult(ResultMessage):
+    filename: str
+
+
+class BulkResultMessage(ResultMessage):
+    files: list[FileResult]
+
+
+class UploadedPart(BaseModel):
+    part_number: int
+    size: int
+    etag: str
+
+
+class UploadSession(ResultMessage):
+    upload_id: str
+    parts: list[UploadedPart] = []
+    min_chunk_size: int = Field(
+        description="Bytes every chunk but the last must have, "
+        "smaller ones fail the whole upload at /complete"
+    )
+    max_chunk_size: int = Field(description="Bytes a chunk may have at most")
@@ -0,0 +1,173 @@
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.flow_config import get_config
+
+PREFIX = "flow_s3_proxy"
+
+REQUEST_DURATION = Histogram(
+    f"{PREFIX}_request_duration_seconds",
+    "Time from receiving a request until its response body is sent",
+    ["method", "route", "status"],
+)
+PHASE_DURATION = Histogram(
+    f"{PREFIX}_phase_duration_seconds",
+    "Time spent in each phase of handling a request",
+    ["phase"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    f"{PREFIX}_requests_in_flight",
+    "Requests currently being handled",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+RECEIVED_BYTES = Counter(
+    f"{PREFIX}_received_bytes",
+    "Request body bytes received per instance",
+    ["instance"],
+)
+SENT_BYTES = Counter(
+    f"{PREFIX}_sent_bytes",
+    "Response body bytes sent per instance",
+    ["instance"],
+)
+S3_ERRORS = Counter(f"{PREFIX}_s3_errors", "Failed S3 calls", ["operation", "code"])
+DATASTORE_ERRORS = Counter(f"{PREFIX}_datastore_errors", "Failed Datastore lookups")
+FORM_CACHE_LOOKUPS = Counter(
+    f"{PREFIX}_form_cache_lookups",
+    "Form existence checks per credential file, by whether the cache answered",
+    ["credentials", "result"],
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    f"{PREFIX}_admission_queue_depth",
+    "Requests waiting for an S3 slot per instance",
+    ["instance"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_WAIT = Histogram(
+    f"{PREFIX}_admission_wait_seconds",
+    "Time requests waited for an S3 slot per instance",
+    ["instance"],
+)
+ADMISSION_REJECTED = Counter(
+    f"{PREFIX}_admission_rejected",
+    "Requests rejected because the instance queue was full",
+    ["instance"],
+)
+SURVEY_CACHE_LOOKUPS = Counter(
+    f"{PREFIX}_survey_cache_lookups",
+    "Versioned survey downloads, by whether the disk cache had them",
+    ["result"],
+)
+SURVEY_CACHE_SERVED = Counter(
+    f"{PREFIX}_survey_cache_served_bytes", "Survey bytes served from the disk cache"
+)
+SURVEY_CACHE_EVICTIONS = Counter(
+    f"{PREFIX}_survey_cache_evictions", "Surveys evicted from the disk cache"
+)
+HEDGED_REQUESTS = Counter(
+    f"{PREFIX}_hedged_requests",
+    "Reads that raced a second attempt, by the attempt that answered first",
+    ["operation", "winner"],
+)
+CIRCUIT_REJECTED = Counter(
+    f"{PREFIX}_circuit_rejected",
+    "Calls failed fast while their backend circuit was open",
+    ["backend"],
+)
+STARTUP_DURATION = Gauge(
+    f"{PREFIX}_startup_duration_seconds",
+    "Time each worker spent in a start up phase",
+    ["phase"],
+    multiprocess_mode="livemax",
+)
+REFRESH_DURATION = Histogram(
+    f"{PREFIX}_refresh_duration_seconds", "Time spent refreshing the flow config"
+)
+
+
+@contextmanager
+def timed(phase: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_DURATION.labels(phase).observe(time.perf_counter() - start)
+
+
+def error_code(error: BaseException) -> str:
+    if isinstance(error, ClientError):
+        return str(error.response.get("Error", {}).get("Code", "Unknown"))
+    return type(error).__name__
+
+
+def render() -> bytes:
+    registry = REGISTRY
+    # Each uvicorn worker writes its samples to this directory
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+    return generate_latest(registry)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        stream_start = start
+        status_code = 500
+        received = sent = 0
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            nonlocal status_code, sent, stream_start
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                stream_start = time.perf_counter()
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            else:
+                sent += message.get("count", 0)
+            await send(message)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(scope["method"])
+        in_flight.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            in_flight.dec()
+            end = time.perf_counter()
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                scope["method"], route.path if route else "unmatched", status_code
+            ).observe(end - start)
+            PHASE_DURATION.labels("stream").observe(end - stream_start)
+            instance = scope.get("path_params", {}).get("instance")
+            # Unknown instances would let clients create arbitrary series
+            if instance and get_config(instance):
+                RECEIVED_BYTES.labels(instance).inc(received)
+                SENT_BYTES.labels(instance).inc(sent)
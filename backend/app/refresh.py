@@ -0,0 +1,95 @@
+import logging
+import os
+import threading
+from collections.abc import Callable
+from datetime import UTC, datetime
+from enum import StrEnum, auto
+
+from app.flow_config import refresh
+from app.messages import MessageStatus, ResultMessage
+from app.metrics import REFRESH_DURATION
+
+REFRESH_DEBOUNCE = float(os.environ.get("REFRESH_DEBOUNCE", "1"))
+
+logger = logging.getLogger(__name__)
+
+
+class JobState(StrEnum):
+    IDLE = auto()
+    SCHEDULED = auto()
+    RUNNING = auto()
+
+
+class RefreshStatus(ResultMessage):
+    state: JobState
+    runs: int = 0
+    last_started: datetime | None = None
+    last_finished: datetime | None = None
+    last_error: str | None = None
+
+
+class RefreshJob:
+    def __init__(self, refresh: Callable[[], None], debounce: float):
+        self._refresh = refresh
+        self._debounce = debounce
+        self._lock = threading.Lock()
+        self._state = JobState.IDLE
+        self._rerun = False
+        self._runs = 0
+        self._last_started: datetime | None = None
+        self._last_finished: datetime | None = None
+        self._last_error: str | None = None
+
+    def trigger(self) -> RefreshStatus:
+        with self._lock:
+            if self._state == JobState.IDLE:
+                self._schedule()
+            elif self._state == JobState.RUNNING:
+                # The running pull may have missed the change being announced
+                self._rerun = True
+            return self._status()
+
+    def status(self) -> RefreshStatus:
+        with self._lock:
+            return self._status()
+
+    def _schedule(self) -> None:
+        self._state = JobState.SCHEDULED
+        timer = threading.Timer(self._debounce, self._run)
+        timer.daemon = True
+        timer.start()
+
+    def _run(self) -> None:
+        with self._lock:
+            self._state = JobState.RUNNING
+            self._rerun = False
+            self._last_started = datetime.now(UTC)
+        error = None
+        try:
+            with REFRESH_DURATION.time():
+                self._refresh()
+        except Exception as e:
+            logger.exception("Config refresh failed")
+            error = str(e)
+        with self._lock:
+            self._runs += 1
+            self._last_finished = datetime.now(UTC)
+            self._last_error = error
+            if self._rerun:
+                self._schedule()
+            else:
+                self._state = JobState.IDLE
+
+    def _status(self) -> RefreshStatus:
+        return RefreshStatus(
+            status=MessageStatus.SUCCESS,
+            message=f"Refresh {self._state}",
+            state=self._state,
+            runs=self._runs,
+            last_started=self._last_started,
+            last_finished=self._last_finished,
+            last_error=self._last_error,
+        )
+
+
+refresh_job = RefreshJob(refresh, REFRESH_DEBOUNCE)
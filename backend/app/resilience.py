@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TypeVar
+
+from app.metrics import CIRCUIT_REJECTED, HEDGED_REQUESTS
+
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "0.05"))
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "2"))
+HEDGE_WINDOW = int(os.environ.get("HEDGE_WINDOW", "500"))
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "50"))
+HEDGE_THREADS = int(os.environ.get("HEDGE_THREADS", "128"))
+S3_GET_DEADLINE = float(os.environ.get("S3_GET_DEADLINE", "20"))
+DATASTORE_GET_DEADLINE = float(os.environ.get("DATASTORE_GET_DEADLINE", "10"))
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", "5"))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "30"))
+
+T = TypeVar("T")
+
+# Callers wait on io threads, attempts need threads of their own
+hedge_executor = ThreadPoolExecutor(
+    max_workers=HEDGE_THREADS, thread_name_prefix="hedge"
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"{name} is failing, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failures: int = CIRCUIT_FAILURES,
+        cooldown: float = CIRCUIT_COOLDOWN,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self._failures = failures
+        self._cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    def acquire(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_after = self._opened_at + self._cooldown - self._clock()
+            if retry_after <= 0 and not self._probing:
+                # Half open, a single call finds out whether the backend is back
+                self._probing = True
+                return
+        CIRCUIT_REJECTED.labels(self.name.split(":")[0]).inc()
+        raise CircuitOpenError(self.name, max(retry_after, 1))
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self._consecutive = 0
+                self._opened_at = None
+            else:
+                self._consecutive += 1
+                if self._probing or self._consecutive >= self._failures:
+                    self._opened_at = self._clock()
+            self._probing = False
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(name: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+        return _breakers[name]
+
+
+def clear_breakers() -> None:
+    with _breakers_lock:
+        _breakers.clear()
+
+
+class Hedge:
+    def __init__(self, operation: str, deadline: float):
+        self.operation = operation
+        self.deadline = deadline
+        self._lock = threading.Lock()
+        self._samples: deque[float] = deque(maxlen=HEDGE_WINDOW)
+
+    def delay(self) -> float:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return HEDGE_MAX_DELAY
+            ordered = sorted(self._samples)
+        percentile = ordered[int(HEDGE_PERCENTILE * (len(ordered) - 1))]
+        return min(max(percentile, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._samples.clear()
+
+    def call(
+        self, func: Callable[[], T], discard: Callable[[T], None] | None = None
+    ) -> T:
+        start = time.perf_counter()
+        attempts = [hedge_executor.submit(self._timed, func)]
+        done, _ = wait(attempts, timeout=self.delay())
+        if not done:
+            # The first attempt is slower than most, a second one races it
+            attempts.append(hedge_executor.submit(self._timed, func))
+        pending = set(attempts)
+        error: BaseException | None = None
+        while pending:
+            remaining = start + self.deadline - time.perf_counter()
+            done, pending = wait(pending, remaining, return_when=FIRST_COMPLETED)
+            if not done:
+                self._abandon(pending, discard)
+                raise TimeoutError(f"{self.operation} took over {self.deadline}s")
+            for future in done:
+                if future.exception() is None:
+                    self._abandon(pending, discard)
+                    if len(attempts) > 1:
+                        winner = "primary" if future is attempts[0] else "hedge"
+                        HEDGED_REQUESTS.labels(self.operation, winner).inc()
+                    return future.result()
+                error = error or future.exception()
+        assert error is not None
+        raise error
+
+    def _timed(self, func: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        result = func()
+        self.observe(time.perf_counter() - start)
+        return result
+
+    def _abandon(
+        self, attempts: set[Future[T]], discard: Callable[[T], None] | None
+    ) -> None:
+        for attempt in attempts:
+            if attempt.cancel() or discard is None:
+                continue
+            # Already running, whatever it returns late is released
+            attempt.add_done_callback(
+                lambda f: discard(f.result()) if f.exception() is None else None
+            )
+
+
+s3_get = Hedge("get_object", S3_GET_DEADLINE)
+s3_head = Hedge("head_object", S3_GET_DEADLINE)
+datastore_get = Hedge("datastore_get", DATASTORE_GET_DEADLINE)
+
+
+def guarded(
+    name: str,
+    hedge: Hedge,
+    func: Callable[[], T],
+    *,
+    discard: Callable[[T], None] | None = None,
+    is_failure: Callable[[Exception], bool] = lambda _: True,
+) -> T:
+    circuit = breaker(name)
+    circuit.acquire()
+    try:
+        result = hedge.call(func, discard)
+    except Exception as e:
+        circuit.record(not is_failure(e))
+        raise
+    circuit.record(True)
+    return result
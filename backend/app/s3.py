@@ -1,21 +1,432 @@
-from typing import Any, BinaryIO
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import TYPE_CHECKING, Any, BinaryIO, NamedTuple
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
+from app.cache import TTLCache
+from app.resilience import guarded, s3_get, s3_head
 
-class S3Bucket:
-    def __init__(self, bucket: str, access_key_id: str, secret_access_key: str):
+if TYPE_CHECKING:
+    from mypy_boto3_s3 import S3Client
+    from mypy_boto3_s3.type_defs import (
+        CompletedPartTypeDef,
+        GetObjectOutputTypeDef,
+        PartTypeDef,
+    )
+
+S3_CLIENT_CACHE_SIZE = int(os.environ.get("S3_CLIENT_CACHE_SIZE", "128"))
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "50"))
+PRESIGNED_URL_EXPIRES = int(os.environ.get("PRESIGNED_URL_EXPIRES", "900"))
+PRESIGNED_URL_MARGIN = 60
+PRESIGNED_URL_CACHE_SIZE = int(os.environ.get("PRESIGNED_URL_CACHE_SIZE", "10000"))
+OBJECT_METADATA_CACHE_SIZE = int(os.environ.get("OBJECT_METADATA_CACHE_SIZE", "10000"))
+OBJECT_METADATA_TTL = float(os.environ.get("OBJECT_METADATA_TTL", "60"))
+S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL") or None
+S3_CONNECT_TIMEOUT = float(os.environ.get("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.environ.get("S3_READ_TIMEOUT", "30"))
+S3_MAX_ATTEMPTS = int(os.environ.get("S3_MAX_ATTEMPTS", "3"))
+S3_DEFAULT_REGION = "us-east-1"
+BUCKET_REGION_LOOKUP = os.environ.get("BUCKET_REGION_LOOKUP", "true").lower() == "true"
+# S3 rejects multipart uploads with non-final parts smaller than 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Buckets created before regions had names report their legacy location
+_LEGACY_LOCATIONS = {"EU": "eu-west-1"}
+
+_ClientKey = tuple[str, str, str | None]
+
+# boto3's default session is not thread safe, every client is built under this
+_session_lock = threading.Lock()
+
+
+def _new_client(**params: Any) -> "S3Client":
+    with _session_lock:
+        return boto3.client("s3", **params)
+
+
+class _ClientRegistry:
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._clients: OrderedDict[_ClientKey, tuple[str, S3Client]] = OrderedDict()
+        self._regions: dict[str, str | None] = {}
+        self._lookups: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        bucket: str,
+        access_key_id: str,
+        secret_access_key: str,
+        region: str | None,
+    ) -> "S3Client":
+        key = (bucket, access_key_id, region)
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry and entry[0] == secret_access_key:
+                self._clients.move_to_end(key)
+                return entry[1]
+            # Credentials for this bucket were rotated, drop the stale clients
+            for stale in [k for k in self._clients if k[0] == bucket]:
+                del self._clients[stale]
+            client = _new_client(
+                aws_access_key_id=access_key_id,
+                aws_secret_access_key=secret_access_key,
+                region_name=region,
+                endpoint_url=S3_ENDPOINT_URL,
+                config=_client_config(bucket, region),
+            )
+            self._clients[key] = (secret_access_key, client)
+            while len(self._clients) > self._maxsize:
+                self._clients.popitem(last=False)
+            return client
+
+    def region(
+        self, bucket: str, access_key_id: str, secret_access_key: str
+    ) -> str | None:
+        with self._lock:
+            lookup = self._lookups.setdefault(bucket, threading.Lock())
+        # Looked up once per bucket, concurrent first requests wait for it
+        with lookup:
+            with self._lock:
+                if bucket in self._regions:
+                    return self._regions[bucket]
+            try:
+                region = bucket_region(bucket, access_key_id, secret_access_key)
+            except ClientError:
+                # Without permission to look it up clients follow the redirects
+                region = None
+            except BotoCoreError:
+                return None
+            with self._lock:
+                self._regions[bucket] = region
+            return region
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+            self._regions.clear()
+            self._lookups.clear()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+def _client_config(bucket: str, region: str | None) -> Config:
+    # A stuck connection fails within the timeouts instead of holding a request
+    config = Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+    )
+    if region is None:
+        return config
+    # Regional virtual hosts reach the bucket, and its presigned URLs, without
+    # redirects. Dotted names would not match the TLS certificate.
+    path_style = S3_ENDPOINT_URL is not None or "." in bucket
+    return config.merge(
+        Config(
+            signature_version="s3v4",
+            s3={"addressing_style": "path" if path_style else "virtual"},
+        )
+    )
+
+
+def _server_failure(error: Exception) -> bool:
+    # Missing keys and failed conditions are answers, not an unhealthy backend
+    if isinstance(error, ClientError):
+        metadata = error.response.get("ResponseMetadata", {})
+        return metadata.get("HTTPStatusCode", 500) >= 500
+    return True
+
+
+def _close_body(res: "GetObjectOutputTypeDef") -> None:
+    res["Body"].close()
+
+
+_clients = _ClientRegistry(S3_CLIENT_CACHE_SIZE)
+_presigned_urls: TTLCache[tuple[str, str, str], str] = TTLCache(
+    PRESIGNED_URL_CACHE_SIZE, max(PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN, 0)
+)
+
+
+class ObjectMetadata(NamedTuple):
+    size: int
+    etag: str
+    content_type: str
+    last_modified: datetime
+
+
+# Uploads through this worker invalidate their key, other workers' writes
+# show after the TTL. Missing keys are not cached, uploads must show at once.
+_metadata: TTLCache[tuple[str, str], ObjectMetadata] = TTLCache(
+    OBJECT_METADATA_CACHE_SIZE, OBJECT_METADATA_TTL
+)
+
+
+def clear_clients() -> None:
+    _clients.clear()
+    _presigned_urls.clear()
+    _metadata.clear()
+
+
+def bucket_region(bucket: str, access_key_id: str, secret_access_key: str) -> str:
+    client = _new_client(
+        aws_access_key_id=access_key_id,
+        aws_secret_access_key=secret_access_key,
+        region_name=S3_DEFAULT_REGION,
+        endpoint_url=S3_ENDPOINT_URL,
+        config=Config(connect_timeout=5, read_timeout=5, retries={"max_attempts": 2}),
+    )
+    res = client.get_bucket_location(Bucket=bucket)
+    # Buckets in us-east-1 have no location constraint
+    location = res.get("LocationConstraint") or S3_DEFAULT_REGION
+    return _LEGACY_LOCATIONS.get(location, location)
+
+
+def resolve_region(
+    bucket: str, access_key_id: str, secret_access_key: str
+) -> str | None:
+    if not BUCKET_REGION_LOOKUP:
+        return None
+    return _clients.region(bucket, access_key_id, secret_access_key)
+
+
+def load_models() -> None:
+    # The first client parses the S3 service model, later ones reuse it
+    _new_client(
+        region_name=S3_DEFAULT_REGION,
+        aws_access_key_id="warm-up",
+        aws_secret_access_key="warm-up",
+        endpoint_url=S3_ENDPOINT_URL,
+    )
+
+
+def content_md5(digest: bytes) -> str:
+    return base64.b64encode(digest).decode()
+
+
+class ChecksumMismatchError(ValueError):
+    pass
+
+
+class MultipartUpload:
+    def __init__(
+        self,
+        client: "S3Client",
+        bucket: str,
+        key: str,
+        extra: dict[str, Any] | None = None,
+        md5: str | None = None,
+    ):
+        self.client = client
         self.bucket = bucket
-        self.client = boto3.client(
-            "s3",
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=secret_access_key,
+        self.key = key
+        self.extra = extra or {}
+        self.md5 = md5
+        if md5:
+            # Multipart ETags are not digests, keep the client's for later retries
+            self.extra = {**self.extra, "Metadata": {"md5": md5}}
+        self.upload_id: str | None = None
+        self.parts: list[CompletedPartTypeDef] = []
+        self._digest = hashlib.md5()
+
+    def upload_part(self, data: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self.extra
+            )["UploadId"]
+        if self.md5:
+            self._digest.update(data)
+        part_number = len(self.parts) + 1
+        res = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data,
+            ContentMD5=content_md5(hashlib.md5(data).digest()),
         )
+        self.parts.append({"ETag": res["ETag"], "PartNumber": part_number})
+
+    def complete(self, data: bytes = b"") -> None:
+        if self.upload_id is None:
+            # The whole body is a single part, S3 checks it against our digest
+            self._digest.update(data)
+            self._verify()
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=data,
+                ContentMD5=content_md5(self._digest.digest()),
+                **self.extra,
+            )
+        else:
+            if data:
+                self.upload_part(data)
+            self._verify()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        _metadata.pop((self.bucket, self.key))
+
+    def abort(self) -> None:
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+
+    def _verify(self) -> None:
+        if self.md5 and self._digest.hexdigest() != self.md5:
+            raise ChecksumMismatchError("Content-MD5 mismatch")
+
+
+class S3Bucket:
+    def __init__(
+        self,
+        bucket: str,
+        access_key_id: str,
+        secret_access_key: str,
+        region: str | None = None,
+    ):
+        self.bucket = bucket
+        self.access_key_id = access_key_id
+        self.client = _clients.get(bucket, access_key_id, secret_access_key, region)
 
     def upload(
         self, fileobj: BinaryIO, key: str, extra: dict[str, Any] | None = None
     ) -> None:
         self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+        _metadata.pop((self.bucket, key))
+
+    def multipart_upload(
+        self, key: str, extra: dict[str, Any] | None = None, md5: str | None = None
+    ) -> MultipartUpload:
+        return MultipartUpload(self.client, self.bucket, key, extra, md5)
 
-    def download(self, key: str):  # type: ignore
-        return self.client.get_object(Bucket=self.bucket, Key=key)
+    def create_upload(self, key: str, extra: dict[str, Any] | None = None) -> str:
+        return self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=key, **(extra or {})
+        )["UploadId"]
+
+    def upload_part(
+        self,
+        key: str,
+        upload_id: str,
+        part_number: int,
+        data: bytes,
+        md5: str | None = None,
+    ) -> str:
+        # A client digest is checked by S3 itself, against the bytes it received
+        digest = bytes.fromhex(md5) if md5 else hashlib.md5(data).digest()
+        return self.client.upload_part(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+            ContentMD5=content_md5(digest),
+        )["ETag"]
+
+    def list_parts(self, key: str, upload_id: str) -> list["PartTypeDef"]:
+        pages = self.client.get_paginator("list_parts").paginate(
+            Bucket=self.bucket, Key=key, UploadId=upload_id
+        )
+        return [part for page in pages for part in page.get("Parts", [])]
+
+    def complete_upload(
+        self, key: str, upload_id: str, parts: list["CompletedPartTypeDef"]
+    ) -> None:
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+        _metadata.pop((self.bucket, key))
+
+    def abort_upload(self, key: str, upload_id: str) -> None:
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=key, UploadId=upload_id
+        )
+
+    def abort_uploads_before(self, prefix: str, initiated: datetime) -> int:
+        pages = self.client.get_paginator("list_multipart_uploads").paginate(
+            Bucket=self.bucket, Prefix=prefix
+        )
+        stale = [
+            (upload["Key"], upload["UploadId"])
+            for page in pages
+            for upload in page.get("Uploads", [])
+            if upload["Initiated"] < initiated
+        ]
+        for key, upload_id in stale:
+            self.abort_upload(key, upload_id)
+        return len(stale)
+
+    def stored_md5(self, key: str) -> str | None:
+        try:
+            res = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+        if md5 := res.get("Metadata", {}).get("md5"):
+            return md5
+        # Only single part uploads have the MD5 digest as their ETag
+        etag = res["ETag"].strip('"')
+        return None if "-" in etag else etag
+
+    def presigned_url(self, key: str) -> str:
+        cache_key = (self.bucket, self.access_key_id, key)
+        url = _presigned_urls.get(cache_key)
+        if url is None:
+            url = self.client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": self.bucket, "Key": key},
+                ExpiresIn=PRESIGNED_URL_EXPIRES,
+            )
+            _presigned_urls.set(cache_key, url)
+        return url
+
+    def head(self, key: str) -> ObjectMetadata | None:
+        cache_key = (self.bucket, key)
+        if metadata := _metadata.get(cache_key):
+            return metadata
+        try:
+            res = guarded(
+                f"s3:{self.bucket}",
+                s3_head,
+                lambda: self.client.head_object(Bucket=self.bucket, Key=key),
+                is_failure=_server_failure,
+            )
+        except ClientError as e:
+            if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 404:
+                return None
+            raise
+        metadata = ObjectMetadata(
+            res["ContentLength"],
+            res["ETag"],
+            res.get("ContentType", "binary/octet-stream"),
+            res["LastModified"],
+        )
+        _metadata.set(cache_key, metadata)
+        return metadata
+
+    def download(self, key: str, **params: Any) -> "GetObjectOutputTypeDef":
+        return guarded(
+            f"s3:{self.bucket}",
+            s3_get,
+            lambda: self.client.get_object(Bucket=self.bucket, Key=key, **params),
+            discard=_close_body,
+            is_failure=_server_failure,
+        )
@@ -0,0 +1,124 @@
+import logging
+import os
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING
+
+from botocore.exceptions import BotoCoreError, ClientError
+from fastapi import HTTPException, status
+
+from app.cache import TTLCache
+from app.messages import UploadedPart
+from app.metrics import S3_ERRORS, error_code
+from app.s3 import MIN_PART_SIZE, S3Bucket
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3.type_defs import CompletedPartTypeDef, PartTypeDef
+
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", str(24 * 60 * 60)))
+UPLOAD_SWEEP_INTERVAL = float(os.environ.get("UPLOAD_SWEEP_INTERVAL", "3600"))
+# Chunks are buffered before upload_part, the cap bounds memory per request
+UPLOAD_CHUNK_MAX_SIZE = max(
+    int(os.environ.get("UPLOAD_CHUNK_MAX_SIZE", str(8 * 1024 * 1024))), MIN_PART_SIZE
+)
+SESSION_PREFIX = "devicezip/"
+SESSION_CONTENT_TYPE = "application/zip"
+MAX_PARTS = 10000
+
+# S3 errors caused by the client's requests rather than by S3 itself
+_CLIENT_ERRORS = {
+    "NoSuchUpload": status.HTTP_404_NOT_FOUND,
+    "BadDigest": status.HTTP_400_BAD_REQUEST,
+    "InvalidDigest": status.HTTP_400_BAD_REQUEST,
+    "EntityTooSmall": status.HTTP_400_BAD_REQUEST,
+    "InvalidPart": status.HTTP_400_BAD_REQUEST,
+}
+
+logger = logging.getLogger(__name__)
+
+_swept: TTLCache[tuple[str, str], bool] = TTLCache(1024, UPLOAD_SWEEP_INTERVAL)
+
+
+@contextmanager
+def session_errors(operation: str) -> Iterator[None]:
+    try:
+        yield
+    except ClientError as e:
+        code = error_code(e)
+        if code in _CLIENT_ERRORS:
+            raise HTTPException(_CLIENT_ERRORS[code], code) from e
+        S3_ERRORS.labels(operation, code).inc()
+        raise
+    except BotoCoreError as e:
+        S3_ERRORS.labels(operation, error_code(e)).inc()
+        raise
+
+
+async def read_chunk(chunks: AsyncIterator[bytes], content_length: str | None) -> bytes:
+    # Oversized chunks are refused before any of their bytes is buffered
+    if content_length is None:
+        raise HTTPException(
+            status.HTTP_411_LENGTH_REQUIRED, "Chunks need a Content-Length"
+        )
+    if not content_length.isdigit():
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "Invalid Content-Length")
+    size = int(content_length)
+    if size > UPLOAD_CHUNK_MAX_SIZE:
+        raise HTTPException(
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            f"Chunks are limited to {UPLOAD_CHUNK_MAX_SIZE} bytes",
+        )
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > size:
+            raise HTTPException(
+                status.HTTP_400_BAD_REQUEST, "Chunk is longer than its Content-Length"
+            )
+    return bytes(buffer)
+
+
+def uploaded_parts(parts: list["PartTypeDef"]) -> list[UploadedPart]:
+    return [
+        UploadedPart(part_number=p["PartNumber"], size=p["Size"], etag=p["ETag"])
+        for p in parts
+    ]
+
+
+def completed_parts(
+    parts: list["PartTypeDef"], expected: int | None = None
+) -> list["CompletedPartTypeDef"]:
+    numbers = {p["PartNumber"] for p in parts}
+    if not numbers:
+        raise HTTPException(status.HTTP_409_CONFLICT, "No parts stored")
+    count = max(numbers) if expected is None else expected
+    # A gap would silently truncate the zip, S3 accepts any ascending numbers
+    if missing := sorted(set(range(1, count + 1)) - numbers):
+        raise HTTPException(status.HTTP_409_CONFLICT, f"Missing parts: {missing}")
+    if len(numbers) != count:
+        raise HTTPException(status.HTTP_409_CONFLICT, "Unexpected parts stored")
+    return [
+        {"ETag": p["ETag"], "PartNumber": p["PartNumber"]}
+        for p in sorted(parts, key=lambda p: p["PartNumber"])
+    ]
+
+
+def sweep_stale_uploads(bucket: S3Bucket) -> None:
+    swept = (bucket.bucket, bucket.access_key_id)
+    if _swept.get(swept):
+        return
+    _swept.set(swept, True)
+    initiated = datetime.now(UTC) - timedelta(seconds=UPLOAD_SESSION_TTL)
+    try:
+        aborted = bucket.abort_uploads_before(SESSION_PREFIX, initiated)
+    except (BotoCoreError, ClientError) as e:
+        S3_ERRORS.labels("abort_stale_uploads", error_code(e)).inc()
+        logger.warning("Could not abort stale uploads in %s: %s", bucket.bucket, e)
+        return
+    if aborted:
+        logger.info("Aborted %d stale uploads in %s", aborted, bucket.bucket)
+
+
+def clear_sweeps() -> None:
+    _swept.clear()
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import tempfile
+import weakref
+from collections.abc import Callable
+from functools import partial
+from typing import IO, TYPE_CHECKING
+
+from app.concurrency import ReadAhead, run_io
+from app.disk_cache import CacheFill
+from app.s3 import S3Bucket
+
+if TYPE_CHECKING:
+    from mypy_boto3_s3.type_defs import GetObjectOutputTypeDef
+
+SHARED_READ_SIZE = 256 * 1024
+
+_FlightKey = tuple[str, str, str]
+
+
+class SharedDownload:
+    task: asyncio.Task[None]
+
+    def __init__(
+        self,
+        detach: Callable[["SharedDownload"], None],
+        reserve: Callable[[], CacheFill | None] | None = None,
+    ) -> None:
+        self.response: asyncio.Future[GetObjectOutputTypeDef] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.readers = 0
+        self._detach = detach
+        self._reserve = reserve
+        self._body: ReadAhead | None = None
+        self._file: IO[bytes] | None = None
+        self._size = 0
+        self._done = False
+        self._error: Exception | None = None
+        self._changed = asyncio.Condition()
+
+    async def fetch(self, bucket: S3Bucket, key: str) -> None:
+        fill = None
+        try:
+            if self._reserve:
+                fill = await run_io(self._reserve)
+            res = await run_io(bucket.download, key)
+            if not self.readers:
+                # Every reader left while the request was in flight
+                res["Body"].close()
+                return
+            self._body = ReadAhead(res["Body"])
+            if self.readers == 1 and fill is None:
+                # Nobody joined, the only reader streams the body directly
+                self._detach(self)
+                self.response.set_result(res)
+                return
+            # Readers go at their own pace, the body is spooled to disk for
+            # them, or into the cache it fills. The file goes away with the
+            # last reader of this download.
+            self._file = fill.file if fill else tempfile.TemporaryFile()
+            weakref.finalize(self, self._file.close)
+            self.response.set_result(res)
+            try:
+                async for chunk in self._body:
+                    await run_io(self._append, chunk)
+                    async with self._changed:
+                        self._size += len(chunk)
+                        self._changed.notify_all()
+            finally:
+                self._body.close()
+            if fill and self._size == res["ContentLength"]:
+                await run_io(fill.commit, res)
+                fill = None
+        except Exception as e:
+            self._error = e
+            if not self.response.done():
+                self.response.set_exception(e)
+        finally:
+            if fill:
+                fill.discard()
+            async with self._changed:
+                self._done = True
+                self._changed.notify_all()
+
+    async def read(self, position: int) -> bytes:
+        if self._file is None:
+            assert self._body is not None
+            return await anext(self._body, b"")
+        async with self._changed:
+            await self._changed.wait_for(partial(self._readable, position))
+        if self._error:
+            raise RuntimeError("Shared download failed") from self._error
+        if position >= self._size:
+            return b""
+        size = min(SHARED_READ_SIZE, self._size - position)
+        return await run_io(os.pread, self._file.fileno(), size, position)
+
+    def leave(self) -> None:
+        self.readers -= 1
+        if self.readers:
+            return
+        if self.response.done():
+            # Nobody is left to read it, the rest of the body is not fetched
+            self._detach(self)
+            self.task.cancel()
+        if self._body:
+            self._body.close()
+
+    def _readable(self, position: int) -> bool:
+        return self._done or self._size > position
+
+    def _append(self, chunk: bytes) -> None:
+        assert self._file is not None
+        self._file.write(chunk)
+        self._file.flush()
+
+
+class SharedReader:
+    def __init__(self, download: SharedDownload):
+        self._download = download
+        self._position = 0
+        self._closed = False
+        download.readers += 1
+
+    def __aiter__(self) -> "SharedReader":
+        return self
+
+    async def __anext__(self) -> bytes:
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            chunk = await self._download.read(self._position)
+        except BaseException:
+            self.close()
+            raise
+        if not chunk:
+            self.close()
+            raise StopAsyncIteration
+        self._position += len(chunk)
+        return chunk
+
+    def close(self) -> None:
+        if not self._closed:
+            self._closed = True
+            self._download.leave()
+
+
+class SharedDownloads:
+    def __init__(self) -> None:
+        self._downloads: dict[_FlightKey, SharedDownload] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def open(
+        self,
+        bucket: S3Bucket,
+        key: str,
+        reserve: Callable[[], CacheFill | None] | None = None,
+    ) -> tuple["GetObjectOutputTypeDef", SharedReader]:
+        flight_key = (bucket.bucket, bucket.access_key_id, key)
+        download = self._downloads.get(flight_key)
+        if download is None:
+            # Only the request starting a download fills the cache from it
+            download = SharedDownload(partial(self._detach, flight_key), reserve)
+            self._downloads[flight_key] = download
+            download.task = asyncio.create_task(
+                self._fetch(flight_key, download, bucket, key)
+            )
+            self._tasks.add(download.task)
+            download.task.add_done_callback(self._tasks.discard)
+        reader = SharedReader(download)
+        try:
+            # A cancelled request must not cancel the fetch shared with others
+            res = await asyncio.shield(download.response)
+        except BaseException:
+            reader.close()
+            raise
+        return res, reader
+
+    def __len__(self) -> int:
+        return len(self._downloads)
+
+    def _detach(self, flight_key: _FlightKey, download: SharedDownload) -> None:
+        if self._downloads.get(flight_key) is download:
+            del self._downloads[flight_key]
+
+    async def _fetch(
+        self,
+        flight_key: _FlightKey,
+        download: SharedDownload,
+        bucket: S3Bucket,
+        key: str,
+    ) -> None:
+        try:
+            await download.fetch(bucket, key)
+        finally:
+            self._detach(flight_key, download)
+
+
+shared_downloads = SharedDownloads()
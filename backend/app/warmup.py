@@ -0,0 +1,126 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable
+from enum import StrEnum, auto
+
+from app import STARTED
+from app.dependencies import make_bucket, make_form_validator
+from app.flow_config import get_config
+from app.messages import MessageStatus, ResultMessage
+from app.metrics import STARTUP_DURATION
+from app.s3 import load_models
+
+WARMUP_INSTANCES = tuple(
+    instance.strip()
+    for instance in os.environ.get("WARMUP_INSTANCES", "").split(",")
+    if instance.strip()
+)
+# Number of form ids per instance to prime the form cache with, 0 disables it
+WARMUP_FORMS = int(os.environ.get("WARMUP_FORMS", "0"))
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUpState(StrEnum):
+    PENDING = auto()
+    RUNNING = auto()
+    READY = auto()
+
+
+class WarmUpStatus(ResultMessage):
+    state: WarmUpState
+    instances: int = 0
+    forms: int = 0
+    duration: float | None = None
+    errors: list[str] = []
+
+
+class WarmUp:
+    def __init__(
+        self,
+        instances: tuple[str, ...],
+        forms: int,
+        clock: Callable[[], float] = time.perf_counter,
+        started: float = STARTED,
+    ):
+        self._instances = instances
+        self._forms = forms
+        self._clock = clock
+        self._started = started
+        self._lock = threading.Lock()
+        self._state = WarmUpState.PENDING
+        self._warmed = 0
+        self._primed = 0
+        self._duration: float | None = None
+        self._errors: list[str] = []
+
+    @property
+    def ready(self) -> bool:
+        return self._state == WarmUpState.READY
+
+    def start(self) -> None:
+        with self._lock:
+            if self._state != WarmUpState.PENDING:
+                return
+            self._state = WarmUpState.RUNNING
+        STARTUP_DURATION.labels("import").set(self._clock() - self._started)
+        thread = threading.Thread(target=self.run, name="warm-up", daemon=True)
+        thread.start()
+
+    def status(self) -> WarmUpStatus:
+        with self._lock:
+            return WarmUpStatus(
+                status=MessageStatus.SUCCESS if self.ready else MessageStatus.FAIL,
+                message=f"Warm-up {self._state}",
+                state=self._state,
+                instances=self._warmed,
+                forms=self._primed,
+                duration=self._duration,
+                errors=list(self._errors),
+            )
+
+    def run(self) -> None:
+        start = self._clock()
+        # Clients of instances that failed are created on their first request
+        steps: list[tuple[str, Callable[[], object]]] = [
+            ("datastore", lambda: importlib.import_module("google.cloud.datastore")),
+            ("config", lambda: get_config("")),
+            ("s3", load_models),
+            *((i, self._warm_instance(i)) for i in self._instances),
+        ]
+        for name, step in steps:
+            try:
+                step()
+            except Exception as e:
+                logger.exception("Warm-up of %s failed", name)
+                with self._lock:
+                    self._errors.append(f"{name}: {e}")
+        end = self._clock()
+        STARTUP_DURATION.labels("warm_up").set(end - start)
+        with self._lock:
+            self._duration = end - start
+            self._state = WarmUpState.READY
+        logger.info(
+            "Ready %.3fs after start, warm-up took %.3fs",
+            end - self._started,
+            end - start,
+        )
+
+    def _warm_instance(self, instance: str) -> Callable[[], None]:
+        def warm() -> None:
+            config = get_config(instance)
+            if not config:
+                raise LookupError("Unknown instance")
+            make_bucket(config)
+            primed = make_form_validator(config).prime(self._forms)
+            with self._lock:
+                self._warmed += 1
+                self._primed += primed
+
+        return warm
+
+
+warm_up = WarmUp(WARMUP_INSTANCES, WARMUP_FORMS)
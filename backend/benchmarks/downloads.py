@@ -0,0 +1,69 @@
+import asyncio
+import io
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+
+from botocore.response import StreamingBody
+
+from app.concurrency import ReadAhead, run_io
+
+OBJECT_SIZE = 64 * 1024 * 1024
+# Simulated upstream throughput, S3 within a region is in this range
+UPSTREAM_BYTES_PER_SECOND = 400 * 1024 * 1024
+
+
+class SlowStream(io.BytesIO):
+    def read(self, size: int | None = -1) -> bytes:
+        chunk = super().read(size)
+        time.sleep(len(chunk) / UPSTREAM_BYTES_PER_SECOND)
+        return chunk
+
+
+def make_body(throttled: bool) -> StreamingBody:
+    data = bytes(OBJECT_SIZE)
+    return StreamingBody(SlowStream(data) if throttled else io.BytesIO(data), len(data))
+
+
+async def legacy_chunks(body: StreamingBody) -> AsyncIterator[bytes]:
+    chunks: Iterator[bytes] = body.iter_chunks()
+    while chunk := await run_io(next, chunks, b""):
+        yield chunk
+
+
+async def send_all(content: AsyncIterator[bytes]) -> int:
+    sent = 0
+    async for chunk in content:
+        sent += len(chunk)
+        # Stands in for the ASGI send of each chunk
+        await asyncio.sleep(0)
+    return sent
+
+
+def measure(
+    stream: Callable[[StreamingBody], AsyncIterator[bytes]], throttled: bool
+) -> tuple[float, float]:
+    body = make_body(throttled)
+    wall, cpu = time.perf_counter(), time.process_time()
+    assert asyncio.run(send_all(stream(body))) == OBJECT_SIZE
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    gigabytes = OBJECT_SIZE / 1024**3
+    return OBJECT_SIZE / 1024**2 / wall, cpu / gigabytes
+
+
+def main() -> None:
+    print(f"object size:        {OBJECT_SIZE // 1024**2} MiB")
+    for throttled in (False, True):
+        upstream = (
+            f"{UPSTREAM_BYTES_PER_SECOND // 1024**2} MiB/s" if throttled else "memory"
+        )
+        legacy = measure(legacy_chunks, throttled)
+        read_ahead = measure(ReadAhead, throttled)
+        print(f"upstream:           {upstream}")
+        print(f"  legacy MiB/s:     {legacy[0]:,.0f}  cpu s/GiB: {legacy[1]:,.2f}")
+        print(
+            f"  read-ahead MiB/s: {read_ahead[0]:,.0f}  cpu s/GiB: {read_ahead[1]:,.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import os
+import time
+from types import SimpleNamespace
+
+from google.cloud import datastore
+from google.oauth2 import service_account
+
+from app.main import app
+
+DATASTORE_LATENCY = float(os.environ.get("LOADTEST_DATASTORE_LATENCY", "0.005"))
+
+
+class FakeCredentials:
+    project_id = "loadtest"
+
+    @classmethod
+    def from_service_account_file(cls, _: str) -> "FakeCredentials":
+        return cls()
+
+
+class FakeDatastoreClient:
+    def __init__(self, **_: object):
+        pass
+
+    def key(self, kind: str, id: int) -> SimpleNamespace:
+        return SimpleNamespace(kind=kind, id=id)
+
+    def get(self, key: SimpleNamespace, **_: object) -> SimpleNamespace:
+        time.sleep(DATASTORE_LATENCY)
+        return SimpleNamespace(key=key)
+
+    def get_multi(
+        self, keys: list[SimpleNamespace], **_: object
+    ) -> list[SimpleNamespace]:
+        time.sleep(DATASTORE_LATENCY)
+        return [SimpleNamespace(key=key) for key in keys]
+
+
+# Every form exists, lookups cost a simulated round trip
+service_account.Credentials = FakeCredentials  # type: ignore[misc,assignment]
+datastore.Client = FakeDatastoreClient  # type: ignore[misc,assignment]
+
+__all__ = ["app"]
@@ -14,4 +14,9 @@ if [ -z "$(ls -A /akvo-flow-server-config)" ] && [ -f /root/.ssh/id_rsa.pub ]; t
   git clone git@github.com:akvo/akvo-flow-server-config.git /akvo-flow-server-config
 fi
 
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+  rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+  mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+fi
+
 exec "$@"
@@ -3,5 +3,5 @@
 set -e
 set -x
 
-ruff check app tests --fix
-ruff format app tests
+ruff check app tests benchmarks --fix
+ruff format app tests benchmarks
@@ -0,0 +1,20 @@
+from collections.abc import Iterator
+
+import pytest
+
+from app.resilience import clear_breakers, datastore_get, s3_get, s3_head
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def clean_resilience() -> Iterator[None]:
+    yield
+    # Failures and latencies of one test must not open circuits or hedge in others
+    clear_breakers()
+    s3_get.clear()
+    s3_head.clear()
+    datastore_get.clear()
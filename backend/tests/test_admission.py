@@ -0,0 +1,204 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from app.admission import AdmissionMiddleware, FairScheduler, QueueFullError
+
+
+async def settle() -> None:
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.anyio
+async def test_requests_start_until_limits_are_reached():
+    scheduler = FairScheduler(limit=3, instance_limit=2, queue_size=10)
+    started: list[str] = []
+
+    async def request(instance: str) -> None:
+        await scheduler.acquire(instance)
+        started.append(instance)
+
+    tasks = [asyncio.create_task(request(i)) for i in ("a", "a", "a", "b", "b")]
+    await settle()
+
+    # The third "a" waits on its instance limit, the second "b" on the global one
+    assert started == ["a", "a", "b"]
+    scheduler.release("a")
+    await settle()
+    assert started == ["a", "a", "b", "a"]
+    scheduler.release("b")
+    await settle()
+    assert started == ["a", "a", "b", "a", "b"]
+    await asyncio.gather(*tasks)
+
+
+@pytest.mark.anyio
+async def test_waiting_instances_take_turns():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=10)
+    started: list[str] = []
+
+    async def request(instance: str) -> None:
+        await scheduler.acquire(instance)
+        started.append(instance)
+
+    await scheduler.acquire("busy")
+    tasks = [asyncio.create_task(request(i)) for i in ("a", "a", "a", "b", "c")]
+    await settle()
+    for instance in ["busy", "a", "b", "c", "a"]:
+        scheduler.release(instance)
+        await settle()
+
+    assert started == ["a", "b", "c", "a", "a"]
+    await asyncio.gather(*tasks)
+
+
+@pytest.mark.anyio
+async def test_instances_at_their_limit_are_skipped():
+    scheduler = FairScheduler(limit=2, instance_limit=1, queue_size=10)
+    await scheduler.acquire("a")
+    await scheduler.acquire("busy")
+    first = asyncio.create_task(scheduler.acquire("a"))
+    second = asyncio.create_task(scheduler.acquire("a"))
+    other = asyncio.create_task(scheduler.acquire("b"))
+    await settle()
+    first.cancel()
+    await settle()
+
+    scheduler.release("busy")
+    await other
+    assert not second.done()
+    scheduler.release("a")
+    await second
+
+
+@pytest.mark.anyio
+async def test_full_queue_is_rejected():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=1)
+    await scheduler.acquire("a")
+    waiting = asyncio.create_task(scheduler.acquire("a"))
+    await settle()
+
+    with pytest.raises(QueueFullError):
+        await scheduler.acquire("a")
+    scheduler.release("a")
+    await waiting
+
+
+@pytest.mark.anyio
+async def test_cancelled_waiters_leave_the_queue():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=1)
+    await scheduler.acquire("a")
+    cancelled = asyncio.create_task(scheduler.acquire("b"))
+    await settle()
+    cancelled.cancel()
+    await settle()
+
+    # The queue of "b" is empty again, and the slot goes to the next arrival
+    waiting = asyncio.create_task(scheduler.acquire("b"))
+    await settle()
+    scheduler.release("a")
+    await waiting
+    assert cancelled.cancelled()
+
+
+@pytest.mark.anyio
+async def test_slots_are_not_granted_to_cancelled_waiters():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=10)
+    await scheduler.acquire("a")
+    first = asyncio.create_task(scheduler.acquire("b"))
+    second = asyncio.create_task(scheduler.acquire("b"))
+    await settle()
+
+    # Cancelled, but its task has not run since, the slot goes to the next one
+    first.cancel()
+    scheduler.release("a")
+    await second
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    scheduler.release("b")
+    await scheduler.acquire("c")
+
+
+@pytest.mark.anyio
+async def test_granted_slots_of_cancelled_waiters_are_released():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=10)
+    await scheduler.acquire("a")
+    granted = asyncio.create_task(scheduler.acquire("b"))
+    await settle()
+
+    # Granted, then cancelled before its task could resume
+    scheduler.release("a")
+    granted.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await granted
+    await asyncio.wait_for(scheduler.acquire("c"), 1)
+
+
+def admission_client(scheduler: FairScheduler) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(AdmissionMiddleware, scheduler=scheduler)
+
+    @app.get("/{instance}/images/{filename}")
+    async def get_image() -> dict:
+        return {}
+
+    @app.post("/{instance}/images.zip")
+    async def post_bundle() -> dict:
+        return {}
+
+    @app.get("/healtz")
+    async def healt_check() -> dict:
+        return {}
+
+    return TestClient(app)
+
+
+def test_middleware_rejects_with_retry_after():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=0)
+    client = admission_client(scheduler)
+    labels = {"instance": "instance1"}
+    before = REGISTRY.get_sample_value("flow_s3_proxy_admission_rejected_total", labels)
+    waits = REGISTRY.get_sample_value(
+        "flow_s3_proxy_admission_wait_seconds_count", labels
+    )
+
+    with patch("app.admission.get_config", return_value={"content": "x"}):
+        assert client.get("/instance1/images/a.jpg").status_code == 200
+        with patch.object(scheduler, "_total", 1):
+            response = client.get("/instance1/images/a.jpg")
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+    assert (
+        REGISTRY.get_sample_value("flow_s3_proxy_admission_rejected_total", labels)
+        == (before or 0) + 1
+    )
+    assert (
+        REGISTRY.get_sample_value("flow_s3_proxy_admission_wait_seconds_count", labels)
+        == (waits or 0) + 1
+    )
+
+
+def test_middleware_skips_other_requests():
+    scheduler = FairScheduler(limit=0, instance_limit=0, queue_size=0)
+    client = admission_client(scheduler)
+
+    with patch("app.admission.get_config", return_value={}):
+        assert client.get("/unknown/images/a.jpg").status_code == 200
+    assert client.get("/healtz").status_code == 200
+
+
+def test_middleware_admits_bundles():
+    scheduler = FairScheduler(limit=1, instance_limit=1, queue_size=0)
+    client = admission_client(scheduler)
+
+    with patch("app.admission.get_config", return_value={"content": "x"}):
+        assert client.post("/instance1/images.zip").status_code == 200
+        with patch.object(scheduler, "_total", 1):
+            assert client.post("/instance1/images.zip").status_code == 503
+            assert client.get("/instance1").status_code == 404
@@ -0,0 +1,233 @@
+import asyncio
+import io
+import json
+import os
+import threading
+import zipfile
+from datetime import UTC, datetime
+from unittest.mock import Mock, patch
+
+import anyio
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+
+from app.bundles import MANIFEST, _discard, _release, bundle_response, zip_bundle
+from app.messages import FileResult, MessageStatus
+from app.s3 import S3Bucket
+
+LAST_MODIFIED = datetime(2024, 1, 2, 3, 4, 5, tzinfo=UTC)
+
+
+def fake_image(content: bytes) -> dict:
+    return {
+        "Body": StreamingBody(io.BytesIO(content), len(content)),
+        "ContentLength": len(content),
+        "LastModified": LAST_MODIFIED,
+    }
+
+
+def not_found() -> ClientError:
+    return ClientError(
+        {"Error": {"Code": "NoSuchKey"}, "ResponseMetadata": {"HTTPStatusCode": 404}},
+        "GetObject",
+    )
+
+
+async def read_bundle(bucket: Mock, filenames: list[str], **params) -> zipfile.ZipFile:
+    chunks = [chunk async for chunk in zip_bundle(bucket, filenames, **params)]
+    return zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_reports_missing_images_in_manifest():
+    bucket = Mock(spec=S3Bucket)
+    bucket.download.side_effect = [
+        fake_image(b"first"),
+        not_found(),
+        ClientError({"Error": {"Code": "SlowDown"}}, "GetObject"),
+    ]
+
+    filenames = ["a.jpg", "missing.jpg", "b.jpg", "../c.jpg"]
+
+    archive = await read_bundle(bucket, filenames, prefetch=1)
+
+    assert archive.testzip() is None
+    assert archive.namelist() == ["a.jpg", MANIFEST]
+    assert archive.read("a.jpg") == b"first"
+    assert archive.getinfo("a.jpg").date_time == (2024, 1, 2, 3, 4, 4)
+    manifest = json.loads(archive.read(MANIFEST))
+    assert manifest["status"] == "fail"
+    assert manifest["message"] == "3 of 4 files missing"
+    assert [(f["filename"], f["status"], f["message"]) for f in manifest["files"]] == [
+        ("a.jpg", "success", None),
+        ("missing.jpg", "fail", "Not found"),
+        ("b.jpg", "error", "SlowDown"),
+        ("../c.jpg", "fail", "Invalid filename"),
+    ]
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_streams_large_images():
+    images = {"big.jpg": os.urandom(300 * 1024), "small.jpg": b"small"}
+    bucket = Mock(spec=S3Bucket)
+    bucket.download.side_effect = lambda key: fake_image(
+        images[key.removeprefix("images/")]
+    )
+
+    with patch("app.bundles.BUNDLE_BUFFER_SIZE", 1024):
+        archive = await read_bundle(bucket, list(images))
+
+    assert archive.testzip() is None
+    assert archive.read("big.jpg") == images["big.jpg"]
+    assert archive.read("small.jpg") == b"small"
+    assert json.loads(archive.read(MANIFEST))["message"] == "OK!"
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_flags_interrupted_images():
+    closed = threading.Event()
+    body = Mock(spec=StreamingBody)
+    body.read.side_effect = [
+        b"partial",
+        ClientError({"Error": {"Code": "RequestTimeout"}}, "GetObject"),
+    ]
+    body.close.side_effect = lambda: closed.set()
+    bucket = Mock(spec=S3Bucket)
+    bucket.download.return_value = {
+        "Body": body,
+        "ContentLength": 64 * 1024 * 1024,
+        "LastModified": LAST_MODIFIED,
+    }
+
+    archive = await read_bundle(bucket, ["big.jpg"])
+
+    assert archive.testzip() is None
+    assert archive.read("big.jpg") == b"partial"
+    manifest = json.loads(archive.read(MANIFEST))
+    assert [(f["filename"], f["status"], f["message"]) for f in manifest["files"]] == [
+        ("big.jpg", "error", "Incomplete: RequestTimeout"),
+    ]
+    assert await anyio.to_thread.run_sync(closed.wait, 5)
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_closes_abandoned_responses():
+    released = threading.Event()
+    closed = {name: threading.Event() for name in ("a.jpg", "b.jpg", "c.jpg")}
+
+    def download(key: str) -> dict:
+        filename = key.removeprefix("images/")
+        if filename in ("c.jpg", "d.jpg"):
+            released.wait(5)
+        if filename == "d.jpg":
+            raise not_found()
+        body = Mock(spec=StreamingBody)
+        body.read.return_value = b"x" * 1024
+        body.close.side_effect = lambda: closed[filename].set()
+        return {"Body": body, "ContentLength": 1 << 30, "LastModified": LAST_MODIFIED}
+
+    bucket = Mock(spec=S3Bucket, download=Mock(side_effect=download))
+    chunks = zip_bundle(bucket, ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+    assert b".jpg" in await anext(chunks)
+    await chunks.aclose()
+    released.set()
+
+    for event in closed.values():
+        assert await anyio.to_thread.run_sync(event.wait, 5)
+
+
+@pytest.mark.internal
+@pytest.mark.anyio
+async def test_discarded_fetches_keep_buffered_images():
+    fetched = asyncio.get_running_loop().create_future()
+    fetched.set_result((FileResult(filename="a.jpg", status=MessageStatus.FAIL), None))
+    read = asyncio.get_running_loop().create_future()
+    read.set_result((zipfile.ZipInfo("a.jpg"), b"data"))
+
+    _discard(fetched)
+    _release(read)
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_writes_images_as_they_arrive():
+    released = threading.Event()
+    images = {"slow.jpg": b"slow", "fast.jpg": b"fast"}
+
+    def download(key: str) -> dict:
+        if key == "images/slow.jpg":
+            released.wait(5)
+        return fake_image(images[key.removeprefix("images/")])
+
+    bucket = Mock(spec=S3Bucket, download=Mock(side_effect=download))
+    chunks = []
+    with anyio.fail_after(5):
+        async for chunk in zip_bundle(bucket, ["slow.jpg", "fast.jpg"]):
+            if not chunks:
+                assert b"fast.jpg" in chunk
+                released.set()
+            chunks.append(chunk)
+
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert archive.namelist() == ["fast.jpg", "slow.jpg", MANIFEST]
+    assert json.loads(archive.read(MANIFEST))["message"] == "OK!"
+
+
+@pytest.mark.anyio
+async def test_zip_bundle_prefetch_is_bounded():
+    lock = threading.Lock()
+    running = peak = 0
+
+    def download(key: str) -> dict:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        threading.Event().wait(0.01)
+        with lock:
+            running -= 1
+        return fake_image(key.encode())
+
+    bucket = Mock(spec=S3Bucket, download=Mock(side_effect=download))
+    filenames = [f"{i}.jpg" for i in range(12)]
+
+    archive = await read_bundle(bucket, filenames, prefetch=3)
+
+    assert sorted(archive.namelist()) == sorted([*filenames, MANIFEST])
+    assert peak == 3
+
+
+@pytest.mark.anyio
+async def test_bundle_response_stops_fetching_on_disconnect():
+    released = threading.Event()
+    images = {"a.jpg": b"first", "b.jpg": b"second"}
+
+    def download(key: str) -> dict:
+        if key == "images/b.jpg":
+            released.wait(5)
+        return fake_image(images[key.removeprefix("images/")])
+
+    bucket = Mock(spec=S3Bucket, download=Mock(side_effect=download))
+    response = bundle_response(bucket, ["a.jpg", "b.jpg", "a.jpg"], "images.zip")
+    sent = anyio.Event()
+    messages = []
+
+    async def receive() -> dict:
+        await sent.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: dict) -> None:
+        messages.append(message)
+        if message["type"] == "http.response.body":
+            sent.set()
+
+    with anyio.fail_after(5):
+        await response({"type": "http", "method": "GET"}, receive, send)
+    released.set()
+
+    assert dict(messages[0]["headers"])[b"content-disposition"] == (
+        b'attachment; filename="images.zip"'
+    )
+    assert b"a.jpg" in messages[1]["body"]
+    assert not any(m.get("more_body") is False for m in messages)
+    assert bucket.download.call_count == 2
@@ -0,0 +1,47 @@
+from unittest.mock import patch
+
+from app.cache import CacheInfo, TTLCache
+
+
+def test_get_returns_cached_value():
+    cache: TTLCache[str, int] = TTLCache(10, 60)
+    cache.set("key", 1)
+
+    assert cache.get("key") == 1
+    assert cache.get("other") is None
+    assert cache.cache_info() == CacheInfo(hits=1, misses=1, maxsize=10, currsize=1)
+
+
+def test_get_expires_entries():
+    cache: TTLCache[str, int] = TTLCache(10, 60)
+    with patch("app.cache.time.monotonic", return_value=100.0):
+        cache.set("default", 1)
+        cache.set("short", 2, ttl=5)
+    with patch("app.cache.time.monotonic", return_value=110.0):
+        assert cache.get("default") == 1
+        assert cache.get("short") is None
+        assert cache.cache_info().currsize == 1
+
+
+def test_set_evicts_least_recently_used():
+    cache: TTLCache[str, int] = TTLCache(2, 60)
+    cache.set("one", 1)
+    cache.set("two", 2)
+    cache.get("one")
+    cache.set("three", 3)
+
+    assert cache.get("one") == 1
+    assert cache.get("two") is None
+    assert cache.get("three") == 3
+
+
+def test_pop_and_clear():
+    cache: TTLCache[str, int] = TTLCache(10, 60)
+    cache.set("one", 1)
+    cache.set("two", 2)
+
+    cache.pop("one")
+    cache.pop("missing")
+    assert cache.get("one") is None
+    cache.clear()
+    assert cache.cache_info().currsize == 0
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from app.concurrency import ReadAhead, run_io
+
+
+@pytest.mark.anyio
+async def test_run_io_runs_outside_event_loop_thread():
+    def work(value: int, *, offset: int) -> tuple[int, str]:
+        return value + offset, threading.current_thread().name
+
+    result, thread_name = await run_io(work, 1, offset=2)
+
+    assert result == 3
+    assert thread_name.startswith("io")
+
+
+async def wait_closed(body: Mock) -> None:
+    deadline = time.monotonic() + 5
+    while not body.close.called:
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.anyio
+async def test_read_ahead_grows_chunks_up_to_max_size():
+    body = Mock(read=Mock(side_effect=[b"a", b"b", b"c", b"d", b""]))
+
+    chunks = [chunk async for chunk in ReadAhead(body, min_size=2, max_size=5)]
+
+    assert chunks == [b"a", b"b", b"c", b"d"]
+    sizes = [c.args[0] for c in body.read.call_args_list]
+    assert sizes == [2, 4, 5, 5, 5]
+    await wait_closed(body)
+
+
+@pytest.mark.anyio
+async def test_read_ahead_is_bounded():
+    body = Mock(read=Mock(return_value=b"chunk"))
+    reader = ReadAhead(body, read_ahead=2)
+
+    assert await anext(reader) == b"chunk"
+    await asyncio.sleep(0.05)
+    # Two queued, one waiting to be queued, besides the one handed out
+    assert body.read.call_count == 4
+    reader.close()
+    reader.close()
+
+    await wait_closed(body)
+    with pytest.raises(StopAsyncIteration):
+        await anext(reader)
+    body.close.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_read_ahead_close_waits_for_read_in_progress():
+    reading = threading.Event()
+    release = threading.Event()
+
+    def read(_: int) -> bytes:
+        reading.set()
+        release.wait()
+        return b"chunk"
+
+    body = Mock(read=Mock(side_effect=read))
+    reader = ReadAhead(body)
+    waiting = asyncio.create_task(anext(reader))
+    await asyncio.to_thread(reading.wait)
+    waiting.cancel()
+    reader.close()
+    await asyncio.sleep(0.05)
+
+    body.close.assert_not_called()
+    release.set()
+    await wait_closed(body)
+    assert body.read.call_count == 1
+    # A read scheduled before close was seen finds the body closed
+    assert reader._read(1) == b""
+
+
+@pytest.mark.anyio
+async def test_read_ahead_errors_reach_reader():
+    body = Mock(read=Mock(side_effect=[b"abc", OSError("connection reset")]))
+    reader = ReadAhead(body)
+
+    assert await anext(reader) == b"abc"
+    with pytest.raises(OSError, match="connection reset"):
+        await anext(reader)
+    await wait_closed(body)
+
+
+@pytest.mark.anyio
+async def test_read_ahead_closed_before_reading():
+    body = Mock()
+
+    ReadAhead(body).close()
+
+    await wait_closed(body)
+    body.read.assert_not_called()
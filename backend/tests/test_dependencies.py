@@ -1,5 +1,13 @@
+from unittest.mock import patch
+
 from app.dependencies import provide_make_bucket, provide_make_form_validator
-from app.flow_config import AWS_ACCESS_ID, AWS_BUCKET, AWS_SECRET, GCP_CREDENTIAL
+from app.flow_config import (
+    AWS_ACCESS_ID,
+    AWS_BUCKET,
+    AWS_REGION,
+    AWS_SECRET,
+    GCP_CREDENTIAL,
+)
 from app.form_validator import FormValidator
 from app.s3 import S3Bucket
 
@@ -7,8 +15,21 @@ from app.s3 import S3Bucket
 def test_bucket_factory():
     factory = provide_make_bucket()
     config = {AWS_BUCKET: "bucket", AWS_ACCESS_ID: "fake-id", AWS_SECRET: "fake-secret"}
-    bucket = factory(config)
+    with patch("app.dependencies.resolve_region", return_value="eu-west-2") as lookup:
+        bucket = factory(config)
     assert isinstance(bucket, S3Bucket)
+    assert bucket.client.meta.region_name == "eu-west-2"
+    lookup.assert_called_once_with("bucket", "fake-id", "fake-secret")
+
+
+def test_bucket_factory_pins_region():
+    config = {AWS_BUCKET: "bucket", AWS_ACCESS_ID: "id", AWS_REGION: "eu-west-1"}
+
+    with patch("app.dependencies.resolve_region") as lookup:
+        bucket = provide_make_bucket()(config)
+
+    assert bucket.client.meta.region_name == "eu-west-1"
+    lookup.assert_not_called()
 
 
 def test_form_validator_factory():
@@ -16,3 +37,9 @@ def test_form_validator_factory():
     config = {GCP_CREDENTIAL: "fake-credential"}
     validator = factory(config)
     assert isinstance(validator, FormValidator)
+
+
+def test_form_validator_factory_reuses_validator():
+    factory = provide_make_form_validator()
+    config = {GCP_CREDENTIAL: "fake-credential"}
+    assert factory(config) is factory(dict(config))
@@ -0,0 +1,120 @@
+import os
+import time
+from datetime import UTC, datetime
+from unittest.mock import patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.disk_cache import STALE_FILL_SECONDS, DiskCache
+
+RESPONSE = {
+    "ContentType": "application/zip",
+    "ETag": '"etag"',
+    "LastModified": datetime(2024, 1, 2, 3, 4, 5, tzinfo=UTC),
+}
+
+
+@pytest.fixture
+def cache(tmp_path) -> DiskCache:
+    return DiskCache(str(tmp_path / "cache"), 100)
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(f"flow_s3_proxy_survey_cache_{name}", labels) or 0
+
+
+def fill(cache: DiskCache, name: str, content: bytes = b"survey") -> None:
+    reserved = cache.reserve("instance", name)
+    assert reserved is not None
+    with reserved.file:
+        reserved.file.write(content)
+    reserved.commit(RESPONSE)
+
+
+def test_get_missing_entry(cache: DiskCache):
+    misses = sample("lookups_total", result="miss")
+
+    assert cache.get("instance", "123v1.0") is None
+    assert sample("lookups_total", result="miss") == misses + 1
+
+
+def test_fill_and_get(cache: DiskCache):
+    hits, served = sample("lookups_total", result="hit"), sample("served_bytes_total")
+    fill(cache, "123v1.0")
+    entry = cache.get("instance", "123v1.0")
+
+    assert entry is not None
+    assert entry.size == 6
+    assert entry.headers == {
+        "content-type": "application/zip",
+        "etag": '"etag"',
+        "last-modified": "Tue, 02 Jan 2024 03:04:05 GMT",
+    }
+    with open(entry.path, "rb") as f:
+        assert f.read() == b"survey"
+    assert cache.get("other", "123v1.0") is None
+    cache.served(entry.size)
+    assert sample("lookups_total", result="hit") == hits + 1
+    assert sample("served_bytes_total") == served + 6
+
+
+def test_reserve_claims_entry_once(cache: DiskCache):
+    reserved = cache.reserve("instance", "123v1.0")
+    assert reserved is not None
+
+    assert cache.reserve("instance", "123v1.0") is None
+    reserved.file.close()
+    reserved.discard()
+    reserved.discard()
+    assert os.listdir(cache.directory) == []
+    assert cache.reserve("instance", "123v1.0") is not None
+
+
+def test_commit_failure_leaves_no_entry(cache: DiskCache):
+    reserved = cache.reserve("instance", "123v1.0")
+    assert reserved is not None
+    reserved.file.close()
+    with patch("os.replace", side_effect=OSError("disk full")):
+        reserved.commit(RESPONSE)
+
+    assert cache.get("instance", "123v1.0") is None
+    assert cache.reserve("instance", "123v1.0") is not None
+
+
+def test_evict_least_recently_used(cache: DiskCache):
+    evictions = sample("evictions_total")
+    for name in ("1v1.0", "2v1.0"):
+        fill(cache, name, b"x" * 40)
+    old = time.time() - 100
+    os.utime(cache.get("instance", "1v1.0").path, (old, old))
+    os.utime(cache.get("instance", "2v1.0").path, (old + 1, old + 1))
+    cache.get("instance", "1v1.0")
+    fill(cache, "3v1.0", b"x" * 40)
+
+    assert cache.get("instance", "2v1.0") is None
+    assert cache.get("instance", "1v1.0") is not None
+    assert cache.get("instance", "3v1.0") is not None
+    assert sample("evictions_total") == evictions + 1
+
+
+def test_evict_removes_stale_fills(cache: DiskCache):
+    os.makedirs(cache.directory)
+    stale = os.path.join(cache.directory, "stale.tmp")
+    fresh = os.path.join(cache.directory, "fresh.tmp")
+    for path in (stale, fresh):
+        open(path, "w").close()
+    old = time.time() - STALE_FILL_SECONDS - 1
+    os.utime(stale, (old, old))
+    cache.evict()
+
+    assert os.listdir(cache.directory) == ["fresh.tmp"]
+
+
+@pytest.mark.internal
+def test_evict_ignores_concurrently_removed_files(cache: DiskCache):
+    fill(cache, "1v1.0")
+    with patch("os.DirEntry.stat", side_effect=FileNotFoundError):
+        cache.evict()
+
+    assert cache.get("instance", "1v1.0") is not None
@@ -0,0 +1,471 @@
+import io
+import threading
+from datetime import UTC, datetime
+from unittest.mock import Mock, patch
+
+import anyio
+import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app.downloads import (
+    IMMUTABLE,
+    ObjectStreamingResponse,
+    byte_range,
+    download_params,
+    file_response,
+    head_response,
+    not_modified,
+    object_response,
+)
+from app.resilience import CircuitOpenError
+from app.s3 import ObjectMetadata, S3Bucket
+from app.singleflight import shared_downloads
+
+LAST_MODIFIED = datetime(2024, 1, 2, 3, 4, 5, tzinfo=UTC)
+
+
+def make_request(headers: dict[str, str] | None = None) -> Request:
+    raw = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "headers": raw})
+
+
+def fake_object(content: bytes, **extra) -> dict:
+    return {
+        "Body": StreamingBody(io.BytesIO(content), len(content)),
+        "ContentType": "application/zip",
+        "ContentLength": len(content),
+        "ETag": '"etag"',
+        "LastModified": LAST_MODIFIED,
+        **extra,
+    }
+
+
+def client_error(status_code: int, headers: dict[str, str] | None = None):
+    return ClientError(
+        {
+            "Error": {"Code": str(status_code)},
+            "ResponseMetadata": {
+                "HTTPStatusCode": status_code,
+                "HTTPHeaders": headers or {},
+            },
+        },
+        "GetObject",
+    )
+
+
+async def body_of(response) -> bytes:
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+
+def test_download_params_without_conditions():
+    assert download_params(make_request()) == {}
+
+
+def test_download_params_conditions_and_range():
+    request = make_request(
+        {
+            "If-None-Match": '"etag"',
+            "If-Modified-Since": "Tue, 02 Jan 2024 03:04:05 GMT",
+            "Range": "bytes=0-99",
+        }
+    )
+
+    assert download_params(request) == {"IfNoneMatch": '"etag"', "Range": "bytes=0-99"}
+
+
+def test_download_params_if_modified_since():
+    request = make_request({"If-Modified-Since": "Tue, 02 Jan 2024 03:04:05 GMT"})
+
+    assert download_params(request) == {"IfModifiedSince": LAST_MODIFIED}
+
+
+def test_download_params_ignores_invalid_conditions():
+    request = make_request({"If-Modified-Since": "yesterday", "Range": "bytes=0-1,5-6"})
+
+    assert download_params(request) == {}
+
+
+@pytest.mark.anyio
+async def test_object_response_streams_full_object():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.return_value = fake_object(b"content")
+
+    response = await object_response(bucket, "key", make_request(), IMMUTABLE)
+
+    bucket.download.assert_called_with("key")
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "7"
+    assert response.headers["etag"] == '"etag"'
+    assert response.headers["last-modified"] == "Tue, 02 Jan 2024 03:04:05 GMT"
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["cache-control"] == IMMUTABLE
+    assert await body_of(response) == b"content"
+
+
+@pytest.mark.anyio
+async def test_object_response_partial_content():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.return_value = fake_object(b"nte", ContentRange="bytes 2-4/7")
+
+    response = await object_response(
+        bucket, "key", make_request({"Range": "bytes=2-4"})
+    )
+
+    bucket.download.assert_called_with("key", Range="bytes=2-4")
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 2-4/7"
+    assert "cache-control" not in response.headers
+    assert await body_of(response) == b"nte"
+
+
+async def disconnect_after_first_chunk(response) -> None:
+    sent = anyio.Event()
+
+    async def receive() -> dict:
+        await sent.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message: dict) -> None:
+        if message["type"] == "http.response.body":
+            # The client is gone while the chunk is sent, not while it is read
+            sent.set()
+            await anyio.sleep_forever()
+
+    with anyio.fail_after(5):
+        await response({"type": "http", "method": "GET"}, receive, send)
+
+
+def endless_body() -> tuple[Mock, threading.Event]:
+    closed = threading.Event()
+    body = Mock(read=Mock(return_value=b"chunk"), close=Mock(side_effect=closed.set))
+    return body, closed
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("headers", [{}, {"Range": "bytes=0-"}])
+async def test_object_response_releases_body_on_disconnect(headers):
+    body, closed = endless_body()
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.return_value = fake_object(b"", Body=body, ContentRange="x")
+    response = await object_response(bucket, "key", make_request(headers))
+
+    await disconnect_after_first_chunk(response)
+
+    assert await anyio.to_thread.run_sync(closed.wait, 5)
+    assert len(shared_downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_object_response_releases_shared_body_on_disconnect():
+    body, closed = endless_body()
+    release = threading.Event()
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = lambda *_: release.wait() and fake_object(
+        b"", Body=body
+    )
+    responses = []
+
+    async def respond() -> None:
+        responses.append(await object_response(bucket, "key", make_request()))
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(respond)
+        tg.start_soon(respond)
+        await anyio.sleep(0.05)
+        release.set()
+    for response in responses:
+        await disconnect_after_first_chunk(response)
+
+    assert await anyio.to_thread.run_sync(closed.wait, 5)
+    bucket.download.assert_called_once()
+    assert len(shared_downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_object_streaming_response_leaves_other_iterators():
+    class Chunks:
+        def __init__(self) -> None:
+            self.chunks = [b"chunk"]
+
+        def __aiter__(self) -> "Chunks":
+            return self
+
+        async def __anext__(self) -> bytes:
+            if not self.chunks:
+                raise StopAsyncIteration
+            return self.chunks.pop()
+
+    response = ObjectStreamingResponse(Chunks())
+    messages = []
+
+    async def receive() -> dict:
+        await anyio.sleep_forever()
+
+    async def send(message: dict) -> None:
+        messages.append(message)
+
+    await response({"type": "http", "method": "GET"}, receive, send)
+
+    assert messages[1]["body"] == b"chunk"
+
+
+@pytest.mark.anyio
+async def test_object_response_not_modified():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = client_error(
+        304, {"etag": '"etag"', "content-type": "application/xml"}
+    )
+
+    response = await object_response(
+        bucket, "key", make_request({"If-None-Match": '"etag"'}), IMMUTABLE
+    )
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"etag"'
+    assert response.headers["cache-control"] == IMMUTABLE
+    assert "content-type" not in response.headers
+
+
+@pytest.mark.anyio
+async def test_object_response_not_modified_without_cache_control():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = client_error(304)
+
+    response = await object_response(bucket, "key", make_request())
+
+    assert response.status_code == 304
+    assert "cache-control" not in response.headers
+
+
+@pytest.mark.anyio
+async def test_object_response_range_not_satisfiable():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = client_error(416)
+
+    response = await object_response(bucket, "key", make_request())
+
+    assert response.status_code == 416
+
+
+@pytest.mark.anyio
+async def test_object_response_missing_object():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = client_error(404)
+
+    with pytest.raises(HTTPException) as e:
+        await object_response(bucket, "key", make_request())
+
+    assert e.value.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_object_response_upstream_timeout():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = TimeoutError("get_object took over 20s")
+
+    with pytest.raises(HTTPException) as e:
+        await object_response(bucket, "key", make_request({"Range": "bytes=0-1"}))
+
+    assert e.value.status_code == 504
+
+
+@pytest.mark.anyio
+async def test_object_response_open_circuit_is_raised():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = CircuitOpenError("s3:bucket", 30)
+
+    with pytest.raises(CircuitOpenError):
+        await object_response(bucket, "key", make_request({"Range": "bytes=0-1"}))
+
+
+@pytest.mark.anyio
+async def test_head_response():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.head.return_value = ObjectMetadata(42, '"etag"', "image/jpeg", LAST_MODIFIED)
+
+    response = await head_response(bucket, "key", make_request(), IMMUTABLE)
+
+    assert response.status_code == 200
+    assert response.body == b""
+    assert response.headers["content-length"] == "42"
+    assert response.headers["content-type"] == "image/jpeg"
+    assert response.headers["etag"] == '"etag"'
+    assert response.headers["last-modified"] == "Tue, 02 Jan 2024 03:04:05 GMT"
+    assert response.headers["cache-control"] == IMMUTABLE
+    bucket.head.assert_called_once_with("key")
+
+
+@pytest.mark.anyio
+async def test_head_response_not_modified():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.head.return_value = ObjectMetadata(42, '"etag"', "image/jpeg", LAST_MODIFIED)
+    request = make_request({"If-None-Match": '"etag"'})
+
+    response = await head_response(bucket, "key", request)
+
+    assert response.status_code == 304
+    assert "cache-control" not in response.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    ("result", "status_code"),
+    [
+        (None, 404),
+        (client_error(403), 404),
+        (TimeoutError("head_object took over 20s"), 504),
+    ],
+)
+async def test_head_response_errors(result, status_code):
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    if isinstance(result, Exception):
+        bucket.head.side_effect = result
+    else:
+        bucket.head.return_value = result
+
+    with pytest.raises(HTTPException) as e:
+        await head_response(bucket, "key", make_request())
+
+    assert e.value.status_code == status_code
+
+
+@pytest.mark.anyio
+async def test_head_response_open_circuit_is_raised():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.head.side_effect = CircuitOpenError("s3:bucket", 30)
+
+    with pytest.raises(CircuitOpenError):
+        await head_response(bucket, "key", make_request())
+
+
+@pytest.fixture
+def cached_file(tmp_path) -> str:
+    path = tmp_path / "cached"
+    path.write_bytes(b"0123456789")
+    return str(path)
+
+
+CACHED_HEADERS = {
+    "content-type": "application/zip",
+    "etag": '"etag"',
+    "last-modified": "Tue, 02 Jan 2024 03:04:05 GMT",
+}
+
+
+async def send_response(response, method: str = "GET", extensions=None) -> list:
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "extensions": extensions or {}}
+    await response(scope, None, send)
+    return messages
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        ("", None),
+        ("bytes=2-4", (2, 4)),
+        ("bytes=2-", (2, 9)),
+        ("bytes=5-100", (5, 9)),
+        ("bytes=-3", (7, 9)),
+        ("bytes=-30", (0, 9)),
+        ("bytes=4-2", None),
+        ("bytes=0-1,4-5", None),
+    ],
+)
+def test_byte_range(header: str, expected):
+    assert byte_range(make_request({"Range": header}), 10) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=10-", "bytes=-0"])
+def test_byte_range_not_satisfiable(header: str):
+    with pytest.raises(HTTPException) as e:
+        byte_range(make_request({"Range": header}), 10)
+
+    assert e.value.status_code == 416
+    assert e.value.headers == {"content-range": "bytes */10"}
+
+
+@pytest.mark.parametrize(
+    ("headers", "expected"),
+    [
+        ({}, False),
+        ({"If-None-Match": '"etag"'}, True),
+        ({"If-None-Match": '"other", W/"etag"'}, True),
+        ({"If-None-Match": "*"}, True),
+        ({"If-None-Match": '"other"'}, False),
+        ({"If-Modified-Since": "Tue, 02 Jan 2024 03:04:05 GMT"}, True),
+        ({"If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}, False),
+        ({"If-Modified-Since": "yesterday"}, False),
+    ],
+)
+def test_not_modified(headers: dict[str, str], expected: bool):
+    request = make_request(headers)
+
+    assert not_modified(request, '"etag"', CACHED_HEADERS["last-modified"]) is expected
+
+
+@pytest.mark.anyio
+async def test_file_response_full(cached_file: str):
+    response = file_response(cached_file, 10, CACHED_HEADERS, make_request(), IMMUTABLE)
+    messages = await send_response(response)
+
+    assert response.status_code == 200
+    assert response.headers["content-length"] == "10"
+    assert response.headers["content-type"] == "application/zip"
+    assert response.headers["cache-control"] == IMMUTABLE
+    assert response.headers["etag"] == '"etag"'
+    assert b"".join(m["body"] for m in messages[1:]) == b"0123456789"
+
+
+@pytest.mark.anyio
+async def test_file_response_range_in_chunks(cached_file: str):
+    request = make_request({"Range": "bytes=2-8"})
+    response = file_response(cached_file, 10, CACHED_HEADERS, request)
+    with patch("app.downloads.FILE_CHUNK_SIZE", 3):
+        messages = await send_response(response)
+
+    assert response.status_code == 206
+    assert response.headers["content-range"] == "bytes 2-8/10"
+    assert response.headers["content-length"] == "7"
+    assert "cache-control" not in response.headers
+    assert [m["body"] for m in messages[1:]] == [b"234", b"567", b"8"]
+    assert [m["more_body"] for m in messages[1:]] == [True, True, False]
+
+
+@pytest.mark.anyio
+async def test_file_response_zero_copy(cached_file: str):
+    request = make_request({"Range": "bytes=2-"})
+    response = file_response(cached_file, 10, CACHED_HEADERS, request)
+    messages = await send_response(
+        response, extensions={"http.response.zerocopysend": {}}
+    )
+
+    assert messages[1]["type"] == "http.response.zerocopysend"
+    assert messages[1]["offset"] == 2
+    assert messages[1]["count"] == 8
+    assert messages[1]["file"].closed
+
+
+@pytest.mark.anyio
+async def test_file_response_head(cached_file: str):
+    response = file_response(cached_file, 10, CACHED_HEADERS, make_request())
+    messages = await send_response(response, method="HEAD")
+
+    assert messages[1]["body"] == b""
+    assert response.headers["content-length"] == "10"
+
+
+def test_file_response_not_modified(cached_file: str):
+    request = make_request({"If-None-Match": '"etag"'})
+    response = file_response(cached_file, 10, CACHED_HEADERS, request, IMMUTABLE)
+
+    assert response.status_code == 304
+    assert response.headers["etag"] == '"etag"'
+    assert response.headers["cache-control"] == IMMUTABLE
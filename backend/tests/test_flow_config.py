@@ -1,11 +1,15 @@
 import json
+import os
+import shutil
+from glob import glob
 from pathlib import PosixPath
 from typing import cast
 from unittest.mock import patch
 
 import pytest
+from git.exc import GitCommandError
 
-from app.flow_config import get_config, populate, refresh
+from app.flow_config import AWS_REGION, get_config, populate, refresh
 
 
 @pytest.fixture
@@ -31,6 +35,17 @@ def test_happy_path(config: dict[str, dict[str, str]]):
     assert 2 == len(config)
 
 
+def test_populate_keeps_configured_regions(config_source: str, config_file: str):
+    # Regions are resolved when a bucket is first used, never while indexing
+    with patch("app.s3.bucket_region") as bucket_region:
+        populate(source=config_source, destination=config_file)
+    config = cast(dict, get_config("one", config_file=config_file))
+
+    assert config[AWS_REGION] == "eu-west-1"
+    assert AWS_REGION not in cast(dict, get_config("two", config_file=config_file))
+    bucket_region.assert_not_called()
+
+
 def test_populate_ignore_no_survey_props(config: dict[str, dict[str, str]]):
     assert "no_survey_props" not in config
 
@@ -72,10 +87,150 @@ def test_get_config_call_populate_on_no_config_file(
 def test_refresh_pull_git_repo_and_repopulate(config_source: str, config_file: str):
     with patch("app.flow_config.Git") as mocked_git:
         with patch("app.flow_config.populate") as mocked_populate:
+            mocked_git.return_value.rev_parse.return_value = "head"
             refresh(source=config_source, destination=config_file)
             mocked_git.assert_called_with(config_source)
             mocked_git_instance = mocked_git.return_value
             mocked_git_instance.pull.assert_called()
             mocked_populate.assert_called_with(
-                source=config_source, destination=config_file
+                source=config_source, destination=config_file, changed=None
+            )
+
+
+def indexed_head(config_file: str, head: str | None = None) -> str:
+    if head is not None:
+        with open(f"{config_file}.head", "w") as f:
+            f.write(head)
+    with open(f"{config_file}.head") as f:
+        return f.read()
+
+
+@pytest.mark.internal
+@pytest.mark.usefixtures("config")
+def test_refresh_repopulates_changed_instances(config_source: str, config_file: str):
+    indexed_head(config_file, "old")
+    with patch("app.flow_config.Git") as mocked_git:
+        with patch("app.flow_config.populate") as mocked_populate:
+            mocked_git_instance = mocked_git.return_value
+            mocked_git_instance.rev_parse.return_value = "new"
+            mocked_git_instance.diff.return_value = (
+                "example-1/survey.properties\nexample-1/x.json\nREADME.md\n"
+            )
+            refresh(source=config_source, destination=config_file)
+
+            mocked_git_instance.diff.assert_called_with("--name-only", "old", "new")
+            mocked_populate.assert_called_with(
+                source=config_source, destination=config_file, changed={"example-1"}
+            )
+    assert indexed_head(config_file) == "new"
+
+
+@pytest.mark.internal
+@pytest.mark.usefixtures("config")
+def test_refresh_skips_populate_without_new_commits(
+    config_source: str, config_file: str
+):
+    indexed_head(config_file, "head")
+    with patch("app.flow_config.Git") as mocked_git:
+        with patch("app.flow_config.populate") as mocked_populate:
+            mocked_git.return_value.rev_parse.return_value = "head"
+            refresh(source=config_source, destination=config_file)
+
+            mocked_populate.assert_not_called()
+
+
+@pytest.mark.internal
+@pytest.mark.usefixtures("config")
+def test_refresh_retries_after_failed_populate(config_source: str, config_file: str):
+    indexed_head(config_file, "old")
+    with patch("app.flow_config.Git") as mocked_git:
+        with patch("app.flow_config.populate") as mocked_populate:
+            mocked_git_instance = mocked_git.return_value
+            mocked_git_instance.rev_parse.return_value = "new"
+            mocked_git_instance.diff.return_value = "example-1/survey.properties\n"
+            mocked_populate.side_effect = [PermissionError("unreadable"), None]
+            with pytest.raises(PermissionError):
+                refresh(source=config_source, destination=config_file)
+            assert indexed_head(config_file) == "old"
+
+            # Same HEAD after the pull, the changes are still indexed
+            refresh(source=config_source, destination=config_file)
+
+            mocked_populate.assert_called_with(
+                source=config_source, destination=config_file, changed={"example-1"}
             )
+    assert indexed_head(config_file) == "new"
+
+
+@pytest.mark.internal
+@pytest.mark.usefixtures("config")
+def test_refresh_rebuilds_on_unknown_history(config_source: str, config_file: str):
+    indexed_head(config_file, "old")
+    with patch("app.flow_config.Git") as mocked_git:
+        with patch("app.flow_config.populate") as mocked_populate:
+            mocked_git_instance = mocked_git.return_value
+            mocked_git_instance.rev_parse.return_value = "new"
+            mocked_git_instance.diff.side_effect = GitCommandError("diff")
+            refresh(source=config_source, destination=config_file)
+
+            mocked_populate.assert_called_with(
+                source=config_source, destination=config_file, changed=None
+            )
+
+
+def test_populate_reindexes_changed_instances(
+    tmp_path: PosixPath, config_source: str, config_file: str, config
+):
+    source = tmp_path / "source"
+    shutil.copytree(config_source, source)
+    populate(source=str(source), destination=config_file)
+    (source / "example-1" / "survey.properties").write_text(
+        "instanceUrl = https://uno.akvoflow.org\n"
+    )
+
+    populate(
+        source=str(source),
+        destination=config_file,
+        changed=["example-1", "removed-instance"],
+    )
+
+    with open(config_file) as f:
+        reindexed = json.load(f)
+    assert set(reindexed) == {"uno", "two"}
+    assert reindexed["uno"]["instanceUrl"] == "https://uno.akvoflow.org"
+    assert reindexed["two"]["instanceUrl"] == config["two"]["instanceUrl"]
+
+
+@pytest.mark.usefixtures("config")
+def test_get_config_unknown_instance(config_file: str):
+    assert get_config("unknown", config_file=config_file) is None
+
+
+@pytest.mark.internal
+def test_get_config_reuses_loaded_config(config_file: str, config):
+    get_config("one", config_file=config_file)
+    with patch("app.flow_config.json.load") as mocked_load:
+        assert get_config("one", config_file=config_file) == config["one"]
+        assert get_config("unknown", config_file=config_file) is None
+        mocked_load.assert_not_called()
+
+
+def test_populate_keeps_previous_config_on_failure(
+    config_source: str, config_file: str, config
+):
+    with patch("app.flow_config.json.dump", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            populate(source=config_source, destination=config_file)
+
+    with open(config_file) as f:
+        assert json.load(f) == config
+    assert not glob(f"{os.path.dirname(config_file)}/*.tmp")
+
+
+def test_get_config_reloads_changed_config_file(config_file: str, config):
+    get_config("one", config_file=config_file)
+    with open(config_file, "w") as f:
+        json.dump({"three": config["two"]}, f)
+
+    assert get_config("one", config_file=config_file) is None
+    assert get_config("three", config_file=config_file) == config["two"]
@@ -1,11 +1,22 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from unittest.mock import patch
 
-from app.form_validator import FormValidator
+import pytest
+from prometheus_client import REGISTRY
+
+from app.form_validator import (
+    FORM_CACHE_MISS_TTL,
+    FormValidator,
+    _Batcher,
+    get_form_validator,
+)
 
 
 def test_validate_with_entity_exists():
-    with patch("app.form_validator.Credentials.from_service_account_file"):
-        with patch("app.form_validator.Client") as mocked_client:
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
             validator = FormValidator("fake-file.json")
             mocked_client_instance = mocked_client.return_value
             mocked_client_instance.get.return_value = {"value": "fake entity"}
@@ -18,8 +29,8 @@ def test_validate_with_entity_exists():
 
 
 def test_validate_with_entity_not_exists():
-    with patch("app.form_validator.Credentials.from_service_account_file"):
-        with patch("app.form_validator.Client") as mocked_client:
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
             validator = FormValidator("fake-file.json")
             mocked_client_instance = mocked_client.return_value
             mocked_client_instance.get.return_value = None
@@ -29,3 +40,195 @@ def test_validate_with_entity_not_exists():
             mocked_client_instance.key.asssert_called()
             mocked_client_instance.get.asssert_called()
             assert not result
+
+
+def lookups(result: str) -> float:
+    labels = {"credentials": "cached-file.json", "result": result}
+    name = "flow_s3_proxy_form_cache_lookups_total"
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_validate_caches_existing_forms():
+    hits, misses = lookups("hit"), lookups("miss")
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
+            validator = FormValidator("/config/instance/cached-file.json")
+            mocked_client_instance = mocked_client.return_value
+            mocked_client_instance.get.return_value = {"value": "fake entity"}
+
+            assert validator.validate(123)
+            assert validator.validate(123)
+
+            mocked_client_instance.get.assert_called_once()
+            assert lookups("hit") == hits + 1
+            assert lookups("miss") == misses + 1
+
+
+def test_validate_caches_missing_forms_with_miss_ttl():
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
+            validator = FormValidator("fake-file.json")
+            mocked_client_instance = mocked_client.return_value
+            mocked_client_instance.get.return_value = None
+
+            with patch("app.cache.time.monotonic", return_value=100.0):
+                assert not validator.validate(123)
+                assert not validator.validate(123)
+            with patch(
+                "app.cache.time.monotonic",
+                return_value=100.0 + FORM_CACHE_MISS_TTL,
+            ):
+                assert not validator.validate(123)
+
+            assert mocked_client_instance.get.call_count == 2
+
+
+def test_prime_caches_existing_forms():
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
+            validator = FormValidator("fake-file.json")
+            query = mocked_client.return_value.query.return_value
+            query.fetch.return_value = [
+                SimpleNamespace(key=SimpleNamespace(id=1)),
+                SimpleNamespace(key=SimpleNamespace(id=2)),
+            ]
+
+            assert validator.prime(10) == 2
+            assert validator.validate(1)
+            assert validator.validate(2)
+
+            query.keys_only.assert_called_once()
+            query.fetch.assert_called_once_with(limit=10)
+            mocked_client.return_value.get.assert_not_called()
+
+
+def test_prime_without_limit_only_creates_client():
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
+            assert FormValidator("fake-file.json").prime(0) == 0
+
+            mocked_client.assert_called_once()
+            mocked_client.return_value.query.assert_not_called()
+
+
+def test_get_form_validator_is_shared_per_credential_file():
+    assert get_form_validator("one.json") is get_form_validator("one.json")
+    assert get_form_validator("one.json") is not get_form_validator("two.json")
+
+
+class FakeDatastoreClient:
+    def __init__(self, existing: set[int]):
+        self.existing = existing
+        self.rpcs: list[list[int]] = []
+        self.lock = threading.Lock()
+
+    def key(self, kind: str, id: int) -> SimpleNamespace:
+        return SimpleNamespace(kind=kind, id=id)
+
+    def get(
+        self, key: SimpleNamespace, timeout: float | None = None
+    ) -> SimpleNamespace | None:
+        with self.lock:
+            self.rpcs.append([key.id])
+        return SimpleNamespace(key=key) if key.id in self.existing else None
+
+    def get_multi(
+        self, keys: list[SimpleNamespace], timeout: float | None = None
+    ) -> list[SimpleNamespace]:
+        with self.lock:
+            self.rpcs.append([key.id for key in keys])
+        return [SimpleNamespace(key=key) for key in keys if key.id in self.existing]
+
+
+def validate_concurrently(validator: FormValidator, form_ids: list[int]) -> list[bool]:
+    with ThreadPoolExecutor(max_workers=len(form_ids)) as executor:
+        return list(executor.map(validator.validate, form_ids))
+
+
+def test_validate_batches_concurrent_lookups():
+    fake_client = FakeDatastoreClient({1, 2})
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client", return_value=fake_client):
+            with patch("app.form_validator.FORM_BATCH_WINDOW", 0.2):
+                validator = FormValidator("fake-file.json")
+
+            results = validate_concurrently(validator, [1, 2, 3, 1, 2, 3])
+
+            assert results == [True, True, False, True, True, False]
+            assert len(fake_client.rpcs) == 1
+            assert sorted(fake_client.rpcs[0]) == [1, 2, 3]
+
+
+def test_validate_single_lookup_uses_get():
+    fake_client = FakeDatastoreClient({1})
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client", return_value=fake_client):
+            validator = FormValidator("fake-file.json")
+
+            assert validator.validate(1)
+            assert not validator.validate(2)
+            assert fake_client.rpcs == [[1], [2]]
+
+
+def test_validate_counts_datastore_errors():
+    before = REGISTRY.get_sample_value("flow_s3_proxy_datastore_errors_total") or 0
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client") as mocked_client:
+            mocked_client.return_value.get.side_effect = RuntimeError("unavailable")
+            validator = FormValidator("fake-file.json")
+
+            with pytest.raises(RuntimeError):
+                validator.validate(1)
+
+    after = REGISTRY.get_sample_value("flow_s3_proxy_datastore_errors_total")
+    assert after == before + 1
+
+
+def test_validate_batches_flush_when_full():
+    fake_client = FakeDatastoreClient({1, 2, 3, 4})
+    with patch("google.oauth2.service_account.Credentials.from_service_account_file"):
+        with patch("google.cloud.datastore.Client", return_value=fake_client):
+            with patch("app.form_validator.FORM_BATCH_WINDOW", 60):
+                with patch("app.form_validator.FORM_BATCH_SIZE", 2):
+                    validator = FormValidator("fake-file.json")
+
+            results = validate_concurrently(validator, [1, 2, 3, 4])
+
+            assert results == [True, True, True, True]
+            assert sorted(len(rpc) for rpc in fake_client.rpcs) == [2, 2]
+
+
+@pytest.mark.internal
+def test_batcher_shares_in_flight_lookups():
+    started = threading.Event()
+    release = threading.Event()
+    calls: list[list[int]] = []
+
+    def fetch(form_ids: list[int]) -> list[int]:
+        calls.append(form_ids)
+        started.set()
+        release.wait()
+        return form_ids
+
+    batcher = _Batcher(fetch, 0, 10)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(batcher.get, 1)
+        started.wait()
+        second = executor.submit(batcher.get, 1)
+        release.set()
+
+        assert first.result() and second.result()
+    assert calls == [[1]]
+
+
+@pytest.mark.internal
+def test_batcher_propagates_errors_to_batch():
+    def fetch(_: list[int]) -> list[int]:
+        raise RuntimeError("datastore unavailable")
+
+    batcher = _Batcher(fetch, 0, 10)
+
+    with pytest.raises(RuntimeError):
+        batcher.get(1)
+    with pytest.raises(RuntimeError):
+        batcher.get(1)
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import io
+import threading
+from datetime import UTC, datetime
+from unittest.mock import Mock
+
+import anyio
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+from PIL import Image
+from prometheus_client import REGISTRY
+from starlette.requests import Request
+
+from app import images
+from app.images import (
+    Variant,
+    parse_variant,
+    read_source,
+    render,
+    store_variant,
+    variant_response,
+)
+from app.s3 import ObjectMetadata, S3Bucket
+
+
+def image_bytes(size: tuple[int, int], mode: str = "RGB", **params) -> bytes:
+    output = io.BytesIO()
+    Image.new(mode, size).save(output, params.pop("format", "png"), **params)
+    return output.getvalue()
+
+
+def test_parse_variant_defaults():
+    assert parse_variant(None, None, None, None) is None
+    assert parse_variant(320, None, None, None) == Variant(320, None, 75, "jpeg")
+    assert parse_variant(None, 160, 90, "webp") == Variant(None, 160, 90, "webp")
+
+
+@pytest.mark.parametrize(
+    ("width", "height", "quality", "image_format", "detail"),
+    [
+        (321, None, None, None, "w must be one of [160, 320, 640, 1280]"),
+        (None, 10000, None, None, "h must be one of [160, 320, 640, 1280]"),
+        (None, None, 100, None, "q must be one of [50, 75, 90]"),
+        (None, None, None, "gif", "format must be one of ['jpeg', 'png', 'webp']"),
+    ],
+)
+def test_parse_variant_allows_bounded_set(width, height, quality, image_format, detail):
+    with pytest.raises(HTTPException) as e:
+        parse_variant(width, height, quality, image_format)
+
+    assert e.value.status_code == 422
+    assert e.value.detail == detail
+
+
+def test_variant_key():
+    variant = Variant(None, 160, 75, "webp")
+
+    key = variant.key("a.jpg", '"abc"')
+
+    assert key == "derivatives/images/a.jpg/abc/0x160-q75.webp"
+
+
+@pytest.mark.parametrize(
+    ("variant", "size", "mode"),
+    [
+        (Variant(320, None, 75, "jpeg"), (320, 240), "RGB"),
+        (Variant(None, 160, 50, "webp"), (213, 160), "RGBA"),
+        (Variant(1280, 1280, 90, "png"), (800, 600), "RGBA"),
+    ],
+)
+def test_render_fits_within_bounds(variant, size, mode):
+    with Image.open(io.BytesIO(render(image_bytes((800, 600), "RGBA"), variant))) as im:
+        assert im.format == variant.format.upper()
+        assert im.size == size
+        assert im.mode == mode
+
+
+def test_render_applies_exif_rotation():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees clockwise
+    data = image_bytes((800, 600), format="jpeg", exif=exif)
+
+    with Image.open(io.BytesIO(render(data, Variant(160, 160, 75, "jpeg")))) as im:
+        assert im.size == (120, 160)
+
+
+def test_read_source_limits_size():
+    body = Mock()
+    bucket = Mock(spec=S3Bucket)
+    bucket.download.return_value = {"ContentLength": 64 * 1024 * 1024, "Body": body}
+
+    with pytest.raises(HTTPException) as e:
+        read_source(bucket, "images/a.jpg")
+
+    assert e.value.status_code == 413
+    body.close.assert_called_once()
+    body.read.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_store_variant_failures_are_counted():
+    labels = {"operation": "put_object", "code": "SlowDown"}
+    before = REGISTRY.get_sample_value("flow_s3_proxy_s3_errors_total", labels) or 0
+    bucket = Mock(spec=S3Bucket)
+    bucket.multipart_upload.return_value.complete.side_effect = ClientError(
+        {"Error": {"Code": "SlowDown"}}, "PutObject"
+    )
+
+    await store_variant(bucket, "derivatives/images/a.jpg/0x160-q75.webp", b"", "x/y")
+
+    assert REGISTRY.get_sample_value("flow_s3_proxy_s3_errors_total", labels) == (
+        before + 1
+    )
+    bucket.multipart_upload.assert_called_once_with(
+        "derivatives/images/a.jpg/0x160-q75.webp", {"ContentType": "x/y"}
+    )
+
+
+def source_bucket(release: threading.Event) -> Mock:
+    data = image_bytes((800, 600))
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.head.return_value = ObjectMetadata(
+        len(data), '"source"', "image/png", datetime(2024, 1, 2, tzinfo=UTC)
+    )
+    bucket.missed = threading.Event()
+    bucket.started = threading.Event()
+
+    def download(key: str) -> dict:
+        if key.startswith("derivatives/"):
+            bucket.missed.set()
+            raise ClientError(
+                {"Error": {}, "ResponseMetadata": {"HTTPStatusCode": 404}}, "GetObject"
+            )
+        bucket.started.set()
+        release.wait(5)
+        return {"Body": Mock(read=Mock(return_value=data)), "ContentLength": len(data)}
+
+    bucket.download.side_effect = download
+    return bucket
+
+
+def get_variant(bucket: Mock) -> "asyncio.Task":
+    request = Request({"type": "http", "method": "GET", "headers": []})
+    variant = Variant(320, None, 75, "jpeg")
+    return asyncio.create_task(variant_response(bucket, "a.png", variant, request))
+
+
+@pytest.mark.anyio
+async def test_concurrent_requests_generate_a_variant_once():
+    release = threading.Event()
+    bucket = source_bucket(release)
+    requests = [get_variant(bucket) for _ in range(3)]
+    # The stored variant is looked up once for all, then generated once for all
+    assert await anyio.to_thread.run_sync(bucket.missed.wait, 5)
+    await asyncio.sleep(0.05)
+    release.set()
+    responses = await asyncio.gather(*requests)
+    await asyncio.gather(*images._tasks)
+
+    assert len({response.body for response in responses}) == 1
+    etag = f'"{hashlib.md5(responses[0].body).hexdigest()}"'
+    for response in responses:
+        assert response.headers["etag"] == etag
+        assert response.headers["cache-control"] == "no-cache"
+        assert "last-modified" in response.headers
+    bucket.download.assert_any_call("images/a.png")
+    assert bucket.download.call_count == 2
+    bucket.multipart_upload.assert_called_once_with(
+        "derivatives/images/a.png/source/320x0-q75.jpeg", {"ContentType": "image/jpeg"}
+    )
+    assert images._rendering == {}
+
+
+@pytest.mark.internal
+@pytest.mark.anyio
+async def test_cancelled_generation_is_forgotten():
+    release = threading.Event()
+    bucket = source_bucket(release)
+    request = get_variant(bucket)
+    assert await anyio.to_thread.run_sync(bucket.started.wait, 5)
+    for task in images._tasks:
+        task.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await request
+    release.set()
+    assert images._rendering == {}
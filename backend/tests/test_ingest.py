@@ -0,0 +1,299 @@
+import base64
+import hashlib
+import threading
+import time
+from collections.abc import AsyncIterator
+from unittest.mock import Mock, patch
+
+import anyio
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+from starlette.requests import Request
+
+from app.ingest import bulk_upload, multipart_reader, open_upload, stream_upload
+from app.messages import MessageStatus
+
+BOUNDARY = "fake-boundary"
+
+
+def make_request(
+    chunks: list[bytes], content_type: str | None, headers: list | None = None
+) -> Request:
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": True} for chunk in chunks
+    ] + [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    headers = list(headers or [])
+    if content_type:
+        headers.append((b"content-type", content_type.encode()))
+    return Request({"type": "http", "method": "PUT", "headers": headers}, receive)
+
+
+def multipart_body(*parts: tuple, closed: bool = True) -> bytes:
+    body = b""
+    for name, content_type, data, *filename in parts:
+        body += f"--{BOUNDARY}\r\n".encode()
+        disposition = f'form-data; name="{name}"'
+        if (filename or ["f"])[0]:
+            disposition += f'; filename="{(filename or ["f"])[0]}"'
+        body += f"Content-Disposition: {disposition}\r\n".encode()
+        if content_type:
+            body += f"Content-Type: {content_type}\r\n".encode()
+        body += b"\r\n" + data + b"\r\n"
+    if closed:
+        body += f"--{BOUNDARY}--\r\n".encode()
+    return body
+
+
+def split(data: bytes, size: int) -> list[bytes]:
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+async def collect(chunks: AsyncIterator[bytes]) -> bytes:
+    return b"".join([chunk async for chunk in chunks])
+
+
+@pytest.mark.anyio
+async def test_open_upload_raw_body():
+    request = make_request([b"one", b"two"], "image/jpeg")
+
+    source = await open_upload(request)
+
+    assert source.content_type == "image/jpeg"
+    assert await collect(source.chunks) == b"onetwo"
+
+
+@pytest.mark.anyio
+async def test_open_upload_raw_body_without_content_type():
+    source = await open_upload(make_request([b"data"], None))
+
+    assert source.content_type == "application/octet-stream"
+
+
+@pytest.mark.anyio
+async def test_open_upload_streams_multipart_file_field():
+    content = bytes(range(256)) * 64
+    body = multipart_body(("other", None, b"ignored"), ("file", "image/png", content))
+    content_type = f"multipart/form-data; boundary={BOUNDARY}"
+    request = make_request(split(body, 100), content_type)
+
+    source = await open_upload(request)
+
+    assert source.content_type == "image/png"
+    assert await collect(source.chunks) == content
+
+
+@pytest.mark.anyio
+async def test_open_upload_reads_content_md5():
+    digest = hashlib.md5(b"data").digest()
+    header = (b"content-md5", base64.b64encode(digest))
+    source = await open_upload(make_request([b"data"], None, [header]))
+
+    assert source.md5 == digest.hex()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("value", [b"not base64!", base64.b64encode(b"short")])
+async def test_open_upload_rejects_invalid_content_md5(value):
+    request = make_request([b"data"], None, [(b"content-md5", value)])
+
+    with pytest.raises(HTTPException) as e:
+        await open_upload(request)
+
+    assert e.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_open_upload_missing_field():
+    body = multipart_body(("other", None, b"ignored"))
+    request = make_request([body], f"multipart/form-data; boundary={BOUNDARY}")
+
+    with pytest.raises(HTTPException) as e:
+        await open_upload(request)
+
+    assert e.value.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_open_upload_missing_boundary():
+    with pytest.raises(HTTPException) as e:
+        await open_upload(make_request([b""], "multipart/form-data"))
+
+    assert e.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_open_upload_truncated_multipart():
+    body = multipart_body(("file", None, b"content"), closed=False)
+    body = body[: -len(b"\r\n")]
+    request = make_request([body], f"multipart/form-data; boundary={BOUNDARY}")
+
+    source = await open_upload(request)
+    with pytest.raises(HTTPException) as e:
+        await collect(source.chunks)
+
+    assert e.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_open_upload_malformed_multipart():
+    request = make_request([b"garbage"], f"multipart/form-data; boundary={BOUNDARY}")
+
+    with pytest.raises(HTTPException) as e:
+        await open_upload(request)
+
+    assert e.value.status_code == 400
+
+
+async def chunks_of(*chunks: bytes) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_stream_upload_sends_fixed_size_parts():
+    upload = Mock()
+    with patch("app.ingest.UPLOAD_PART_SIZE", 4):
+        await stream_upload(chunks_of(b"ab", b"cd", b"efghi", b"j"), upload)
+
+    assert [c.args[0] for c in upload.upload_part.call_args_list] == [
+        b"abcd",
+        b"efghi",
+    ]
+    upload.complete.assert_called_once_with(b"j")
+    upload.abort.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_aborts_on_error():
+    async def failing_chunks() -> AsyncIterator[bytes]:
+        yield b"data"
+        raise RuntimeError("client gone")
+
+    upload = Mock()
+    with pytest.raises(RuntimeError):
+        await stream_upload(failing_chunks(), upload)
+
+    upload.complete.assert_not_called()
+    upload.abort.assert_called_once()
+
+
+@pytest.mark.anyio
+async def test_stream_upload_counts_s3_errors():
+    labels = {"operation": "upload", "code": "SlowDown"}
+    before = REGISTRY.get_sample_value("flow_s3_proxy_s3_errors_total", labels) or 0
+    upload = Mock()
+    upload.complete.side_effect = ClientError(
+        {"Error": {"Code": "SlowDown"}}, "PutObject"
+    )
+
+    with pytest.raises(ClientError):
+        await stream_upload(chunks_of(b"data"), upload)
+
+    assert REGISTRY.get_sample_value("flow_s3_proxy_s3_errors_total", labels) == (
+        before + 1
+    )
+    upload.abort.assert_called_once()
+
+
+def bulk_request(*parts: tuple, closed: bool = True) -> Request:
+    body = multipart_body(*parts, closed=closed)
+    if not closed:
+        body = body[: -len(b"\r\n")]
+    return make_request(split(body, 64), f"multipart/form-data; boundary={BOUNDARY}")
+
+
+@pytest.mark.anyio
+async def test_bulk_upload_uploads_files_concurrently():
+    running = peak = 0
+    lock = threading.Lock()
+
+    def complete(_: bytes) -> None:
+        nonlocal running, peak
+        with lock:
+            running += 1
+            peak = max(peak, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    uploads: dict[str, Mock] = {}
+
+    def make_upload(part):
+        uploads[part.filename] = Mock(complete=Mock(side_effect=complete))
+        return uploads[part.filename]
+
+    request = bulk_request(
+        *[("file", "image/jpeg", f"image {i}".encode(), f"{i}.jpg") for i in range(5)],
+        ("other", None, b"ignored"),
+        ("file", "image/jpeg", b"anonymous", None),
+    )
+    with patch("app.ingest.BULK_UPLOAD_CONCURRENCY", 2):
+        results = await bulk_upload(multipart_reader(request), make_upload)
+
+    assert [(r.filename, r.status) for r in results] == [
+        *[(f"{i}.jpg", MessageStatus.SUCCESS) for i in range(5)],
+        ("", MessageStatus.FAIL),
+    ]
+    for i in range(5):
+        uploads[f"{i}.jpg"].complete.assert_called_once_with(f"image {i}".encode())
+    assert peak == 2
+
+
+@pytest.mark.anyio
+async def test_bulk_upload_reports_failed_files():
+    failing = Mock()
+    failing.complete.side_effect = ClientError({"Error": {"Code": "SlowDown"}}, "Put")
+    failing_part = Mock()
+    failing_part.upload_part.side_effect = ClientError({}, "UploadPart")
+    working = Mock()
+    uploads = iter([failing, failing_part, working])
+    request = bulk_request(
+        ("file", "image/jpeg", b"one", "1.jpg"),
+        ("file", "image/jpeg", b"two too long", "2.jpg"),
+        ("file", "image/jpeg", b"six", "3.jpg"),
+    )
+
+    with patch("app.ingest.UPLOAD_PART_SIZE", 4):
+        results = await bulk_upload(multipart_reader(request), lambda _: next(uploads))
+
+    assert [(r.filename, r.status) for r in results] == [
+        ("1.jpg", MessageStatus.ERROR),
+        ("2.jpg", MessageStatus.ERROR),
+        ("3.jpg", MessageStatus.SUCCESS),
+    ]
+    failing.abort.assert_called_once()
+    failing_part.abort.assert_called_once()
+    failing_part.complete.assert_not_called()
+    working.complete.assert_called_once_with(b"six")
+
+
+@pytest.mark.anyio
+async def test_bulk_upload_aborts_pending_uploads_on_truncated_body():
+    release = threading.Event()
+    first = Mock()
+    first.complete.side_effect = lambda _: release.wait()
+    truncated = Mock()
+    uploads = iter([first, truncated])
+    request = bulk_request(
+        ("file", "image/jpeg", b"one", "1.jpg"),
+        ("file", "image/jpeg", b"two", "2.jpg"),
+        closed=False,
+    )
+
+    try:
+        with pytest.raises(HTTPException) as e:
+            with anyio.fail_after(5):
+                await bulk_upload(multipart_reader(request), lambda _: next(uploads))
+    finally:
+        release.set()
+
+    assert e.value.status_code == 400
+    first.abort.assert_called_once()
+    truncated.abort.assert_called_once()
+    truncated.complete.assert_not_called()
@@ -1,20 +1,51 @@
+import base64
+import hashlib
 import io
+import json
+import os
+import zipfile
+from datetime import UTC, datetime
 from unittest.mock import Mock, patch
 
 import pytest
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from moto import mock_aws
+from PIL import Image
+from prometheus_client import REGISTRY
+from starlette.requests import ClientDisconnect
+from starlette.responses import Response
 
 from app.dependencies import provide_make_bucket, provide_make_form_validator
+from app.disk_cache import DiskCache
+from app.downloads import IMMUTABLE, REVALIDATE
+from app.flow_config import DOWNLOAD_REDIRECT
 from app.form_validator import FormValidator
 from app.main import app
-from app.s3 import S3Bucket
+from app.messages import MessageStatus
+from app.refresh import JobState, RefreshStatus
+from app.resilience import CircuitOpenError
+from app.s3 import ChecksumMismatchError, ObjectMetadata, S3Bucket, clear_clients
+from app.sessions import UPLOAD_CHUNK_MAX_SIZE
+from app.warmup import WarmUp
 
 client = TestClient(app)
 
+SERVED = "flow_s3_proxy_survey_cache_served_bytes_total"
+
+
+@pytest.fixture(autouse=True)
+def fake_survey_cache(tmp_path):
+    fake_survey_cache = DiskCache(str(tmp_path), 1024 * 1024)
+    with patch("app.main.survey_cache", fake_survey_cache):
+        yield fake_survey_cache
+
 
 @pytest.fixture
 def fake_bucket():
-    fake_bucket = Mock(spec=S3Bucket)
+    fake_bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
     app.dependency_overrides[provide_make_bucket] = lambda: lambda *_: fake_bucket
     yield fake_bucket
     del app.dependency_overrides[provide_make_bucket]
@@ -36,6 +67,24 @@ def test_healtz():
     assert {"status": "success", "message": "OK!"} == response.json()
 
 
+def test_ready_once_warmed_up():
+    warm_up = WarmUp((), 0)
+
+    with patch("app.main.warm_up", warm_up):
+        response = client.get("/ready")
+        assert response.status_code == 503
+        assert response.json()["state"] == "pending"
+        with patch.object(WarmUp, "ready", True):
+            response = client.get("/ready")
+
+    assert response.status_code == 200
+
+
+def test_lifespan_starts_warm_up():
+    with patch("app.main.warm_up") as warm_up, TestClient(app):
+        warm_up.start.assert_called_once()
+
+
 def test_put_devicezip_should_call_bucket_upload(fake_bucket, fake_validator):
     fake_config = {"content": "not important"}
     file_name = "test.txt"
@@ -49,10 +98,11 @@ def test_put_devicezip_should_call_bucket_upload(fake_bucket, fake_validator):
         )
 
         fake_validator.validate.assert_called_with(123)
-        fake_bucket.upload.assert_called()
-        (_first_arg, second_arg, third_arg), _kwargs = fake_bucket.upload.call_args
-        assert second_arg == f"devicezip/{file_name}"
-        assert third_arg == {"ContentType": file_content_type}
+        fake_bucket.multipart_upload.assert_called_with(
+            f"devicezip/{file_name}", {"ContentType": file_content_type}, None
+        )
+        fake_upload = fake_bucket.multipart_upload.return_value
+        fake_upload.complete.assert_called_with(b"<file content>")
 
 
 def test_put_devicezip_with_invalid_instance_returns_404(fake_bucket):
@@ -64,7 +114,7 @@ def test_put_devicezip_with_invalid_instance_returns_404(fake_bucket):
         )
 
         assert response.status_code == 404
-        fake_bucket.upload.assert_not_called()
+        fake_bucket.multipart_upload.assert_not_called()
 
 
 def test_put_images_should_call_bucket_upload(fake_bucket, fake_validator):
@@ -80,10 +130,301 @@ def test_put_images_should_call_bucket_upload(fake_bucket, fake_validator):
         )
 
         fake_validator.validate.assert_called_with(123)
-        fake_bucket.upload.assert_called()
-        (_first_arg, second_arg, third_arg), _kwargs = fake_bucket.upload.call_args
-        assert second_arg == f"images/{file_name}"
-        assert third_arg == {"ContentType": file_content_type, "ACL": "public-read"}
+        fake_bucket.multipart_upload.assert_called_with(
+            f"images/{file_name}",
+            {"ContentType": file_content_type, "ACL": "public-read"},
+            None,
+        )
+        fake_upload = fake_bucket.multipart_upload.return_value
+        fake_upload.complete.assert_called_with(b"<file content>")
+
+
+def test_put_images_with_raw_body_should_stream_to_bucket(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        response = client.put(
+            "/instance1/images/123/test.jpg",
+            content=b"<file content>",
+            headers={"Content-Type": "image/jpeg"},
+        )
+
+        assert response.status_code == 201
+        fake_bucket.multipart_upload.assert_called_with(
+            "images/test.jpg", {"ContentType": "image/jpeg", "ACL": "public-read"}, None
+        )
+        fake_upload = fake_bucket.multipart_upload.return_value
+        fake_upload.complete.assert_called_with(b"<file content>")
+
+
+def test_put_images_skips_unchanged_upload(fake_bucket, fake_validator):
+    digest = hashlib.md5(b"<file content>").digest()
+    fake_bucket.stored_md5.return_value = digest.hex()
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        fake_validator.validate.return_value = True
+        response = client.put(
+            "/instance1/images/123/test.jpg",
+            content=b"<file content>",
+            headers={"Content-MD5": base64.b64encode(digest).decode()},
+        )
+
+        assert response.status_code == 201
+        assert response.json()["message"] == "Unchanged"
+        fake_bucket.stored_md5.assert_called_once_with("images/test.jpg")
+        fake_bucket.multipart_upload.assert_not_called()
+
+
+def test_put_images_rejects_corrupted_upload(fake_bucket, fake_validator):
+    digest = hashlib.md5(b"<file content>").digest()
+    fake_bucket.stored_md5.return_value = None
+    fake_upload = fake_bucket.multipart_upload.return_value
+    fake_upload.complete.side_effect = ChecksumMismatchError("Content-MD5 mismatch")
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        fake_validator.validate.return_value = True
+        response = client.put(
+            "/instance1/images/123/test.jpg",
+            content=b"<corrupted>",
+            headers={
+                "Content-MD5": base64.b64encode(digest).decode(),
+                "Content-Type": "image/jpeg",
+            },
+        )
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Content-MD5 mismatch"
+        fake_bucket.multipart_upload.assert_called_with(
+            "images/test.jpg",
+            {"ContentType": "image/jpeg", "ACL": "public-read"},
+            digest.hex(),
+        )
+        fake_upload.abort.assert_called_once()
+
+
+def test_put_images_without_file_field_returns_422(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        response = client.put(
+            "/instance1/images/123/test.jpg",
+            files={"other": ("test.jpg", io.BytesIO(b"<file content>"))},
+        )
+
+        assert response.status_code == 422
+        fake_bucket.multipart_upload.assert_not_called()
+
+
+def test_open_circuit_fails_fast(fake_bucket, fake_validator):
+    fake_validator.validate.side_effect = CircuitOpenError("datastore:x", 12.5)
+    with patch("app.main.get_config", return_value={"content": "x"}):
+        response = client.get("/instance1/surveys/123.zip")
+
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "13"
+    fake_bucket.download.assert_not_called()
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_form_validation_timeout(fake_validator):
+    fake_validator.validate.side_effect = TimeoutError("datastore_get took over 10s")
+    with patch("app.main.get_config", return_value={"content": "x"}):
+        response = client.get("/instance1/surveys/123.zip")
+
+    assert response.status_code == 504
+
+
+def test_post_images_uploads_every_file(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        response = client.post(
+            "/instance1/images/123",
+            files=[
+                ("file", ("a.jpg", io.BytesIO(b"<a>"), "image/jpeg")),
+                ("file", ("b.png", io.BytesIO(b"<b>"), "image/png")),
+            ],
+        )
+
+        assert response.status_code == 201
+        assert [f["filename"] for f in response.json()["files"]] == ["a.jpg", "b.png"]
+        fake_validator.validate.assert_called_once_with(123)
+        fake_bucket.multipart_upload.assert_any_call(
+            "images/a.jpg", {"ContentType": "image/jpeg", "ACL": "public-read"}
+        )
+        fake_bucket.multipart_upload.assert_any_call(
+            "images/b.png", {"ContentType": "image/png", "ACL": "public-read"}
+        )
+
+
+def test_post_images_rejects_filenames_outside_images(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    filenames = ["../devicezip/evil.zip", "a/b.jpg", "..", ".", "ok.jpg"]
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        response = client.post(
+            "/instance1/images/123",
+            files=[("file", (f, io.BytesIO(b"<a>"), "image/jpeg")) for f in filenames],
+        )
+
+    files = response.json()["files"]
+    assert response.status_code == 207
+    assert [(f["filename"], f["status"], f["message"]) for f in files] == [
+        *[(f, "fail", "Invalid filename") for f in filenames[:-1]],
+        ("ok.jpg", "success", None),
+    ]
+    fake_bucket.multipart_upload.assert_called_once_with(
+        "images/ok.jpg", {"ContentType": "image/jpeg", "ACL": "public-read"}
+    )
+
+
+def test_post_images_partial_failure_returns_207(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    fake_bucket.multipart_upload.return_value.complete.side_effect = [
+        None,
+        RuntimeError("S3 unavailable"),
+    ]
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        with patch("app.ingest.BULK_UPLOAD_CONCURRENCY", 1):
+            response = client.post(
+                "/instance1/images/123",
+                files=[
+                    ("file", ("a.jpg", io.BytesIO(b"<a>"), "image/jpeg")),
+                    ("file", ("b.jpg", io.BytesIO(b"<b>"), "image/jpeg")),
+                ],
+            )
+
+        assert response.status_code == 207
+        assert response.json()["status"] == "fail"
+        assert response.json()["message"] == "1 of 2 files failed"
+        assert [f["status"] for f in response.json()["files"]] == ["success", "error"]
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_post_images_requires_multipart_files(fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        raw = client.post("/instance1/images/123", content=b"<file content>")
+        empty = client.post(
+            "/instance1/images/123", files={"other": ("a.jpg", io.BytesIO(b"<a>"))}
+        )
+
+        assert raw.status_code == 415
+        assert empty.status_code == 422
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_post_images_client_disconnect_returns_400(fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        with patch("app.main.bulk_upload", side_effect=ClientDisconnect):
+            fake_validator.validate.return_value = True
+            response = client.post(
+                "/instance1/images/123", files={"file": ("a.jpg", io.BytesIO(b"<a>"))}
+            )
+
+            assert response.status_code == 400
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_put_devicezip_client_disconnect_returns_400(fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        with patch("app.main.open_upload", side_effect=ClientDisconnect):
+            fake_validator.validate.return_value = True
+            response = client.put("/instance1/devicezip/123/test.zip", content=b"")
+
+            assert response.status_code == 400
+
+
+@pytest.fixture
+def moto_bucket():
+    # Moto reports every multipart upload as initiated in 2010, do not sweep them
+    with mock_aws(), patch("app.main.sweep_stale_uploads"):
+        clear_clients()
+        bucket = S3Bucket("flow-bucket", "fake-id", "fake-secret", "us-east-1")
+        bucket.client.create_bucket(Bucket="flow-bucket")
+        app.dependency_overrides[provide_make_bucket] = lambda: lambda *_: bucket
+        yield bucket
+        del app.dependency_overrides[provide_make_bucket]
+        clear_clients()
+
+
+@pytest.mark.usefixtures("fake_validator")
+def test_resumable_upload_session(moto_bucket):
+    url = "/instance1/devicezip/123/big.zip/uploads"
+    first, second = os.urandom(5 * 1024 * 1024), b"tail"
+    with (
+        patch("app.main.get_config", return_value={"content": "not important"}),
+        patch("app.main.sweep_stale_uploads") as sweep,
+    ):
+        opened = client.post(url)
+        assert opened.status_code == 201
+        assert opened.json()["min_chunk_size"] == len(first)
+        assert opened.json()["max_chunk_size"] == UPLOAD_CHUNK_MAX_SIZE
+        sweep.assert_called_once_with(moto_bucket)
+        upload_url = f"{url}/{opened.json()['upload_id']}"
+
+        # Chunks without a Content-Length could not be refused before buffering
+        response = client.put(f"{upload_url}/2", content=iter([second]))
+        assert response.status_code == 411
+
+        response = client.put(f"{upload_url}/2", content=second)
+        assert response.json()["size"] == len(second)
+        assert client.post(f"{upload_url}/complete").status_code == 409
+        digest = base64.b64encode(hashlib.md5(first).digest()).decode()
+        response = client.put(
+            f"{upload_url}/1", content=first, headers={"Content-MD5": digest}
+        )
+        assert response.status_code == 200
+        parts = client.get(upload_url).json()["parts"]
+        assert [(p["part_number"], p["size"]) for p in parts] == [
+            (1, len(first)),
+            (2, len(second)),
+        ]
+        assert client.post(f"{upload_url}/complete?parts=2").status_code == 201
+
+        stored = moto_bucket.download("devicezip/big.zip")
+        assert stored["Body"].read() == first + second
+        assert stored["ContentType"] == "application/zip"
+        assert client.get(upload_url).status_code == 404
+
+
+@pytest.mark.usefixtures("fake_validator")
+def test_abort_upload_session(moto_bucket):
+    url = "/instance1/devicezip/123/big.zip/uploads"
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        upload_url = f"{url}/{client.post(url).json()['upload_id']}"
+
+        assert client.delete(upload_url).status_code == 200
+        assert client.get(upload_url).status_code == 404
+        assert (
+            moto_bucket.client.list_multipart_uploads(Bucket="flow-bucket").get(
+                "Uploads", []
+            )
+            == []
+        )
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_upload_session_part_client_disconnect_returns_400(fake_validator):
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        with patch("app.main.read_chunk", side_effect=ClientDisconnect):
+            fake_validator.validate.return_value = True
+            response = client.put(
+                "/instance1/devicezip/123/big.zip/uploads/upload-id/1", content=b""
+            )
+
+            assert response.status_code == 400
+
+
+def test_upload_session_validates_form(fake_bucket, fake_validator):
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        fake_validator.validate.return_value = False
+        response = client.post("/instance1/devicezip/123/big.zip/uploads")
+
+        assert response.status_code == 404
+        fake_bucket.create_upload.assert_not_called()
 
 
 def test_put_images_with_invalid_instance_returns_404(fake_bucket):
@@ -95,7 +436,7 @@ def test_put_images_with_invalid_instance_returns_404(fake_bucket):
         )
 
         assert response.status_code == 404
-        fake_bucket.upload.assert_not_called()
+        fake_bucket.multipart_upload.assert_not_called()
 
 
 def test_get_survey_form_should_call_bucket_download(fake_bucket, fake_validator):
@@ -120,6 +461,45 @@ def test_get_survey_form_with_version_should_call_bucket_download(
         fake_bucket.download.assert_called_with("surveys/1234567890v12.0.zip")
 
 
+@pytest.mark.usefixtures("fake_bucket")
+def test_get_survey_form_with_version_is_immutable(fake_validator):
+    fake_config = {"content": "not important"}
+    with patch("app.main.get_config", return_value=fake_config):
+        with patch("app.main.object_response") as mocked_response:
+            mocked_response.return_value = Response()
+            fake_validator.validate.return_value = True
+            client.get("/instance1/surveys/1234567890v12.0.zip")
+            client.get("/instance1/surveys/1234567890.zip")
+
+            cache_controls = [c.args[3] for c in mocked_response.call_args_list]
+            assert cache_controls == [IMMUTABLE, REVALIDATE]
+
+
+def test_get_survey_form_with_version_is_served_from_disk_cache(
+    fake_bucket, fake_validator
+):
+    fake_config = {"content": "not important"}
+    fake_bucket.download.side_effect = lambda *_, **__: {
+        "Body": StreamingBody(io.BytesIO(b"survey"), 6),
+        "ContentType": "application/zip",
+        "ContentLength": 6,
+        "ETag": '"etag"',
+        "LastModified": datetime(2024, 1, 2, tzinfo=UTC),
+    }
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        served = REGISTRY.get_sample_value(SERVED) or 0
+        first = client.get("/instance1/surveys/1234567890v12.0.zip")
+        assert fake_bucket.download.call_count == 1
+        second = client.get("/instance1/surveys/1234567890v12.0.zip")
+
+        assert fake_bucket.download.call_count == 1
+        assert first.content == second.content == b"survey"
+        assert second.headers["etag"] == '"etag"'
+        assert second.headers["cache-control"] == IMMUTABLE
+        assert REGISTRY.get_sample_value(SERVED) == served + 6
+
+
 def test_get_survey_form_with_invalid_instance_returns_404(fake_bucket):
     fake_config = {}
     with patch("app.main.get_config", return_value=fake_config):
@@ -147,6 +527,226 @@ def test_get_image_should_call_bucket_download(fake_bucket):
         fake_bucket.download.assert_called_with("images/file.jpg")
 
 
+def test_get_image_redirects_to_presigned_url(fake_bucket):
+    fake_config = {DOWNLOAD_REDIRECT: "true"}
+    fake_bucket.presigned_url.return_value = "https://s3.example/images/file.jpg"
+    with patch("app.main.get_config", return_value=fake_config):
+        response = client.get("/instance1/images/file.jpg", follow_redirects=False)
+
+        assert response.status_code == 307
+        assert response.headers["location"] == "https://s3.example/images/file.jpg"
+        fake_bucket.presigned_url.assert_called_with("images/file.jpg")
+        fake_bucket.download.assert_not_called()
+
+
+def test_head_survey_form_answers_from_metadata(fake_bucket, fake_validator):
+    fake_config = {DOWNLOAD_REDIRECT: "true"}
+    fake_bucket.head.return_value = ObjectMetadata(
+        7, '"etag"', "application/zip", datetime(2024, 1, 2, tzinfo=UTC)
+    )
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = True
+        versioned = client.head("/instance1/surveys/123v4.0.zip")
+        latest = client.head("/instance1/surveys/123.zip")
+
+    assert versioned.status_code == 200
+    assert versioned.headers["content-length"] == "7"
+    assert versioned.headers["cache-control"] == IMMUTABLE
+    assert latest.headers["cache-control"] == REVALIDATE
+    assert latest.content == b""
+    fake_bucket.head.assert_called_with("surveys/123.zip")
+    fake_bucket.presigned_url.assert_not_called()
+
+
+def test_head_survey_form_validates_form(fake_bucket, fake_validator):
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        fake_validator.validate.return_value = False
+        response = client.head("/instance1/surveys/123.zip")
+
+    assert response.status_code == 404
+    fake_bucket.head.assert_not_called()
+
+
+def test_head_image(moto_bucket):
+    moto_bucket.client.put_object(
+        Bucket="flow-bucket", Key="images/a.jpg", Body=b"jpeg", ContentType="image/jpeg"
+    )
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        found = client.head("/instance1/images/a.jpg")
+        missing = client.head("/instance1/images/b.jpg")
+
+    assert found.status_code == 200
+    assert found.headers["content-length"] == "4"
+    assert found.headers["content-type"] == "image/jpeg"
+    assert found.headers["etag"] == f'"{hashlib.md5(b"jpeg").hexdigest()}"'
+    assert "last-modified" in found.headers
+    assert missing.status_code == 404
+
+
+def test_post_image_bundle(moto_bucket):
+    for filename in ("a.jpg", "b.jpg"):
+        moto_bucket.client.put_object(
+            Bucket="flow-bucket", Key=f"images/{filename}", Body=filename.encode()
+        )
+    filenames = ["a.jpg", "c.jpg", "b.jpg", "a.jpg"]
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        response = client.post("/instance1/images.zip", json={"filenames": filenames})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/zip"
+    assert response.headers["content-disposition"] == (
+        'attachment; filename="images.zip"'
+    )
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert sorted(archive.namelist()) == ["a.jpg", "b.jpg", "manifest.json"]
+    assert archive.read("b.jpg") == b"b.jpg"
+    manifest = json.loads(archive.read("manifest.json"))
+    assert manifest["message"] == "1 of 3 files missing"
+
+
+@pytest.mark.usefixtures("fake_bucket")
+def test_post_image_bundle_validates_form(fake_validator):
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        fake_validator.validate.return_value = False
+        invalid = client.post(
+            "/instance1/images.zip", json={"filenames": ["a.jpg"], "form_id": 123}
+        )
+        fake_validator.validate.return_value = True
+        valid = client.post(
+            "/instance1/images.zip", json={"filenames": ["a.jpg"], "form_id": 123}
+        )
+        empty = client.post("/instance1/images.zip", json={"filenames": []})
+
+    assert invalid.status_code == 404
+    assert valid.headers["content-disposition"] == (
+        'attachment; filename="123-images.zip"'
+    )
+    assert empty.status_code == 422
+    fake_validator.validate.assert_called_with(123)
+
+
+def upload_image(bucket: S3Bucket, size: tuple[int, int]) -> str:
+    original = io.BytesIO()
+    Image.new("RGB", size).save(original, "jpeg")
+    original.seek(0)
+    bucket.upload(original, "images/file.jpg")
+    return bucket.head("images/file.jpg").etag.strip('"')
+
+
+def test_get_image_variant_is_generated_once(moto_bucket):
+    etag = upload_image(moto_bucket, (800, 600))
+    url = "/instance1/images/file.jpg?w=320&format=webp"
+    with patch("app.main.get_config", return_value={DOWNLOAD_REDIRECT: "true"}):
+        first = client.get(url)
+        with patch("app.images.render") as render:
+            second = client.get(url)
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers["content-type"] == "image/webp"
+    assert first.content == second.content
+    assert Image.open(io.BytesIO(first.content)).size == (320, 240)
+    stored = moto_bucket.download(f"derivatives/images/file.jpg/{etag}/320x0-q75.webp")
+    assert stored["ContentType"] == "image/webp"
+    render.assert_not_called()
+
+
+def test_get_image_variant_follows_reuploads(moto_bucket):
+    upload_image(moto_bucket, (800, 600))
+    url = "/instance1/images/file.jpg?w=320"
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        first = client.get(url)
+        upload_image(moto_bucket, (600, 800))
+        second = client.get(url)
+
+    assert Image.open(io.BytesIO(first.content)).size == (320, 240)
+    assert Image.open(io.BytesIO(second.content)).size == (320, 427)
+
+
+def test_get_image_variant_of_removed_image(moto_bucket):
+    upload_image(moto_bucket, (800, 600))
+    # Removed by another worker, this one still has its metadata cached
+    moto_bucket.client.delete_object(Bucket="flow-bucket", Key="images/file.jpg")
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        response = client.get("/instance1/images/file.jpg?w=320")
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize(
+    ("error", "status_code"),
+    [
+        (TimeoutError("hedged"), 504),
+        (ClientError({"Error": {"Code": "AccessDenied"}}, "HeadObject"), 404),
+    ],
+)
+def test_get_image_variant_maps_s3_errors(fake_bucket, error, status_code):
+    fake_bucket.head.side_effect = error
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        response = client.get("/instance1/images/file.jpg?w=320")
+
+    assert response.status_code == status_code
+
+
+def test_get_image_variant_of_slow_original(fake_bucket):
+    fake_bucket.download.side_effect = [
+        ClientError({"ResponseMetadata": {"HTTPStatusCode": 404}}, "GetObject"),
+        TimeoutError("hedged"),
+    ]
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        response = client.get("/instance1/images/file.jpg?w=320")
+
+    assert response.status_code == 504
+
+
+def test_get_image_variant_errors(moto_bucket):
+    moto_bucket.client.put_object(
+        Bucket="flow-bucket", Key="images/file.txt", Body=b"not an image"
+    )
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        invalid = client.get("/instance1/images/file.jpg?w=123")
+        missing = client.get("/instance1/images/missing.jpg?w=320")
+        broken = client.get("/instance1/images/file.txt?w=320")
+
+    assert invalid.status_code == 422
+    assert missing.status_code == 404
+    assert broken.status_code == 422
+
+
+def test_get_image_variant_passes_other_errors(fake_bucket):
+    with patch("app.main.get_config", return_value={"content": "not important"}):
+        with patch("app.images.object_response", side_effect=HTTPException(500)):
+            response = client.get("/instance1/images/file.jpg?w=320")
+
+    assert response.status_code == 500
+    fake_bucket.download.assert_not_called()
+
+
+def test_get_survey_form_redirects_when_enabled_globally(fake_bucket, fake_validator):
+    fake_config = {"content": "not important"}
+    fake_bucket.presigned_url.return_value = "https://s3.example/surveys/123.zip"
+    with patch("app.main.get_config", return_value=fake_config):
+        with patch("app.downloads.DOWNLOAD_REDIRECT_ENABLED", True):
+            fake_validator.validate.return_value = True
+            response = client.get(
+                "/instance1/surveys/123v1.0.zip", follow_redirects=False
+            )
+
+            fake_validator.validate.assert_called_with(123)
+            assert response.status_code == 307
+            fake_bucket.presigned_url.assert_called_with("surveys/123v1.0.zip")
+            fake_bucket.download.assert_not_called()
+
+
+def test_get_survey_form_redirect_still_validates_form(fake_bucket, fake_validator):
+    fake_config = {DOWNLOAD_REDIRECT: "true"}
+    with patch("app.main.get_config", return_value=fake_config):
+        fake_validator.validate.return_value = False
+        response = client.get("/instance1/surveys/123.zip", follow_redirects=False)
+
+        assert response.status_code == 404
+        fake_bucket.presigned_url.assert_not_called()
+
+
 def test_get_image_with_invalid_instance_returns_404(fake_bucket):
     fake_config = {}
     with patch("app.main.get_config", return_value=fake_config):
@@ -156,17 +756,33 @@ def test_get_image_with_invalid_instance_returns_404(fake_bucket):
         fake_bucket.download.assert_not_called()
 
 
+def test_get_metrics():
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert "flow_s3_proxy_request_duration_seconds" in response.text
+
+
 def test_get_refresh():
-    with patch("app.main.refresh") as mocked_refresh:
+    with patch("app.main.refresh_job.trigger") as mocked_trigger:
+        mocked_trigger.return_value = RefreshStatus(
+            status=MessageStatus.SUCCESS, state=JobState.SCHEDULED
+        )
         response = client.get("/refresh")
 
-        assert response.status_code == 200
-        mocked_refresh.assert_called_once()
+        assert response.status_code == 202
+        assert response.json()["state"] == "scheduled"
+        mocked_trigger.assert_called_once()
 
 
 def test_post_refresh():
-    with patch("app.main.refresh") as mocked_refresh:
+    with patch("app.main.refresh_job.trigger") as mocked_trigger:
+        mocked_trigger.return_value = RefreshStatus(
+            status=MessageStatus.SUCCESS, state=JobState.RUNNING
+        )
         response = client.post("/refresh")
 
-        assert response.status_code == 200
-        mocked_refresh.assert_called_once()
+        assert response.status_code == 202
+        assert response.json()["state"] == "running"
+        mocked_trigger.assert_called_once()
@@ -0,0 +1,113 @@
+from unittest.mock import patch
+
+import pytest
+from botocore.exceptions import ClientError
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from app.metrics import MetricsMiddleware, error_code, render, timed
+
+
+def sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.put("/{instance}/echo")
+    async def echo(instance: str, request: Request) -> dict[str, str | int]:
+        return {"instance": instance, "size": len(await request.body())}
+
+    return app
+
+
+def test_timed_observes_phase():
+    before = sample("flow_s3_proxy_phase_duration_seconds_count", phase="test")
+
+    with timed("test"):
+        pass
+
+    after = sample("flow_s3_proxy_phase_duration_seconds_count", phase="test")
+    assert after == before + 1
+
+
+def test_error_code():
+    error = ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+
+    assert error_code(error) == "NoSuchKey"
+    assert error_code(ClientError({}, "GetObject")) == "Unknown"
+    assert error_code(TimeoutError()) == "TimeoutError"
+
+
+def test_middleware_records_route_and_instance_bytes():
+    client = TestClient(make_app())
+    labels = {"method": "PUT", "route": "/{instance}/echo", "status": "200"}
+    before = sample("flow_s3_proxy_request_duration_seconds_count", **labels)
+    received = sample("flow_s3_proxy_received_bytes_total", instance="known")
+
+    with patch("app.metrics.get_config", side_effect=lambda i: i == "known" or None):
+        assert client.put("/known/echo", content=b"12345").status_code == 200
+        assert client.put("/unknown/echo", content=b"12345").status_code == 200
+
+    after = sample("flow_s3_proxy_request_duration_seconds_count", **labels)
+    assert after == before + 2
+    assert sample("flow_s3_proxy_received_bytes_total", instance="known") == (
+        received + 5
+    )
+    assert sample("flow_s3_proxy_sent_bytes_total", instance="known") > 0
+    assert sample("flow_s3_proxy_received_bytes_total", instance="unknown") == 0
+    assert sample("flow_s3_proxy_requests_in_flight", method="PUT") == 0
+
+
+def test_middleware_records_unmatched_routes():
+    client = TestClient(make_app())
+    labels = {"method": "GET", "route": "unmatched", "status": "404"}
+    before = sample("flow_s3_proxy_request_duration_seconds_count", **labels)
+
+    assert client.get("/nowhere").status_code == 404
+
+    after = sample("flow_s3_proxy_request_duration_seconds_count", **labels)
+    assert after == before + 1
+
+
+@pytest.mark.internal
+@pytest.mark.anyio
+async def test_middleware_counts_zero_copy_sends():
+    async def app(scope, _receive, send) -> None:
+        scope["path_params"] = {"instance": "zero-copy"}
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.zerocopysend", "count": 42})
+
+    async def send(_) -> None:
+        pass
+
+    with patch("app.metrics.get_config", return_value={"awsBucket": "bucket"}):
+        await MetricsMiddleware(app)({"type": "http", "method": "GET"}, None, send)
+
+    assert sample("flow_s3_proxy_sent_bytes_total", instance="zero-copy") == 42
+
+
+@pytest.mark.internal
+@pytest.mark.anyio
+async def test_middleware_passes_through_other_scopes():
+    calls = []
+
+    async def app(scope, _receive, _send) -> None:
+        calls.append(scope["type"])
+
+    await MetricsMiddleware(app)({"type": "lifespan"}, None, None)
+
+    assert calls == ["lifespan"]
+
+
+def test_render_default_registry():
+    assert b"flow_s3_proxy_request_duration_seconds" in render()
+
+
+def test_render_multiprocess(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    assert b"flow_s3_proxy_request_duration_seconds" not in render()
@@ -0,0 +1,53 @@
+import threading
+import time
+from unittest.mock import Mock
+
+from app.refresh import JobState, RefreshJob, RefreshStatus
+
+
+def wait_until_idle(job: RefreshJob) -> RefreshStatus:
+    deadline = time.monotonic() + 5
+    while (status := job.status()).state != JobState.IDLE:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return status
+
+
+def test_trigger_debounces_refreshes():
+    refresh = Mock()
+    job = RefreshJob(refresh, 0.05)
+
+    statuses = [job.trigger() for _ in range(3)]
+
+    assert [s.state for s in statuses] == [JobState.SCHEDULED] * 3
+    status = wait_until_idle(job)
+    refresh.assert_called_once()
+    assert status.runs == 1
+    assert status.last_started and status.last_finished
+    assert status.last_error is None
+
+
+def test_trigger_while_running_refreshes_again():
+    started = threading.Event()
+    release = threading.Event()
+    refresh = Mock(side_effect=lambda: started.set() or release.wait())
+    job = RefreshJob(refresh, 0)
+
+    job.trigger()
+    started.wait()
+    assert job.trigger().state == JobState.RUNNING
+    assert job.trigger().state == JobState.RUNNING
+    release.set()
+
+    assert wait_until_idle(job).runs == 2
+    assert refresh.call_count == 2
+
+
+def test_refresh_errors_are_reported():
+    job = RefreshJob(Mock(side_effect=RuntimeError("pull failed")), 0)
+
+    job.trigger()
+
+    status = wait_until_idle(job)
+    assert status.runs == 1
+    assert status.last_error == "pull failed"
@@ -0,0 +1,216 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.resilience import (
+    HEDGE_MAX_DELAY,
+    HEDGE_MIN_DELAY,
+    CircuitBreaker,
+    CircuitOpenError,
+    Hedge,
+    breaker,
+    guarded,
+)
+
+
+def sample(name: str, labels: dict[str, str]) -> float:
+    return REGISTRY.get_sample_value(f"flow_s3_proxy_{name}_total", labels) or 0
+
+
+def test_circuit_opens_after_consecutive_failures():
+    clock = Mock(return_value=100.0)
+    circuit = CircuitBreaker("s3:bucket", failures=3, cooldown=30, clock=clock)
+    before = sample("circuit_rejected", {"backend": "s3"})
+
+    for ok in (False, False, True, False, False):
+        circuit.acquire()
+        circuit.record(ok)
+    circuit.acquire()
+    circuit.record(False)
+
+    with pytest.raises(CircuitOpenError) as e:
+        circuit.acquire()
+    assert e.value.retry_after == 30
+    assert sample("circuit_rejected", {"backend": "s3"}) == before + 1
+
+
+def test_open_circuit_probes_once_after_cooldown():
+    clock = Mock(return_value=100.0)
+    circuit = CircuitBreaker("s3:bucket", failures=1, cooldown=30, clock=clock)
+    circuit.record(False)
+
+    clock.return_value = 130.0
+    circuit.acquire()
+    with pytest.raises(CircuitOpenError) as e:
+        circuit.acquire()
+    assert e.value.retry_after == 1
+
+    # A failed probe opens the circuit for another cooldown
+    circuit.record(False)
+    clock.return_value = 159.0
+    with pytest.raises(CircuitOpenError):
+        circuit.acquire()
+    clock.return_value = 160.0
+    circuit.acquire()
+    circuit.record(True)
+    circuit.acquire()
+    circuit.acquire()
+
+
+def test_breakers_are_shared_per_name():
+    assert breaker("s3:one") is breaker("s3:one")
+    assert breaker("s3:one") is not breaker("s3:two")
+
+
+def test_hedge_delay_follows_percentile():
+    hedge = Hedge("op", deadline=10)
+    assert hedge.delay() == HEDGE_MAX_DELAY
+
+    for i in range(100):
+        hedge.observe(i / 1000)
+    assert hedge.delay() == pytest.approx(0.094)
+
+    hedge.clear()
+    for _ in range(100):
+        hedge.observe(0.001)
+    assert hedge.delay() == HEDGE_MIN_DELAY
+    for _ in range(100):
+        hedge.observe(60)
+    assert hedge.delay() == HEDGE_MAX_DELAY
+
+
+def test_fast_calls_are_not_hedged():
+    func = Mock(return_value="result")
+
+    assert Hedge("op", deadline=10).call(func) == "result"
+    func.assert_called_once()
+
+
+def slow_then_fast(release: threading.Event) -> Mock:
+    def first() -> str:
+        release.wait(5)
+        return "slow"
+
+    return Mock(side_effect=[first, lambda: "fast"])
+
+
+def test_slow_calls_race_a_hedge():
+    release = threading.Event()
+    attempts = slow_then_fast(release)
+    discard = Mock()
+    hedge = Hedge("slow_op", deadline=10)
+    before = sample("hedged_requests", {"operation": "slow_op", "winner": "hedge"})
+
+    with patch("app.resilience.HEDGE_MAX_DELAY", 0.01):
+        assert hedge.call(lambda: attempts()(), discard) == "fast"
+    discard.assert_not_called()
+    release.set()
+
+    # The losing attempt's late result is released
+    deadline = time.monotonic() + 5
+    while not discard.called:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    discard.assert_called_once_with("slow")
+    assert sample("hedged_requests", {"operation": "slow_op", "winner": "hedge"}) == (
+        before + 1
+    )
+
+
+def test_hedged_primary_can_still_win():
+    release = threading.Event()
+    primary_started = threading.Event()
+
+    def attempt() -> str:
+        if not primary_started.is_set():
+            primary_started.set()
+            release.wait(5)
+            return "primary"
+        # The primary answers as soon as the hedge is sent, well before it
+        release.set()
+        time.sleep(0.5)
+        return "hedge"
+
+    before = sample("hedged_requests", {"operation": "race", "winner": "primary"})
+    with patch("app.resilience.HEDGE_MAX_DELAY", 0.01):
+        assert Hedge("race", deadline=10).call(attempt) == "primary"
+    assert sample("hedged_requests", {"operation": "race", "winner": "primary"}) == (
+        before + 1
+    )
+
+
+def test_failed_hedge_waits_for_primary():
+    release = threading.Event()
+    failing = Mock(side_effect=OSError("reset"))
+    attempts = Mock(side_effect=[lambda: release.wait(5) and "slow", failing])
+    threading.Timer(0.1, release.set).start()
+
+    with patch("app.resilience.HEDGE_MAX_DELAY", 0.01):
+        assert Hedge("op", deadline=10).call(lambda: attempts()()) == "slow"
+    failing.assert_called_once()
+
+
+def test_hedge_raises_first_error_when_all_fail():
+    errors = iter([ValueError("first"), ValueError("second")])
+
+    def attempt() -> str:
+        time.sleep(0.05)
+        raise next(errors)
+
+    with patch("app.resilience.HEDGE_MAX_DELAY", 0.01):
+        with pytest.raises(ValueError, match="first"):
+            Hedge("op", deadline=10).call(attempt)
+
+
+def test_hedge_deadline():
+    release = threading.Event()
+    discard = Mock()
+
+    # A single thread leaves the hedge queued, it is cancelled
+    with (
+        patch("app.resilience.hedge_executor", ThreadPoolExecutor(1)),
+        patch("app.resilience.HEDGE_MAX_DELAY", 0.01),
+        pytest.raises(TimeoutError, match="op took over 0.1s"),
+    ):
+        Hedge("op", deadline=0.1).call(lambda: release.wait(5) and "late", discard)
+    release.set()
+
+    deadline = time.monotonic() + 5
+    while not discard.called:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    discard.assert_called_once_with("late")
+
+
+def test_guarded_records_outcomes():
+    hedge = Hedge("op", deadline=10)
+    circuit = breaker("test:guarded")
+
+    with patch.object(circuit, "record") as record:
+        assert guarded("test:guarded", hedge, lambda: "ok") == "ok"
+        with pytest.raises(KeyError):
+            guarded(
+                "test:guarded",
+                hedge,
+                Mock(side_effect=KeyError("missing")),
+                is_failure=lambda e: not isinstance(e, KeyError),
+            )
+        with pytest.raises(OSError):
+            guarded("test:guarded", hedge, Mock(side_effect=OSError("reset")))
+
+    assert [c.args for c in record.call_args_list] == [(True,), (True,), (False,)]
+
+
+def test_guarded_fails_fast_while_open():
+    func = Mock()
+    circuit = breaker("test:open")
+    for _ in range(10):
+        circuit.record(False)
+
+    with pytest.raises(CircuitOpenError):
+        guarded("test:open", Hedge("op", deadline=10), func)
+    func.assert_not_called()
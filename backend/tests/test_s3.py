@@ -1,7 +1,42 @@
+import base64
+import hashlib
 import io
+import threading
+import time
+from collections.abc import Iterator
+from datetime import datetime
 from unittest.mock import Mock, patch
 
-from app.s3 import S3Bucket
+import boto3
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from moto import mock_aws
+
+from app.resilience import CircuitOpenError
+from app.s3 import (
+    PRESIGNED_URL_EXPIRES,
+    PRESIGNED_URL_MARGIN,
+    ChecksumMismatchError,
+    S3Bucket,
+    _ClientRegistry,
+    _clients,
+    _session_lock,
+    bucket_region,
+    clear_clients,
+    load_models,
+    resolve_region,
+)
+
+
+def md5_header(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+
+@pytest.fixture(autouse=True)
+def clean_clients() -> Iterator[None]:
+    clear_clients()
+    yield
+    clear_clients()
 
 
 def test_upload():
@@ -30,3 +65,497 @@ def test_download():
         bucket.download(filename)
 
         fake_client.get_object.assert_called_with(Bucket=bucket_name, Key=filename)
+
+
+def get_object_error(status_code: int | None) -> ClientError:
+    metadata = {"HTTPStatusCode": status_code} if status_code else {}
+    return ClientError({"ResponseMetadata": metadata}, "GetObject")
+
+
+@pytest.mark.parametrize(
+    ("error", "failure"),
+    [
+        (get_object_error(404), False),
+        (get_object_error(503), True),
+        (get_object_error(None), True),
+        (OSError("connection reset"), True),
+    ],
+)
+def test_download_failures_open_circuit(error, failure):
+    fake_client = Mock()
+    fake_client.get_object.side_effect = error
+    with (
+        patch("app.s3.boto3.client", return_value=fake_client),
+        patch("app.resilience.CIRCUIT_FAILURES", 1),
+    ):
+        bucket = S3Bucket("circuit-bucket", "fake-id", "fake-secret-key")
+        with pytest.raises(type(error)):
+            bucket.download("test.txt")
+
+        if failure:
+            with pytest.raises(CircuitOpenError):
+                bucket.download("test.txt")
+        else:
+            with pytest.raises(type(error)):
+                bucket.download("test.txt")
+
+
+def test_hedged_download_closes_losing_body():
+    release = threading.Event()
+    slow_body = Mock()
+
+    def get_object(**_) -> dict:
+        if not release.is_set():
+            release.set()
+            time.sleep(0.2)
+            return {"Body": slow_body}
+        return {"Body": Mock()}
+
+    fake_client = Mock()
+    fake_client.get_object.side_effect = get_object
+    with (
+        patch("app.s3.boto3.client", return_value=fake_client),
+        patch("app.resilience.HEDGE_MAX_DELAY", 0.01),
+    ):
+        res = S3Bucket("fake_bucket", "fake-id", "fake-secret-key").download("k")
+
+    assert res["Body"] is not slow_body
+    deadline = time.monotonic() + 5
+    while not slow_body.close.called:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_buckets_share_client():
+    with patch("app.s3.boto3.client") as mocked_client:
+        first = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        second = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+
+        mocked_client.assert_called_once()
+        assert first.client is second.client
+
+
+def test_rotated_credentials_replace_client():
+    with patch("app.s3.boto3.client", side_effect=lambda *_, **__: Mock()):
+        first = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        rotated_secret = S3Bucket("fake_bucket", "fake-id", "new-secret-key")
+        rotated_id = S3Bucket("fake_bucket", "new-id", "new-secret-key")
+
+        assert first.client is not rotated_secret.client
+        assert rotated_secret.client is not rotated_id.client
+
+
+@pytest.mark.internal
+def test_load_models_does_not_register_clients():
+    load_models()
+
+    assert len(_clients) == 0
+
+
+@pytest.mark.parametrize(
+    ("bucket", "region", "url"),
+    [
+        ("flow-bucket", None, "https://flow-bucket.s3.amazonaws.com/key?"),
+        (
+            "flow-bucket",
+            "eu-west-1",
+            "https://flow-bucket.s3.eu-west-1.amazonaws.com/key?X-Amz-Algorithm=",
+        ),
+        (
+            "flow.bucket",
+            "eu-west-1",
+            "https://s3.eu-west-1.amazonaws.com/flow.bucket/key?X-Amz-Algorithm=",
+        ),
+    ],
+)
+def test_region_pinned_clients_address_regional_endpoint(bucket, region, url):
+    s3_bucket = S3Bucket(bucket, "fake-id", "fake-secret", region)
+
+    assert s3_bucket.presigned_url("key").startswith(url)
+
+
+@mock_aws
+@pytest.mark.parametrize("region", ["us-east-1", "eu-west-1", "ap-southeast-2"])
+def test_bucket_region(region):
+    client = boto3.client("s3", region_name=region)
+    if region == "us-east-1":
+        client.create_bucket(Bucket="flow-bucket")
+    else:
+        client.create_bucket(
+            Bucket="flow-bucket",
+            CreateBucketConfiguration={"LocationConstraint": region},
+        )
+
+    assert bucket_region("flow-bucket", "fake-id", "fake-secret") == region
+
+
+def test_bucket_region_maps_legacy_locations():
+    fake_client = Mock()
+    fake_client.get_bucket_location.return_value = {"LocationConstraint": "EU"}
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        assert bucket_region("flow-bucket", "fake-id", "fake-secret") == "eu-west-1"
+
+
+def test_resolve_region_looks_up_each_bucket_once():
+    with patch("app.s3.bucket_region", return_value="eu-west-1") as lookup:
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") == "eu-west-1"
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") == "eu-west-1"
+        clear_clients()
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") == "eu-west-1"
+
+    assert lookup.call_count == 2
+
+
+def test_resolve_region_once_for_concurrent_requests():
+    started = threading.Event()
+    release = threading.Event()
+
+    def lookup(*_) -> str:
+        started.set()
+        release.wait(5)
+        return "eu-west-1"
+
+    with patch("app.s3.bucket_region", side_effect=lookup) as bucket_region:
+        threads = [
+            threading.Thread(target=resolve_region, args=("flow-bucket", "id", "s"))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        assert started.wait(5)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+    bucket_region.assert_called_once()
+
+
+def test_clients_are_built_one_at_a_time():
+    def client(*_, **__) -> Mock:
+        assert _session_lock.locked()
+        return Mock(get_bucket_location=Mock(return_value={}))
+
+    with patch("app.s3.boto3.client", side_effect=client) as build:
+        S3Bucket("flow-bucket", "fake-id", "fake-secret", None)
+        bucket_region("flow-bucket", "fake-id", "fake-secret")
+        load_models()
+
+    assert build.call_count == 3
+
+
+def test_resolve_region_failures():
+    denied = ClientError({"Error": {"Code": "AccessDenied"}}, "GetBucketLocation")
+    unreachable = EndpointConnectionError(endpoint_url="https://s3.amazonaws.com")
+    with patch("app.s3.bucket_region", side_effect=[unreachable, denied]) as lookup:
+        # Connection errors are retried, missing permissions are not
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") is None
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") is None
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") is None
+
+    assert lookup.call_count == 2
+
+
+def test_resolve_region_disabled():
+    with (
+        patch("app.s3.BUCKET_REGION_LOOKUP", False),
+        patch("app.s3.bucket_region") as lookup,
+    ):
+        assert resolve_region("flow-bucket", "fake-id", "fake-secret") is None
+
+    lookup.assert_not_called()
+
+
+def test_client_registry_evicts_least_recently_used():
+    registry = _ClientRegistry(2)
+    with patch("app.s3.boto3.client", side_effect=lambda *_, **__: Mock()):
+        one = registry.get("one", "id", "secret", None)
+        two = registry.get("two", "id", "secret", None)
+        assert registry.get("one", "id", "secret", None) is one
+        registry.get("three", "id", "secret", None)
+
+        assert len(registry) == 2
+        assert registry.get("one", "id", "secret", None) is one
+        assert registry.get("two", "id", "secret", None) is not two
+
+
+@mock_aws
+def test_head_caches_metadata_until_overwritten():
+    bucket = S3Bucket("flow-bucket", "fake-id", "fake-secret", "us-east-1")
+    bucket.client.create_bucket(Bucket="flow-bucket")
+
+    assert bucket.head("a.txt") is None
+    bucket.upload(io.BytesIO(b"first"), "a.txt", {"ContentType": "text/plain"})
+    with patch.object(bucket.client, "head_object", wraps=bucket.client.head_object):
+        metadata = bucket.head("a.txt")
+        assert bucket.head("a.txt") is metadata
+        bucket.client.head_object.assert_called_once()
+
+    assert metadata.size == 5
+    assert metadata.etag == f'"{hashlib.md5(b"first").hexdigest()}"'
+    assert metadata.content_type == "text/plain"
+    upload = bucket.multipart_upload("a.txt")
+    upload.complete(b"second")
+    assert bucket.head("a.txt").size == 6
+    upload_id = bucket.create_upload("a.txt", {})
+    etag = bucket.upload_part("a.txt", upload_id, 1, b"third!!")
+    bucket.complete_upload("a.txt", upload_id, [{"ETag": etag, "PartNumber": 1}])
+    assert bucket.head("a.txt").size == 7
+
+
+@pytest.mark.parametrize(("error", "failure"), [(500, True), (403, False)])
+def test_head_errors(error, failure):
+    fake_client = Mock()
+    fake_client.head_object.side_effect = get_object_error(error)
+    with (
+        patch("app.s3.boto3.client", return_value=fake_client),
+        patch("app.resilience.CIRCUIT_FAILURES", 1),
+    ):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        with pytest.raises(ClientError):
+            bucket.head("test.txt")
+
+        with pytest.raises(CircuitOpenError if failure else ClientError):
+            bucket.head("test.txt")
+
+
+def test_multipart_upload_small_body_uses_put_object():
+    fake_client = Mock()
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt", {"ContentType": "text/plain"})
+        upload.complete(b"test")
+        upload.abort()
+
+        fake_client.put_object.assert_called_with(
+            Bucket="fake_bucket",
+            Key="test.txt",
+            Body=b"test",
+            ContentMD5=md5_header(b"test"),
+            ContentType="text/plain",
+        )
+        fake_client.create_multipart_upload.assert_not_called()
+        fake_client.abort_multipart_upload.assert_not_called()
+
+
+def test_multipart_upload_parts():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.side_effect = [{"ETag": "etag-1"}, {"ETag": "etag-2"}]
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt")
+        upload.upload_part(b"first")
+        upload.complete(b"second")
+
+        fake_client.create_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket", Key="test.txt"
+        )
+        fake_client.upload_part.assert_called_with(
+            Bucket="fake_bucket",
+            Key="test.txt",
+            UploadId="upload-id",
+            PartNumber=2,
+            Body=b"second",
+            ContentMD5=md5_header(b"second"),
+        )
+        fake_client.complete_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket",
+            Key="test.txt",
+            UploadId="upload-id",
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": "etag-1", "PartNumber": 1},
+                    {"ETag": "etag-2", "PartNumber": 2},
+                ]
+            },
+        )
+
+
+def test_multipart_upload_abort():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.return_value = {"ETag": "etag-1"}
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt")
+        upload.upload_part(b"first")
+        upload.abort()
+
+        fake_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket", Key="test.txt", UploadId="upload-id"
+        )
+
+
+def test_multipart_upload_complete_without_tail():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.return_value = {"ETag": "etag-1"}
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt")
+        upload.upload_part(b"first")
+        upload.complete()
+
+        fake_client.upload_part.assert_called_once()
+        fake_client.complete_multipart_upload.assert_called_once()
+
+
+def test_multipart_upload_verifies_and_stores_client_md5():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.return_value = {"ETag": "etag"}
+    md5 = hashlib.md5(b"firstsecond").hexdigest()
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt", {"ContentType": "text/plain"}, md5)
+        upload.upload_part(b"first")
+        upload.complete(b"second")
+
+        fake_client.create_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket",
+            Key="test.txt",
+            ContentType="text/plain",
+            Metadata={"md5": md5},
+        )
+        fake_client.complete_multipart_upload.assert_called_once()
+
+
+def test_multipart_upload_rejects_md5_mismatch():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.return_value = {"ETag": "etag"}
+    md5 = hashlib.md5(b"expected").hexdigest()
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        upload = bucket.multipart_upload("test.txt", md5=md5)
+        upload.upload_part(b"first")
+        with pytest.raises(ChecksumMismatchError):
+            upload.complete(b"second")
+        small_upload = bucket.multipart_upload("small.txt", md5=md5)
+        with pytest.raises(ChecksumMismatchError):
+            small_upload.complete(b"corrupted")
+
+        fake_client.complete_multipart_upload.assert_not_called()
+        fake_client.put_object.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    ("head", "expected"),
+    [
+        ({"ETag": '"etag-1"', "Metadata": {"md5": "abc"}}, "abc"),
+        ({"ETag": '"0123abcd"', "Metadata": {}}, "0123abcd"),
+        ({"ETag": '"0123abcd-2"'}, None),
+    ],
+)
+def test_stored_md5(head, expected):
+    fake_client = Mock()
+    fake_client.head_object.return_value = head
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+
+        assert bucket.stored_md5("test.txt") == expected
+        fake_client.head_object.assert_called_once_with(
+            Bucket="fake_bucket", Key="test.txt"
+        )
+
+
+def test_stored_md5_of_missing_object():
+    fake_client = Mock()
+    fake_client.head_object.side_effect = ClientError(
+        {"Error": {"Code": "404"}}, "HeadObject"
+    )
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+
+        assert bucket.stored_md5("test.txt") is None
+        fake_client.head_object.side_effect = ClientError(
+            {"Error": {"Code": "403"}}, "HeadObject"
+        )
+        with pytest.raises(ClientError):
+            bucket.stored_md5("test.txt")
+
+
+def test_upload_session_calls():
+    fake_client = Mock()
+    fake_client.create_multipart_upload.return_value = {"UploadId": "upload-id"}
+    fake_client.upload_part.return_value = {"ETag": "etag"}
+    fake_client.get_paginator.return_value.paginate.return_value = [
+        {"Parts": [{"PartNumber": 1}]},
+        {"Parts": [{"PartNumber": 2}]},
+        {},
+    ]
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+
+        assert bucket.create_upload("key", {"ContentType": "a/b"}) == "upload-id"
+        assert bucket.upload_part("key", "upload-id", 2, b"data") == "etag"
+        md5 = hashlib.md5(b"other").hexdigest()
+        bucket.upload_part("key", "upload-id", 3, b"data", md5)
+        assert bucket.list_parts("key", "upload-id") == [
+            {"PartNumber": 1},
+            {"PartNumber": 2},
+        ]
+        bucket.complete_upload("key", "upload-id", [{"ETag": "e", "PartNumber": 1}])
+        bucket.abort_upload("key", "upload-id")
+
+        fake_client.create_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket", Key="key", ContentType="a/b"
+        )
+        # A client digest goes to S3 as is, rather than ours of what arrived
+        assert [c.kwargs["ContentMD5"] for c in fake_client.upload_part.mock_calls] == [
+            md5_header(b"data"),
+            md5_header(b"other"),
+        ]
+        fake_client.get_paginator.assert_called_once_with("list_parts")
+        fake_client.complete_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket",
+            Key="key",
+            UploadId="upload-id",
+            MultipartUpload={"Parts": [{"ETag": "e", "PartNumber": 1}]},
+        )
+        fake_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket", Key="key", UploadId="upload-id"
+        )
+
+
+def test_abort_uploads_before():
+    fake_client = Mock()
+    fake_client.get_paginator.return_value.paginate.return_value = [
+        {
+            "Uploads": [
+                {"Key": "a", "UploadId": "1", "Initiated": datetime(2024, 1, 1)},
+                {"Key": "b", "UploadId": "2", "Initiated": datetime(2024, 3, 1)},
+            ]
+        },
+        {},
+    ]
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+
+        assert bucket.abort_uploads_before("prefix/", datetime(2024, 2, 1)) == 1
+
+        fake_client.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket="fake_bucket", Prefix="prefix/"
+        )
+        fake_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="fake_bucket", Key="a", UploadId="1"
+        )
+
+
+def test_presigned_url_is_cached_until_shortly_before_expiry():
+    fake_client = Mock()
+    fake_client.generate_presigned_url.side_effect = ["url-1", "url-2"]
+    with patch("app.s3.boto3.client", return_value=fake_client):
+        bucket = S3Bucket("fake_bucket", "fake-id", "fake-secret-key")
+        with patch("app.cache.time.monotonic", return_value=100.0):
+            assert bucket.presigned_url("test.txt") == "url-1"
+            assert bucket.presigned_url("test.txt") == "url-1"
+        expiry = 100.0 + PRESIGNED_URL_EXPIRES - PRESIGNED_URL_MARGIN
+        with patch("app.cache.time.monotonic", return_value=expiry):
+            assert bucket.presigned_url("test.txt") == "url-2"
+
+        fake_client.generate_presigned_url.assert_called_with(
+            "get_object",
+            Params={"Bucket": "fake_bucket", "Key": "test.txt"},
+            ExpiresIn=PRESIGNED_URL_EXPIRES,
+        )
@@ -0,0 +1,151 @@
+from collections.abc import AsyncIterator, Iterator
+from datetime import UTC, datetime, timedelta
+from unittest.mock import Mock, patch
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from fastapi import HTTPException
+from prometheus_client import REGISTRY
+
+from app.s3 import S3Bucket
+from app.sessions import (
+    UPLOAD_SESSION_TTL,
+    clear_sweeps,
+    completed_parts,
+    read_chunk,
+    session_errors,
+    sweep_stale_uploads,
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_sweeps() -> Iterator[None]:
+    clear_sweeps()
+    yield
+    clear_sweeps()
+
+
+def s3_errors(operation: str, code: str) -> float:
+    labels = {"operation": operation, "code": code}
+    return REGISTRY.get_sample_value("flow_s3_proxy_s3_errors_total", labels) or 0
+
+
+def test_session_errors_map_client_mistakes():
+    with pytest.raises(HTTPException) as e, session_errors("upload_part"):
+        raise ClientError({"Error": {"Code": "NoSuchUpload"}}, "UploadPart")
+
+    assert e.value.status_code == 404
+    assert e.value.detail == "NoSuchUpload"
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        ClientError({"Error": {"Code": "SlowDown"}}, "UploadPart"),
+        EndpointConnectionError(endpoint_url="http://s3"),
+    ],
+)
+def test_session_errors_count_s3_failures(error):
+    code = "SlowDown" if isinstance(error, ClientError) else type(error).__name__
+    before = s3_errors("upload_part", code)
+
+    with pytest.raises(type(error)), session_errors("upload_part"):
+        raise error
+
+    assert s3_errors("upload_part", code) == before + 1
+
+
+async def chunks_of(*chunks: bytes) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_read_chunk_limits_size():
+    with patch("app.sessions.UPLOAD_CHUNK_MAX_SIZE", 4):
+        assert await read_chunk(chunks_of(b"ab", b"cd"), "4") == b"abcd"
+        with pytest.raises(HTTPException) as e:
+            await read_chunk(chunks_of(), "5")
+
+    assert e.value.status_code == 413
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    ("content_length", "code"), [(None, 411), ("-1", 400), ("3", 400)]
+)
+async def test_read_chunk_needs_its_content_length(content_length, code):
+    with pytest.raises(HTTPException) as e:
+        await read_chunk(chunks_of(b"ab", b"cd"), content_length)
+
+    assert e.value.status_code == code
+
+
+def stored(*numbers: int) -> list[dict]:
+    return [{"PartNumber": n, "ETag": f"etag-{n}", "Size": 1} for n in numbers]
+
+
+def test_completed_parts_are_sorted():
+    assert completed_parts(stored(2, 1)) == [
+        {"ETag": "etag-1", "PartNumber": 1},
+        {"ETag": "etag-2", "PartNumber": 2},
+    ]
+    assert len(completed_parts(stored(1, 2, 3), 3)) == 3
+
+
+@pytest.mark.parametrize(
+    ("numbers", "expected", "detail"),
+    [
+        ((), None, "No parts stored"),
+        ((1, 3), None, "Missing parts: [2]"),
+        ((1, 2), 3, "Missing parts: [3]"),
+        ((1, 2, 3), 2, "Unexpected parts stored"),
+    ],
+)
+def test_completed_parts_must_be_contiguous(numbers, expected, detail):
+    with pytest.raises(HTTPException) as e:
+        completed_parts(stored(*numbers), expected)
+
+    assert e.value.status_code == 409
+    assert e.value.detail == detail
+
+
+def test_sweep_aborts_stale_uploads_once_per_interval():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.abort_uploads_before.return_value = 2
+
+    sweep_stale_uploads(bucket)
+    sweep_stale_uploads(bucket)
+
+    bucket.abort_uploads_before.assert_called_once()
+    prefix, initiated = bucket.abort_uploads_before.call_args.args
+    assert prefix == "devicezip/"
+    expected = datetime.now(UTC) - timedelta(seconds=UPLOAD_SESSION_TTL)
+    assert abs(initiated - expected) < timedelta(minutes=1)
+
+
+def test_sweep_is_per_bucket(caplog):
+    first = Mock(spec=S3Bucket, bucket="first", access_key_id="id")
+    first.abort_uploads_before.return_value = 0
+    second = Mock(spec=S3Bucket, bucket="second", access_key_id="id")
+    second.abort_uploads_before.return_value = 3
+
+    with caplog.at_level("INFO", logger="app.sessions"):
+        sweep_stale_uploads(first)
+        sweep_stale_uploads(second)
+
+    first.abort_uploads_before.assert_called_once()
+    second.abort_uploads_before.assert_called_once()
+    assert caplog.messages == ["Aborted 3 stale uploads in second"]
+
+
+def test_sweep_failures_are_counted():
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.abort_uploads_before.side_effect = ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "ListMultipartUploads"
+    )
+    before = s3_errors("abort_stale_uploads", "AccessDenied")
+
+    sweep_stale_uploads(bucket)
+
+    assert s3_errors("abort_stale_uploads", "AccessDenied") == before + 1
@@ -0,0 +1,242 @@
+import os
+import threading
+from datetime import UTC, datetime
+from functools import partial
+from unittest.mock import Mock, patch
+
+import anyio
+import pytest
+
+from app.disk_cache import DiskCache
+from app.s3 import S3Bucket
+from app.singleflight import SharedDownloads
+
+
+def body_of(*reads: bytes | Exception) -> Mock:
+    return Mock(read=Mock(side_effect=reads))
+
+
+def fake_bucket(chunks: list[bytes], release: threading.Event | None = None) -> Mock:
+    def download(_: str) -> dict:
+        if release:
+            release.wait()
+        return {"Body": body_of(*chunks, b"")}
+
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = download
+    return bucket
+
+
+async def read_all(downloads: SharedDownloads, bucket: Mock, key: str) -> bytes:
+    _, chunks = await downloads.open(bucket, key)
+    return b"".join([chunk async for chunk in chunks])
+
+
+@pytest.mark.anyio
+async def test_concurrent_downloads_share_one_fetch():
+    downloads = SharedDownloads()
+    release = threading.Event()
+    bucket = fake_bucket([b"abc", b"defgh", b"ij"], release)
+    bodies: list[bytes] = []
+
+    async def read() -> None:
+        bodies.append(await read_all(downloads, bucket, "key"))
+
+    with patch("app.singleflight.SHARED_READ_SIZE", 4):
+        async with anyio.create_task_group() as tg:
+            for _ in range(3):
+                tg.start_soon(read)
+            await anyio.sleep(0.05)
+            release.set()
+
+    assert bodies == [b"abcdefghij"] * 3
+    bucket.download.assert_called_once_with("key")
+    assert len(downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_sequential_downloads_fetch_again():
+    downloads = SharedDownloads()
+    bucket = fake_bucket([b"abc"])
+
+    assert await read_all(downloads, bucket, "key") == b"abc"
+    bucket.download.side_effect = None
+    bucket.download.return_value = {"Body": body_of(b"def", b"")}
+    assert await read_all(downloads, bucket, "key") == b"def"
+    assert bucket.download.call_count == 2
+
+
+@pytest.mark.anyio
+async def test_download_errors_reach_readers():
+    downloads = SharedDownloads()
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = RuntimeError("no such key")
+
+    with pytest.raises(RuntimeError, match="no such key"):
+        await downloads.open(bucket, "key")
+    assert len(downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_single_reader_streams_directly():
+    downloads = SharedDownloads()
+    bucket = fake_bucket([b"abc", b"def"])
+
+    with patch("app.singleflight.tempfile.TemporaryFile") as spool:
+        assert await read_all(downloads, bucket, "key") == b"abcdef"
+
+    spool.assert_not_called()
+    assert len(downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_late_requests_do_not_join_a_direct_stream():
+    downloads = SharedDownloads()
+    bucket = fake_bucket([b"abc"])
+    _, first = await downloads.open(bucket, "key")
+    bucket.download.side_effect = None
+    bucket.download.return_value = {"Body": body_of(b"def", b"")}
+
+    assert await read_all(downloads, bucket, "key") == b"def"
+    assert b"".join([chunk async for chunk in first]) == b"abc"
+    first.close()
+    assert await anext(first, None) is None
+    assert bucket.download.call_count == 2
+
+
+@pytest.mark.anyio
+async def test_body_errors_abort_readers():
+    downloads = SharedDownloads()
+    release = threading.Event()
+    bucket = fake_bucket([b"abc"], release)
+    bucket.download.side_effect = None
+    bucket.download.return_value = {
+        "Body": body_of(b"abc", OSError("connection reset"))
+    }
+    errors: list[BaseException] = []
+
+    async def read() -> None:
+        try:
+            await read_all(downloads, bucket, "key")
+        except RuntimeError as e:
+            errors.append(e)
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(read)
+        tg.start_soon(read)
+
+    assert [str(e) for e in errors] == ["Shared download failed"] * 2
+
+
+@pytest.mark.anyio
+async def test_direct_body_errors_reach_the_reader():
+    downloads = SharedDownloads()
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.return_value = {"Body": body_of(b"abc", OSError("reset"))}
+
+    with pytest.raises(OSError, match="reset"):
+        await read_all(downloads, bucket, "key")
+
+
+def endless_body() -> tuple[Mock, threading.Event]:
+    closed = threading.Event()
+    body = Mock(close=Mock(side_effect=closed.set))
+    body.read.return_value = b"x" * 1024
+    return body, closed
+
+
+@pytest.mark.anyio
+async def test_last_reader_leaving_stops_the_fetch():
+    downloads = SharedDownloads()
+    release = threading.Event()
+    body, closed = endless_body()
+    bucket = fake_bucket([], release)
+    bucket.download.side_effect = lambda _: release.wait() and {"Body": body}
+    readers = []
+
+    async def open_reader() -> None:
+        readers.append((await downloads.open(bucket, "key"))[1])
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(open_reader)
+        tg.start_soon(open_reader)
+        await anyio.sleep(0.05)
+        release.set()
+    for reader in readers:
+        assert await anext(reader)
+        reader.close()
+
+    assert await anyio.to_thread.run_sync(closed.wait, 5)
+    reads = body.read.call_count
+    await anyio.sleep(0.05)
+    assert body.read.call_count == reads
+    assert len(downloads) == 0
+
+
+@pytest.mark.anyio
+async def test_readers_leaving_before_the_response_release_the_body():
+    downloads = SharedDownloads()
+    release = threading.Event()
+    body, closed = endless_body()
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.side_effect = lambda _: release.wait() and {"Body": body}
+
+    with anyio.move_on_after(0.05):
+        await downloads.open(bucket, "key")
+    release.set()
+
+    assert await anyio.to_thread.run_sync(closed.wait, 5)
+    assert len(downloads) == 0
+    body.read.assert_not_called()
+
+
+def survey(*chunks: bytes, size: int) -> Mock:
+    bucket = Mock(spec=S3Bucket, bucket="bucket", access_key_id="id")
+    bucket.download.return_value = {
+        "Body": body_of(*chunks, b""),
+        "ContentType": "application/zip",
+        "ContentLength": size,
+        "ETag": '"etag"',
+        "LastModified": datetime(2024, 1, 2, tzinfo=UTC),
+    }
+    return bucket
+
+
+@pytest.mark.anyio
+async def test_download_fills_the_cache(tmp_path):
+    downloads = SharedDownloads()
+    cache = DiskCache(str(tmp_path), 1024)
+    reserve = partial(cache.reserve, "instance", "1v1.0")
+
+    _, chunks = await downloads.open(survey(b"sur", b"vey", size=6), "key", reserve)
+    assert b"".join([chunk async for chunk in chunks]) == b"survey"
+
+    entry = cache.get("instance", "1v1.0")
+    assert entry is not None
+    with open(entry.path, "rb") as f:
+        assert f.read() == b"survey"
+
+
+@pytest.mark.anyio
+async def test_truncated_download_does_not_fill_the_cache(tmp_path):
+    downloads = SharedDownloads()
+    cache = DiskCache(str(tmp_path), 1024)
+    reserve = partial(cache.reserve, "instance", "1v1.0")
+
+    _, chunks = await downloads.open(survey(b"sur", size=6), "key", reserve)
+    assert b"".join([chunk async for chunk in chunks]) == b"sur"
+
+    assert cache.get("instance", "1v1.0") is None
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.anyio
+async def test_download_already_filling_streams_directly():
+    downloads = SharedDownloads()
+    bucket = survey(b"survey", size=6)
+
+    with patch("tempfile.TemporaryFile") as spool:
+        _, chunks = await downloads.open(bucket, "key", Mock(return_value=None))
+        assert b"".join([chunk async for chunk in chunks]) == b"survey"
+
+    spool.assert_not_called()
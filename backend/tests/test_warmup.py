@@ -0,0 +1,112 @@
+import threading
+import time
+from unittest.mock import Mock, call, patch
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.form_validator import FormValidator
+from app.messages import MessageStatus
+from app.warmup import WarmUp, WarmUpState, WarmUpStatus
+
+
+def wait_until_ready(warm_up: WarmUp) -> WarmUpStatus:
+    deadline = time.monotonic() + 5
+    while (status := warm_up.status()).state != WarmUpState.READY:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return status
+
+
+def configs(instance: str) -> dict[str, str] | None:
+    return None if instance == "unknown" else {"instance": instance}
+
+
+@pytest.fixture
+def steps():
+    validator = Mock(spec=FormValidator)
+    validator.prime.side_effect = lambda limit: min(limit, 3)
+    with (
+        patch("app.warmup.load_models") as load_models,
+        patch("app.warmup.get_config", side_effect=configs),
+        patch("app.warmup.make_bucket") as make_bucket,
+        patch("app.warmup.make_form_validator", return_value=validator),
+        # Last, patch() itself resolves targets with it
+        patch("app.warmup.importlib.import_module") as import_module,
+    ):
+        yield Mock(
+            import_module=import_module,
+            load_models=load_models,
+            make_bucket=make_bucket,
+            validator=validator,
+        )
+
+
+def test_warm_up_creates_clients_of_instances(steps):
+    clock = Mock(side_effect=[10.0, 12.0, 12.5])
+    warm_up = WarmUp(("a", "b"), 0, clock=clock, started=9.0)
+
+    assert warm_up.status().state == WarmUpState.PENDING
+    assert not warm_up.ready
+    warm_up.start()
+    status = wait_until_ready(warm_up)
+
+    assert warm_up.ready
+    assert status.status == MessageStatus.SUCCESS
+    assert status.instances == 2
+    assert status.forms == 0
+    assert status.duration == 0.5
+    assert status.errors == []
+    steps.import_module.assert_called_once_with("google.cloud.datastore")
+    steps.load_models.assert_called_once()
+    assert steps.make_bucket.call_args_list == [call(configs("a")), call(configs("b"))]
+    steps.validator.prime.assert_called_with(0)
+    for phase, value in (("import", 1.0), ("warm_up", 0.5)):
+        assert (
+            REGISTRY.get_sample_value(
+                "flow_s3_proxy_startup_duration_seconds", {"phase": phase}
+            )
+            == value
+        )
+
+
+def test_warm_up_primes_form_cache(steps):
+    warm_up = WarmUp(("a",), 50)
+
+    warm_up.run()
+
+    steps.validator.prime.assert_called_once_with(50)
+    assert warm_up.status().forms == 3
+
+
+def test_warm_up_failures_are_reported(steps, caplog):
+    steps.make_bucket.side_effect = [RuntimeError("bad credentials"), Mock()]
+    warm_up = WarmUp(("a", "unknown", "b"), 0)
+
+    with caplog.at_level("INFO", logger="app.warmup"):
+        warm_up.run()
+
+    status = warm_up.status()
+    # Failures only cost speed, requests still create what they need
+    assert status.state == WarmUpState.READY
+    assert status.instances == 1
+    assert status.errors == ["a: bad credentials", "unknown: Unknown instance"]
+    assert caplog.messages[:2] == [
+        "Warm-up of a failed",
+        "Warm-up of unknown failed",
+    ]
+    assert caplog.messages[2].startswith("Ready ")
+
+
+def test_warm_up_starts_once(steps):
+    release = threading.Event()
+    steps.load_models.side_effect = lambda: release.wait()
+    warm_up = WarmUp((), 0)
+
+    warm_up.start()
+    warm_up.start()
+    assert warm_up.status().status == MessageStatus.FAIL
+    release.set()
+
+    assert wait_until_ready(warm_up).state == WarmUpState.READY
+    steps.load_models.assert_called_once()